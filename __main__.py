@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+# Lets tpt be run as "python -m tpt ...".  See cli.py.
+
+import sys
+from tpt.cli import main
+
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
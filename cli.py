@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Command-line entry point for tpt.  Run as "python -m tpt <subcommand> ...".
+# Only argparse, json and shlex are imported at startup; the rest of tpt is imported by the subcommand that needs it,
+# so that "python -m tpt status" and friends start fast.
+
+import sys
+import json
+import shlex
+import argparse
+
+
+
+def job_specs_from_file(fid, file_format) :
+    '''
+    Yields (slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list, memory_in_mb, walltime_in_minutes)
+    tuples from a job-spec file, one line at a time.  Blank lines and lines starting with '#' are skipped.
+
+    In 'jsonl' format, each line is a JSON object with keys 'argv' (required), 'slots' (default 1), 'options' (list
+    of bsub options, default []), 'log' (default '', meaning /dev/null), 'memory_in_mb' and 'walltime_in_minutes'.
+
+    In 'tsv' format, each line is: slots <tab> bsub options (as a single shell-quoted string) <tab> log file <tab>
+    argv[0] <tab> argv[1] ...
+    '''
+    for (line_index, line) in enumerate(fid) :
+        stripped_line = line.strip()
+        if len(stripped_line)==0 or stripped_line.startswith('#') :
+            continue
+        try :
+            if file_format == 'jsonl' :
+                spec = json.loads(stripped_line)
+                yield (int(spec.get('slots', 1)),
+                       spec.get('log', ''),
+                       list(spec.get('options', [])),
+                       list(spec['argv']),
+                       spec.get('memory_in_mb'),
+                       spec.get('walltime_in_minutes'))
+            elif file_format == 'tsv' :
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 4 :
+                    raise ValueError('expected at least 4 tab-separated fields, got %d' % len(fields))
+                yield (int(fields[0]), fields[2], shlex.split(fields[1]), fields[3:], None, None)
+            else :
+                raise RuntimeError('Unknown job-spec format: %s' % file_format)
+        except (ValueError, KeyError, TypeError) as e :
+            raise RuntimeError('Unable to parse line %d of the job-spec file: %s\n%s' % (line_index+1, str(e), line))
+
+
+
+def format_from_file_name(file_name) :
+    # Guess the job-spec format from the file name
+    if file_name.endswith('.jsonl') or file_name.endswith('.json') :
+        return 'jsonl'
+    else :
+        return 'tsv'
+
+
+
+def run_subcommand(args) :
+    # The job specs are parsed one line at a time, but all of them are enqueued before anything is submitted, since
+    # bqueue_type.run() works on a fixed set of jobs.  So when reading from a pipe, nothing is submitted until the
+    # producer is done.
+    from tpt.fuster import bqueue_type
+    job_id_file_name = args.job_id_file if args.job_id_file is not None else args.spec_file + '.jobids'
+    if args.spec_file == '-' and args.job_id_file is None :
+        raise RuntimeError('--job-id-file is required when reading the job specs from stdin')
+    # Start a fresh job id file, so status and cancel don't mix this run's jobs up with an earlier run's
+    open(job_id_file_name, 'w').close()
+    bqueue = bqueue_type(do_actually_submit=not args.local,
+                         maximum_running_slot_count=args.max_slots,
+                         maximum_running_memory_in_mb=args.max_memory_mb,
+                         maximum_running_slot_minutes=args.max_slot_minutes,
+                         job_log_archive_folder_path=args.log_archive,
+                         lsf_event_log_file_name=args.event_log,
+                         do_harvest_results=(args.results_csv is not None),
+                         job_id_file_name=job_id_file_name,
+                         do_adapt_running_slot_count=args.adapt_slots,
+                         minimum_running_slot_count=args.min_slots)
+    file_format = args.format if args.format is not None else format_from_file_name(args.spec_file)
+    fid = sys.stdin if args.spec_file == '-' else open(args.spec_file, 'r')
+    try :
+        for (slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list, memory_in_mb, walltime_in_minutes) in \
+                job_specs_from_file(fid, file_format) :
+            bqueue.enqueue(slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list, memory_in_mb, walltime_in_minutes)
+    finally :
+        if fid is not sys.stdin :
+            fid.close()
+    job_statuses = bqueue.run(args.max_wait, not args.no_progress_bar)
+    if args.results_csv is not None :
+        bqueue.results_table().write_csv(args.results_csv)
+    succeeded_count = sum([ job_status==+1 for job_status in job_statuses ])
+    failed_count = sum([ job_status==-1 for job_status in job_statuses ])
+    print('%d jobs succeeded, %d failed, %d did not finish' % (succeeded_count, failed_count, len(job_statuses)-succeeded_count-failed_count))
+    return 0 if succeeded_count==len(job_statuses) else 1
+
+
+
+def get_lsf_stat_from_job_index(job_id_file_name) :
+    # Returns a dict mapping job index to the 'best' LSF status of all the job ids submitted for it
+    from tpt.fuster import read_job_id_file, get_bjobs_records
+    job_ids_from_job_index = read_job_id_file(job_id_file_name)
+    all_job_ids = [ job_id for job_ids in job_ids_from_job_index.values() for job_id in job_ids ]
+    record_from_job_id = get_bjobs_records(all_job_ids, ['stat'])
+    rank_from_lsf_stat = { 'DONE':3, 'RUN':2, 'PEND':1 }
+    result = {}
+    for (job_index, job_ids) in job_ids_from_job_index.items() :
+        lsf_stats = [ record_from_job_id[job_id]['stat'] if job_id in record_from_job_id else 'FORGOTTEN' for job_id in job_ids ]
+        result[job_index] = max(lsf_stats, key=lambda lsf_stat : rank_from_lsf_stat.get(lsf_stat, 0))
+    return (result, job_ids_from_job_index, record_from_job_id)
+
+
+
+def status_subcommand(args) :
+    (lsf_stat_from_job_index, _, _) = get_lsf_stat_from_job_index(args.job_id_file)
+    job_count_from_lsf_stat = {}
+    for lsf_stat in lsf_stat_from_job_index.values() :
+        job_count_from_lsf_stat[lsf_stat] = job_count_from_lsf_stat.get(lsf_stat, 0) + 1
+    print('%d jobs submitted' % len(lsf_stat_from_job_index))
+    for lsf_stat in sorted(job_count_from_lsf_stat.keys()) :
+        print('%-10s %d' % (lsf_stat, job_count_from_lsf_stat[lsf_stat]))
+    return 0
+
+
+
+def cancel_subcommand(args) :
+    from tpt.fuster import bkill
+    (_, job_ids_from_job_index, record_from_job_id) = get_lsf_stat_from_job_index(args.job_id_file)
+    # Jobs bjobs has forgotten about are long finished
+    job_ids_to_kill = [ job_id for job_ids in job_ids_from_job_index.values() for job_id in job_ids
+                        if job_id in record_from_job_id and record_from_job_id[job_id]['stat'] not in ('DONE', 'EXIT') ]
+    bkill(job_ids_to_kill)
+    print('Killed %d jobs' % len(job_ids_to_kill))
+    return 0
+
+
+
+def main(argv) :
+    parser = argparse.ArgumentParser(prog='tpt', description='Run many LSF jobs from a job-spec file, and keep track of them.')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    run_parser = subparsers.add_parser('run', help='submit the jobs in a job-spec file, and wait for them to finish')
+    run_parser.add_argument('spec_file', help='job-spec file (.tsv or .jsonl), or - for stdin.  It is read in full before any jobs are submitted')
+    run_parser.add_argument('--format', choices=['tsv', 'jsonl'], help='job-spec format (default: guessed from the file name)')
+    run_parser.add_argument('--job-id-file', help='where to record job ids, for status and cancel (default: <spec file>.jobids).  Overwritten on each run')
+    run_parser.add_argument('--max-slots', type=float, default=float('inf'), help='maximum slots in use at once')
+    run_parser.add_argument('--adapt-slots', action='store_true', help='adjust the slot cap to how fast jobs start, up to --max-slots')
+    run_parser.add_argument('--min-slots', type=float, default=1, help='lower bound on the slot cap, with --adapt-slots')
+    run_parser.add_argument('--max-memory-mb', type=float, default=float('inf'), help='maximum memory reserved at once')
+    run_parser.add_argument('--max-slot-minutes', type=float, default=float('inf'), help='maximum total of slot count times run-time limit (-W) over running jobs')
+    run_parser.add_argument('--max-wait', type=float, default=float('inf'), help='give up (and cancel outstanding jobs) after this many seconds')
+    run_parser.add_argument('--local', action='store_true', help='run the jobs locally, one at a time, instead of submitting them')
+    run_parser.add_argument('--log-archive', help='collect job logs into a job log archive in this folder')
+    run_parser.add_argument('--event-log', help='track job states by tailing this LSF event log instead of polling bjobs')
+    run_parser.add_argument('--results-csv', help='write per-job resource accounting to this CSV file')
+    run_parser.add_argument('--no-progress-bar', action='store_true', help='don\'t show a progress bar')
+    run_parser.set_defaults(function=run_subcommand)
+
+    status_parser = subparsers.add_parser('status', help='summarize the state of the jobs from an earlier run')
+    status_parser.add_argument('job_id_file', help='job id file written by run')
+    status_parser.set_defaults(function=status_subcommand)
+
+    cancel_parser = subparsers.add_parser('cancel', help='kill the unfinished jobs from an earlier run')
+    cancel_parser.add_argument('job_id_file', help='job id file written by run')
+    cancel_parser.set_defaults(function=cancel_subcommand)
+
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
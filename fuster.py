@@ -1,12 +1,144 @@
 #!/usr/bin/env python
 
+import os
+import sys
 import time
+import random
+import subprocess
 import math
+import re
+import csv
+import statistics
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import concurrent.futures
 from tpt.utilities import *
+from tpt.lsf_event_log import *
+from tpt.job_log_archive import job_log_archive_type
+from tpt.pilot import pilot_pool_type
+from tpt.runtime_history import runtime_history_type, longest_predicted_first_order
+
+
+
+# Rate limiters for LSF commands, one for submit-type traffic (bsub, bkill) and one for queries (bjobs, bhist).
+# Use set_lsf_rate_limits() to change them.
+_lsf_submit_rate_limiter = token_bucket_type(20, 100)
+_lsf_query_rate_limiter = token_bucket_type(2, 10)
+
+
+
+def set_lsf_rate_limits(submit_rate=20, submit_burst_count=100, query_rate=2, query_burst_count=10, shared_state_folder_path=None) :
+    '''
+    Sets the rates (in calls per second) and burst sizes allowed for LSF submit-type commands (bsub, bkill) and
+    queries (bjobs, bhist).  Use math.inf for no limit.  If shared_state_folder_path is given, the budgets are kept
+    in files in that folder (e.g. /tmp), and are shared by all the tpt processes on the host that use the same folder.
+    '''
+    global _lsf_submit_rate_limiter, _lsf_query_rate_limiter
+    if shared_state_folder_path is None :
+        submit_state_file_name = None
+        query_state_file_name = None
+    else :
+        submit_state_file_name = os.path.join(shared_state_folder_path, 'tpt-lsf-submit-rate-limit')
+        query_state_file_name = os.path.join(shared_state_folder_path, 'tpt-lsf-query-rate-limit')
+    _lsf_submit_rate_limiter = token_bucket_type(submit_rate, submit_burst_count, submit_state_file_name)
+    _lsf_query_rate_limiter = token_bucket_type(query_rate, query_burst_count, query_state_file_name)
+
+
+
+def get_lsf_rate_limit_metrics() :
+    # Returns a dict with the metrics() of the submit and query rate limiters, i.e. how much time has gone to waiting for tokens
+    result = { 'submit': _lsf_submit_rate_limiter.metrics(),
+               'query': _lsf_query_rate_limiter.metrics() }
+    return result
+
+
+
+# Timeouts (in seconds) for LSF submit-type commands and queries, and how many times a query that times out or fails
+# is retried.  Use set_lsf_command_timeouts() to change them.
+_lsf_submit_timeout = 60
+_lsf_query_timeout = 30
+_lsf_query_retry_count = 2
+_lsf_retry_base_delay = 1
+
+
+
+def set_lsf_command_timeouts(submit_timeout=60, query_timeout=30, query_retry_count=2, retry_base_delay=1) :
+    '''
+    Sets the timeouts (in seconds) for LSF submit-type commands (bsub, bkill) and queries (bjobs, bhist).  A command
+    still running when its timeout expires is killed.  Queries that time out (or, for bjobs on specific jobs, fail) 
+    are retried up to query_retry_count times, after a delay of about retry_base_delay seconds, doubling each time, 
+    with random jitter.  Submissions are never retried, since a bsub that timed out may have submitted the job anyway.
+    Use None for no timeout.
+    '''
+    global _lsf_submit_timeout, _lsf_query_timeout, _lsf_query_retry_count, _lsf_retry_base_delay
+    _lsf_submit_timeout = submit_timeout
+    _lsf_query_timeout = query_timeout
+    _lsf_query_retry_count = query_retry_count
+    _lsf_retry_base_delay = retry_base_delay
+
+
+
+class lsf_unavailable_error(RuntimeError) :
+    # Raised when an LSF command times out or fails in a way that suggests LSF itself is in trouble, even after any retries
+    pass
+
+
+
+class lsf_submit_timeout_error(lsf_unavailable_error) :
+    # Raised when bsub times out.  Unlike other bsub failures, the job may have been submitted anyway, so it shouldn't
+    # just be submitted again.
+    pass
+
+
+
+def run_lsf_query(command_line, do_check_return_code=False, is_output_complete=None) :
+    '''
+    Runs an LSF query command (bjobs, bhist), subject to the query rate limit and timeout, retrying with jittered 
+    exponential backoff if it times out, or if do_check_return_code is true and it returns nonzero.  If 
+    is_output_complete is given, it is called as is_output_complete(return_code, stdout, stderr), and the command is 
+    retried if it returns false.  (bjobs returns nonzero when some of the jobs asked about are merely not found, so 
+    the return code alone can't tell that apart from LSF being down.)  Returns (return_code, stdout, stderr).  Raises 
+    lsf_unavailable_error if all the tries fail.
+    '''
+    try_count = _lsf_query_retry_count + 1
+    for try_index in range(try_count) :
+        if try_index > 0 :
+            time.sleep(_lsf_retry_base_delay * 2**(try_index-1) * random.uniform(0.5, 1.5))
+        _lsf_query_rate_limiter.acquire()
+        try :
+            (return_code, stdout, stderr) = run_subprocess_and_return_code_and_stdout_and_stderr(command_line, timeout=_lsf_query_timeout)
+        except subprocess.TimeoutExpired :
+            problem = 'timed out after %g seconds' % _lsf_query_timeout
+            continue
+        if do_check_return_code and return_code != 0 :
+            problem = 'returned %d.  Stdout/stderr:\n%s%s' % (return_code, stdout, stderr)
+            continue
+        if is_output_complete is not None and not is_output_complete(return_code, stdout, stderr) :
+            problem = 'returned %d, without reporting on all the jobs.  Stdout/stderr:\n%s%s' % (return_code, stdout, stderr)
+            continue
+        return (return_code, stdout, stderr)
+    raise lsf_unavailable_error('The command "%s" failed %d times.  The last time it %s' % (space_out(command_line), try_count, problem))
+
+
+
+def parse_bjobs_output(stdout, stderr) :
+    # Returns (bjobs_line_from_job_id, forgotten_job_ids), where forgotten_job_ids is the set of job ids that bjobs
+    # says are 'not found', i.e. that finished long enough ago that bjobs has forgotten them.
+    bjobs_line_from_job_id = {}
+    for line in stdout.split('\n') :
+        tokens = line.split()
+        if isladen(tokens) and tokens[0].isdigit() :   # skips the header
+            bjobs_line_from_job_id[int(tokens[0])] = line
+    forgotten_job_ids = set([ int(job_id_as_string) for job_id_as_string in re.findall(r'Job <([0-9]+)> is not found', stderr) ])
+    return (bjobs_line_from_job_id, forgotten_job_ids)
 
 
 
 def get_bjobs_lines(job_ids) :
+    # Returns a list of bjobs output lines, one per job id, with None for the jobs that bjobs has forgotten
     job_id_count = len(job_ids) 
     job_id_count_per_call = 10000 
     batch_count = math.ceil(job_id_count / job_id_count_per_call) 
@@ -17,41 +149,66 @@ def get_bjobs_lines(job_ids) :
         job_ids_this_batch = job_ids[first_job_index:last_job_index]
         job_ids_as_strings = [ ('%d' % job_id) for job_id in job_ids_this_batch ]
         command_line = ['bjobs'] + job_ids_as_strings
-        (status, stdout) = run_subprocess_and_return_code_and_stdout(command_line) 
-        if status != 0 :
-            raise RuntimeError('There was a problem running the command "%s".  Return code: %d.  Stdout/stderr:\n%s' % (str(command_line), status, stdout) )
-            
-        lines = stdout.split('\n')   # Want a list of lines
-        if len(lines)<1 :
-            raise RuntimeError('There was a problem submitting the bjobs command "%s".  Unable to parse output.  Output was:\n%s', (str(command_line), stdout) ) 
-        job_ids_this_batch_count = len(job_ids_this_batch) 
-        bjobs_lines = lines[1:(job_ids_this_batch_count+1)]   # drop the header
+        def is_output_complete(return_code, stdout, stderr) :
+            # Every job should either have a line, or be reported as not found
+            (bjobs_line_from_job_id, forgotten_job_ids) = parse_bjobs_output(stdout, stderr)
+            return all([ (job_id in bjobs_line_from_job_id or job_id in forgotten_job_ids) for job_id in job_ids_this_batch ])
+        (status, stdout, stderr) = run_lsf_query(command_line, is_output_complete=is_output_complete) 
+        (bjobs_line_from_job_id, _) = parse_bjobs_output(stdout, stderr)
+        bjobs_lines = [ bjobs_line_from_job_id.get(job_id) for job_id in job_ids_this_batch ]
         bjobs_lines_from_batch_index[batch_index] = bjobs_lines 
     result = flatten(bjobs_lines_from_batch_index)
     return result
 
 
 
+def get_bhist_final_lsf_stats(job_ids) :
+    '''
+    Runs "bhist -a -l" on the given job ids, in batches, and returns a dict mapping job id to 'DONE' or 'EXIT', for 
+    the jobs that bhist knows have finished.  Used as a fallback for jobs that bjobs has forgotten about.
+    '''
+    job_id_count = len(job_ids)
+    job_id_count_per_call = 10000
+    batch_count = math.ceil(job_id_count / job_id_count_per_call)
+    result = {}
+    for batch_index in range(batch_count) :
+        job_ids_this_batch = job_ids[job_id_count_per_call*batch_index:job_id_count_per_call*(batch_index+1)]
+        command_line = ['bhist', '-a', '-l'] + [ ('%d' % job_id) for job_id in job_ids_this_batch ]
+        (status, stdout, stderr) = run_lsf_query(command_line)
+        # bhist -l wraps long lines, indenting the continuations, so join those back up first.  The jobs are 
+        # separated by lines of dashes.
+        text = re.sub(r'\n +', '', stdout)
+        for job_text in re.split(r'\n-{10,}\n', text) :
+            match = re.search(r'Job <([0-9]+)', job_text)
+            if match is None :
+                continue
+            job_id = int(match.group(1))
+            if 'Done successfully' in job_text :
+                result[job_id] = 'DONE'
+            elif 'Exited' in job_text :
+                result[job_id] = 'EXIT'
+    return result
+
+
+
 def get_single_bsub_job_status(job_id) :
     # Possible results are {-1,0,+1}.
     #   -1 means errored out
     #    0 mean running or pending
     #   +1 means completed successfully
     
-    if math.isfinite(job_id) :
+    if math.isnan(job_id) :
         # This means the job has not been submitted yet
         result = math.nan 
-    elif job_id == -1 :
-        # This is a job that was run locally and exited cleanly
+    elif job_id == -1 or job_id == -3 :
+        # This is a job that was run locally and exited cleanly, or was skipped because its outputs were up to date
         result = +1 
     elif job_id == -2 :
         # This is a job that was run locally and errored
         result = -1 
     else :
         command_line = ['bjobs', str(job_id)]
-        (status, stdout) = run_subprocess_and_return_code_and_stdout(command_line) 
-        if status != 0 :
-            raise RuntimeError('There was a problem running the command %s.  The return code was %d' % (command_line, status)) 
+        (status, stdout, stderr) = run_lsf_query(command_line, do_check_return_code=True) 
         lines = stdout.split('\n')
         if len(lines)<2 :
             raise RuntimeError('There was a problem submitting the bjobs command "%s".  Unable to parse output.  Output was:\n%s' % (space_out(command_line), stdout)) 
@@ -85,7 +242,7 @@ def get_bsub_job_status(job_ids) :
     has_not_been_submitted = list(map(math.isnan, job_ids))
     assign_where_true_bang(result, has_not_been_submitted, 0)
     was_run_locally = list(map(lambda job_id : (job_id<0), job_ids))   # means the job was run locally
-    was_run_locally_and_exited_cleanly = list(map(lambda job_id : (job_id==-1), job_ids))
+    was_run_locally_and_exited_cleanly = list(map(lambda job_id : (job_id==-1 or job_id==-3), job_ids))   # -3 means skipped as up-to-date
     was_run_locally_and_errored = list(map(lambda job_id : (job_id==-2), job_ids))
     assign_where_true_bang(result, was_run_locally_and_exited_cleanly, +1)
     assign_where_true_bang(result, was_run_locally_and_errored, -1)
@@ -93,13 +250,50 @@ def get_bsub_job_status(job_ids) :
         return result
     was_submitted = [ (not el) for el in elementwise_list_or(was_run_locally, has_not_been_submitted) ]
     submitted_job_ids = ibb(job_ids, was_submitted) 
-    bjobs_lines = get_bjobs_lines(submitted_job_ids) 
-    bjobs_line_index = 0
+    (lsf_stat_from_submitted_index, _) = get_lsf_stat_and_exec_host(submitted_job_ids)
+    job_index_from_submitted_index = where(was_submitted)
+    for (job_index, lsf_stat) in zip(job_index_from_submitted_index, lsf_stat_from_submitted_index) :
+        result[job_index] = job_status_code_from_lsf_stat(lsf_stat)
+    return result
+
+
+
+def job_status_code_from_lsf_stat(lsf_status) :
+    # Converts a bjobs STAT string like 'DONE', 'EXIT', 'RUN', 'PEND', etc. to one of {-1,0,+1}
+    if lsf_status == 'DONE' :
+        running_job_status_code = +1 
+    elif lsf_status == 'EXIT' :
+        # This seems to indicate an exit with something other than a 0 return code
+        running_job_status_code = -1 
+    elif ( lsf_status=='PEND' or lsf_status=='RUN' or lsf_status=='UNKWN' or
+           lsf_status=='SSUSP' or lsf_status=='PSUSP' or lsf_status=='USUSP' ) :
+        running_job_status_code = 0 
+    else :
+        raise RuntimeError('Unknown bjobs status string: %s' % lsf_status) 
+    return running_job_status_code
+
+
+
+def get_lsf_stat_and_exec_host(job_ids) :
+    '''
+    Calls bjobs on the given (submitted) job ids, and returns (lsf_stat_from_job_index, exec_host_from_job_index).
+    The stats are strings like 'DONE', 'EXIT', 'RUN', 'PEND', etc.  The exec host is the name of the (first) host 
+    the job is running on, or '' if it hasn't started yet.  Jobs that bjobs has forgotten about have finished, so 
+    their stat comes from bhist, and is 'EXIT' if bhist doesn't know how they ended either.
+    '''
+    job_count = len(job_ids)
+    bjobs_lines = get_bjobs_lines(job_ids) 
+    forgotten_job_ids = [ job_id for (job_id, bjobs_line) in zip(job_ids, bjobs_lines) if bjobs_line is None ]
+    final_lsf_stat_from_forgotten_job_id = get_bhist_final_lsf_stats(forgotten_job_ids) if isladen(forgotten_job_ids) else {}
+    lsf_stat_from_job_index = [None] * job_count
+    exec_host_from_job_index = [None] * job_count
     for job_index in range(job_count) :
-        if not was_submitted[job_index] :
-            continue 
         job_id = job_ids[job_index] 
         bjobs_line = bjobs_lines[job_index]
+        if bjobs_line is None :
+            lsf_stat_from_job_index[job_index] = final_lsf_stat_from_forgotten_job_id.get(job_id, 'EXIT')
+            exec_host_from_job_index[job_index] = ''
+            continue
         tokens = bjobs_line.split()
         if len(tokens)<3 :
             raise RuntimeError('There was a problem with a bjobs command.  Unable to parse output.  Output was: %s' % bjobs_line) 
@@ -107,41 +301,187 @@ def get_bsub_job_status(job_ids) :
         running_job_id = int(running_job_id_as_string) 
         if running_job_id != job_id :
             raise RuntimeError('The running job id (%d) doesn''t match the job id (%d)' % (running_job_id, job_id) ) 
-        lsf_status = tokens[2]   # Should be string like 'DONE', 'EXIT', 'RUN', 'PEND', etc.
-        if lsf_status == 'DONE' :
-            running_job_status_code = +1 
-        elif lsf_status == 'EXIT' :
-            # This seems to indicate an exit with something other than a 0 return code
-            running_job_status_code = -1 
-        elif ( lsf_status=='PEND' or lsf_status=='RUN' or lsf_status=='UNKWN' or
-               lsf_status=='SSUSP' or lsf_status=='PSUSP' or lsf_status=='USUSP' ) :
-            running_job_status_code = 0 
+        lsf_stat = tokens[2]   # Should be string like 'DONE', 'EXIT', 'RUN', 'PEND', etc.
+        # Columns are JOBID USER STAT QUEUE FROM_HOST EXEC_HOST JOB_NAME SUBMIT_TIME, but EXEC_HOST is blank 
+        # for jobs that haven't started.  For multi-slot jobs it looks like '4*h07u01'.
+        if lsf_stat=='PEND' or lsf_stat=='PSUSP' or len(tokens)<6 :
+            exec_host = ''
         else :
-            raise RuntimeError('Unknown bjobs status string: %s', lsf_status) 
-        result[job_index] = running_job_status_code 
-        bjobs_line_index = bjobs_line_index + 1 
-    return result
+            exec_host = tokens[5].split('*')[-1]
+        lsf_stat_from_job_index[job_index] = lsf_stat
+        exec_host_from_job_index[job_index] = exec_host
+    return (lsf_stat_from_job_index, exec_host_from_job_index)
+
+
+
+def bkill(job_ids) :
+    '''
+    Kills the given LSF jobs, using as few bkill calls as possible.  Job ids that are not positive (i.e. jobs that 
+    were never submitted, or were run locally) are ignored.  Errors from bkill (e.g. because a job has already
+    finished) are ignored, too.
+    '''
+    lsf_job_ids = [ job_id for job_id in job_ids if job_id > 0 ]
+    job_id_count = len(lsf_job_ids)
+    job_id_count_per_call = 10000
+    batch_count = math.ceil(job_id_count / job_id_count_per_call)
+    for batch_index in range(batch_count) :
+        job_ids_this_batch = lsf_job_ids[job_id_count_per_call*batch_index:job_id_count_per_call*(batch_index+1)]
+        command_line = ['bkill'] + [ ('%d' % job_id) for job_id in job_ids_this_batch ]
+        _lsf_submit_rate_limiter.acquire()
+        try :
+            run_subprocess_and_return_code_and_stdout(command_line, timeout=_lsf_submit_timeout)
+        except subprocess.TimeoutExpired :
+            pass
 
 
 
 def determine_which_jobs_to_submit(slot_count_from_submittable_index, maximum_slot_count) :
     # Determine which of the submittable jobs will be submitted, given how
     # many slots each submittable job needs, and the maximum number of slots we can use.
-    submittable_count = len(slot_count_from_submittable_index) 
+    resources_from_submittable_index = [ (slot_count,) for slot_count in slot_count_from_submittable_index ]
+    result = determine_which_jobs_to_submit_given_resources(resources_from_submittable_index, (maximum_slot_count,))
+    return result
+
+
+
+def determine_which_jobs_to_submit_given_resources(resources_from_submittable_index, maximum_resources) :
+    # Like determine_which_jobs_to_submit(), but each job needs a vector of resources, e.g.
+    # (slot_count, memory_in_mb, slot_minutes) as returned by budgeted_resources(), and there is a budget for each of those.
+    # Jobs are considered in order, and a job is submitted if it fits in the budget for every resource at once.
+    # A job that doesn't fit is skipped over, so that smaller jobs later on can fill in the gaps.
+    # The first resource is assumed to be the slot count, which every job needs at least one of.
+    submittable_count = len(resources_from_submittable_index)
     will_submit_from_submittable_index = [False] * submittable_count
-    slots_used_so_far = 0 
+    resource_count = len(maximum_resources)
+    resources_used_so_far = [0] * resource_count
     for submittable_index in range(submittable_count) :
-        slot_count_this_submittable = slot_count_from_submittable_index[submittable_index]
-        putative_slots_used = slots_used_so_far + slot_count_this_submittable 
-        if putative_slots_used <= maximum_slot_count :
-            will_submit_from_submittable_index[submittable_index] = True 
-            slots_used_so_far = putative_slots_used 
-            if slots_used_so_far >= maximum_slot_count :
+        resources_this_submittable = resources_from_submittable_index[submittable_index]
+        putative_resources_used = [ (resources_used_so_far[i] + resources_this_submittable[i]) for i in range(resource_count) ]
+        if all([ (putative_resources_used[i] <= maximum_resources[i]) for i in range(resource_count) ]) :
+            will_submit_from_submittable_index[submittable_index] = True
+            resources_used_so_far = putative_resources_used
+            if resources_used_so_far[0] >= maximum_resources[0] :
                 break
     return will_submit_from_submittable_index
 
 
 
+def mb_from_lsf_memory_amount(amount_string) :
+    # Converts a memory amount from a bsub option, like '4000', '4GB' or '512K', to megabytes.  Amounts with no unit
+    # are taken to be in MB (i.e. LSF_UNIT_FOR_LIMITS=MB), as in bsub_resource_options_as_list().
+    match = re.fullmatch(r'([0-9.]+)([KMGTPE]?)B?', amount_string.strip(), re.IGNORECASE)
+    if match is None :
+        raise RuntimeError('Unable to parse the memory amount "%s" in the bsub options' % amount_string)
+    mb_per_unit_from_unit = { '':1, 'k':1/1024, 'm':1, 'g':1024, 't':1024**2, 'p':1024**3, 'e':1024**4 }
+    result = float(match.group(1)) * mb_per_unit_from_unit[match.group(2).lower()]
+    return result
+
+
+
+def _rusage_memory_amount_string(bsub_options_as_list) :
+    # The amount in a "-R rusage[mem=...]" option, e.g. '4000' or '4GB', or None if there isn't one
+    for option in bsub_options_as_list :
+        match = re.search(r'rusage\[[^\]]*\bmem=([^:,\]\s]+)', option)
+        if match :
+            return match.group(1)
+    return None
+
+
+
+def memory_in_mb_from_bsub_options(bsub_options_as_list) :
+    # Digs the memory reservation out of a "-R rusage[mem=...]" option, if there is one, or failing that the memory
+    # limit out of a "-M ..." option.  Returns 0 if there's neither.
+    amount_string = _rusage_memory_amount_string(bsub_options_as_list)
+    if amount_string is not None :
+        return mb_from_lsf_memory_amount(amount_string)
+    option_count = len(bsub_options_as_list)
+    for i in range(option_count-1) :
+        if bsub_options_as_list[i] == '-M' :
+            return mb_from_lsf_memory_amount(bsub_options_as_list[i+1])
+    return 0
+
+
+
+def walltime_in_minutes_from_bsub_options(bsub_options_as_list) :
+    # Digs the run-time limit out of a "-W [hours:]minutes[/host_name]" option, if there is one.
+    # Returns 0 if there isn't one.
+    option_count = len(bsub_options_as_list)
+    for i in range(option_count-1) :
+        if bsub_options_as_list[i] == '-W' :
+            tokens = bsub_options_as_list[i+1].split('/')[0].split(':')   # the host normalizes the limit, so ignore it
+            if len(tokens) == 1 :
+                return float(tokens[0])
+            else :
+                return 60*float(tokens[0]) + float(tokens[1])
+    return 0
+
+
+
+def bsub_resource_options_as_list(memory_in_mb=None, walltime_in_minutes=None) :
+    # Generates the bsub options that reserve the given memory (in MB, or whatever LSF_UNIT_FOR_LIMITS is
+    # set to at your site) and set the given run-time limit.  Options that are None are left out.
+    result = []
+    if memory_in_mb is not None :
+        result = result + [ '-R', 'rusage[mem=%d]' % math.ceil(memory_in_mb) ]
+    if walltime_in_minutes is not None :
+        result = result + [ '-W', '%d' % math.ceil(walltime_in_minutes) ]
+    return result
+
+
+
+def sum_of_resources(resources_from_job_index) :
+    # Elementwise sum of a list of resource vectors, e.g. (slot_count, memory_in_mb, slot_minutes)
+    result = [0, 0, 0]
+    for resources in resources_from_job_index :
+        result = [ (total + resource) for (total, resource) in zip(result, resources) ]
+    return result
+
+
+
+def budgeted_resources(resources) :
+    # Converts a job's (slot_count, memory_in_mb, walltime_in_minutes) into the vector that gets budgeted, 
+    # (slot_count, memory_in_mb, slot_minutes), where slot_minutes is slot_count times the run-time limit, i.e. 
+    # how much of the cluster the job can tie up.
+    (slot_count, memory_in_mb, walltime_in_minutes) = resources
+    result = (slot_count, memory_in_mb, slot_count*walltime_in_minutes)
+    return result
+
+
+
+def check_job_fits_in_budget(resources, maximum_resources) :
+    # Raises if a job's budgeted resources exceed the whole budget for some resource, since such a job would never
+    # get submitted, and the queue would wait on it forever.
+    names = ['slot count', 'memory in MB', 'slot-minutes']
+    for i in range(len(maximum_resources)) :
+        if resources[i] > maximum_resources[i] :
+            raise RuntimeError('Job needs %s %g, but the budget for all running jobs is only %g' % 
+                               (names[i], resources[i], maximum_resources[i]))
+
+
+
+def resolve_job_resources(slot_count, bsub_options_as_list, memory_in_mb=None, walltime_in_minutes=None) :
+    '''
+    Works out the (slot_count, memory_in_mb, walltime_in_minutes) resource vector for a job, and the bsub options
+    to use for it.  If memory_in_mb or walltime_in_minutes is given, the matching bsub options are appended to
+    bsub_options_as_list, and it's an error for bsub_options_as_list to already have a memory reservation or 
+    run-time limit of its own, since then LSF and the submission planner could disagree.  If not, they are read out 
+    of bsub_options_as_list, and are 0 if not present there.  Returns (resources, bsub_options_as_list).  Does not 
+    mutate the input.
+    '''
+    if memory_in_mb is not None and _rusage_memory_amount_string(bsub_options_as_list) is not None :
+        raise RuntimeError('memory_in_mb was given, but the bsub options %s already reserve memory' % repr(bsub_options_as_list))
+    if walltime_in_minutes is not None and '-W' in bsub_options_as_list :
+        raise RuntimeError('walltime_in_minutes was given, but the bsub options %s already set a run-time limit' % repr(bsub_options_as_list))
+    extra_options_as_list = bsub_resource_options_as_list(memory_in_mb, walltime_in_minutes)
+    if memory_in_mb is None :
+        memory_in_mb = memory_in_mb_from_bsub_options(bsub_options_as_list)
+    if walltime_in_minutes is None :
+        walltime_in_minutes = walltime_in_minutes_from_bsub_options(bsub_options_as_list)
+    resources = (slot_count, memory_in_mb, walltime_in_minutes)
+    return (resources, bsub_options_as_list + extra_options_as_list)
+
+
+
 def bsub(command_line_as_list, do_actually_submit=True, slot_count=1, stdouterr_file_name='/dev/null', options_as_list=[]) :
     # Wrapper for LSF bsub command.  Returns job id as a double.
     # Throws error if anything goes wrong.
@@ -153,7 +493,14 @@ def bsub(command_line_as_list, do_actually_submit=True, slot_count=1, stdouterr_
               options_as_list + 
               command_line_as_list )      
         # printf('%s\n', bsub_command) 
-        raw_stdout = run_subprocess_and_return_stdout(bsub_command_line_as_string)
+        _lsf_submit_rate_limiter.acquire()
+        try :
+            (return_code, raw_stdout) = run_subprocess_and_return_code_and_stdout(bsub_command_line_as_string, timeout=_lsf_submit_timeout)
+        except subprocess.TimeoutExpired :
+            raise lsf_submit_timeout_error('The bsub command %s timed out after %g seconds' % (repr(bsub_command_line_as_string), _lsf_submit_timeout))
+        if return_code != 0 :
+            raise lsf_unavailable_error('The bsub command %s returned nonzero return code %d.\nstdout:\n%s\n' % 
+                                        (repr(bsub_command_line_as_string), return_code, raw_stdout))
         stdout = raw_stdout.strip()   # There are leading newlines and other nonsense in the raw version
         raw_tokens = stdout.split()
         is_token_nonempty = [ len(str)>0 for str in raw_tokens ]
@@ -187,18 +534,37 @@ def bsub(command_line_as_list, do_actually_submit=True, slot_count=1, stdouterr_
             raise RuntimeError('There was a problem submitting the bsub command %s.  Unable to parse output to get job id.  Output was: %s' %
                                (repr(bsub_command_line_as_string), stdout) )
     else :
-        # Just call the def locally, but use a try/catch to make it more robust.
-        try :
-            run_subprocess_live(command_line_as_list, check=True)
-            job_id = -1   # represents a job that was run locally and exited cleanly
-        except RuntimeError as e :
-            printf('Encountered an error while running a local bsub job.  Here''s some information about the error:\n') 
-            printf('%s\n' % str(e)) 
-            job_id = -2   # represents a job that was run locally and errored            
+        (job_id, _) = run_job_locally(command_line_as_list)
     return job_id
 
 
 
+def run_job_locally(command_line_as_list, resource_sampling_interval=None) :
+    '''
+    Runs the job here and now, instead of submitting it, and returns (job_id, resource_usage).  The job id is -1 if 
+    the job exited cleanly, -2 if not.  If resource_sampling_interval is given, the resident memory and CPU time of 
+    the job's process tree are sampled from /proc every that many seconds, and resource_usage is a dict with the peak
+    and mean RSS, CPU time, wall time and exit code (see process_tree_sampler_type).  Otherwise it is None.
+    '''
+    resource_usage = None
+    # Just call the def locally, but use a try/catch to make it more robust.
+    try :
+        if resource_sampling_interval is None :
+            run_subprocess_live(command_line_as_list, check=True)
+        else :
+            (return_code, resource_usage) = run_subprocess_live_and_sample_resources(command_line_as_list, resource_sampling_interval)
+            resource_usage['exit_code'] = return_code
+            if return_code != 0 :
+                raise RuntimeError("Running %s returned a non-zero return code: %d" % (str(command_line_as_list), return_code))
+        job_id = -1   # represents a job that was run locally and exited cleanly
+    except (RuntimeError, OSError) as e :
+        printf('Encountered an error while running a local bsub job.  Here''s some information about the error:\n') 
+        printf('%s\n' % str(e)) 
+        job_id = -2   # represents a job that was run locally and errored            
+    return (job_id, resource_usage)
+
+
+
 def update_job_status_from_job_index(old_job_status_from_job_index, job_id_from_job_index) :
     '''
     Calls get_bsub_job_status() on in-progress jobs to generate an updated job_status_from_job_index.
@@ -215,32 +581,997 @@ def update_job_status_from_job_index(old_job_status_from_job_index, job_id_from_
 
 
 
+def seconds_from_lsf_duration_string(duration_string) :
+    # Converts strings like '123 second(s)' or '45' to a number of seconds.  Returns nan for '-' or ''.
+    tokens = duration_string.split()
+    if isempty(tokens) or tokens[0] == '-' :
+        return math.nan
+    try :
+        result = float(tokens[0])
+    except ValueError :
+        result = math.nan
+    return result
+
+
+
+def mb_from_lsf_memory_string(memory_string) :
+    # Converts strings like '123 Mbytes' or '1.5 Gbytes' to megabytes.  Returns nan for '-' or ''.
+    tokens = memory_string.split()
+    if isempty(tokens) or tokens[0] == '-' :
+        return math.nan
+    try :
+        value = float(tokens[0])
+    except ValueError :
+        return math.nan
+    unit = tokens[1].lower() if len(tokens)>1 else 'mbytes'
+    mb_per_unit_from_first_letter = { 'k':1/1024, 'm':1, 'g':1024, 't':1024*1024 }
+    result = value * mb_per_unit_from_first_letter.get(unit[0], 1)
+    return result
+
+
+
+def get_bjobs_records(job_ids, field_names) :
+    '''
+    Runs "bjobs -a -o ..." on the given job ids, in batches, asking for the given output fields.
+    Returns a dict mapping job id to a dict mapping field name to the (string) field value.
+    Jobs that bjobs has forgotten about are simply missing from the result.
+    '''
+    delimiter = '|'
+    format_string = ' '.join(['jobid'] + field_names) + (" delimiter='%s'" % delimiter)
+    job_id_count = len(job_ids)
+    job_id_count_per_call = 10000
+    batch_count = math.ceil(job_id_count / job_id_count_per_call)
+    result = {}
+    for batch_index in range(batch_count) :
+        job_ids_this_batch = job_ids[job_id_count_per_call*batch_index:job_id_count_per_call*(batch_index+1)]
+        command_line = ['bjobs', '-a', '-noheader', '-o', format_string] + [ ('%d' % job_id) for job_id in job_ids_this_batch ]
+        # bjobs returns nonzero if any of the jobs is not found, so ignore the return code, and just parse what we get
+        (status, stdout, stderr) = run_lsf_query(command_line)
+        for line in stdout.split('\n') :
+            tokens = line.split(delimiter)
+            if len(tokens) != len(field_names)+1 :
+                continue   # e.g. 'Job <1234> is not found'
+            try :
+                job_id = int(tokens[0])
+            except ValueError :
+                continue
+            result[job_id] = dict(zip(field_names, [ token.strip() for token in tokens[1:] ]))
+    return result
+
+
+
+def get_bhist_times(job_ids) :
+    '''
+    Runs "bhist -a" on the given job ids, in batches, and returns a dict mapping job id to (pend_time, run_time),
+    in seconds.  Used as a fallback for jobs that bjobs has forgotten about.
+    '''
+    job_id_count = len(job_ids)
+    job_id_count_per_call = 10000
+    batch_count = math.ceil(job_id_count / job_id_count_per_call)
+    result = {}
+    for batch_index in range(batch_count) :
+        job_ids_this_batch = job_ids[job_id_count_per_call*batch_index:job_id_count_per_call*(batch_index+1)]
+        command_line = ['bhist', '-a'] + [ ('%d' % job_id) for job_id in job_ids_this_batch ]
+        (status, stdout, stderr) = run_lsf_query(command_line)
+        # Lines look like: JOBID USER JOB_NAME PEND PSUSP RUN USUSP SSUSP UNKWN TOTAL
+        # The job name may contain spaces, so count from the end.
+        for line in stdout.split('\n') :
+            tokens = line.split()
+            if len(tokens) < 10 :
+                continue
+            try :
+                job_id = int(tokens[0])
+                pend_time = float(tokens[-7])
+                run_time = float(tokens[-5])
+            except ValueError :
+                continue   # e.g. the header, or 'Summary of time in seconds spent in various states:'
+            result[job_id] = (pend_time, run_time)
+    return result
+
+
+
+def get_job_accounting_records(job_ids) :
+    '''
+    Collects resource accounting information for the given (finished) LSF jobs, using a few wide bjobs calls,
+    and falling back to bhist for jobs that bjobs has forgotten.
+    Returns a dict mapping job id to a dict with keys 'exit_code', 'exec_host', 'pend_time', 'run_time', 'cpu_time',
+    and 'max_memory_in_mb'.  Times are in seconds.  Things that can't be determined are nan (or '' for exec_host).
+    '''
+    field_names = ['stat', 'exit_code', 'exec_host', 'pend_time', 'run_time', 'cpu_used', 'max_mem']
+    bjobs_record_from_job_id = get_bjobs_records(job_ids, field_names)
+    forgotten_job_ids = [ job_id for job_id in job_ids if job_id not in bjobs_record_from_job_id ]
+    bhist_times_from_job_id = get_bhist_times(forgotten_job_ids) if isladen(forgotten_job_ids) else {}
+    result = {}
+    for job_id in job_ids :
+        if job_id in bjobs_record_from_job_id :
+            record = bjobs_record_from_job_id[job_id]
+            exit_code_string = record['exit_code']
+            if exit_code_string == '-' or exit_code_string == '' :
+                # bjobs shows '-' for the exit code of jobs that exited cleanly
+                exit_code = 0 if record['stat'] == 'DONE' else math.nan
+            else :
+                try :
+                    exit_code = int(exit_code_string)
+                except ValueError :
+                    exit_code = math.nan
+            exec_host = record['exec_host'] if record['exec_host'] != '-' else ''
+            result[job_id] = { 'exit_code': exit_code,
+                               'exec_host': exec_host,
+                               'pend_time': seconds_from_lsf_duration_string(record['pend_time']),
+                               'run_time': seconds_from_lsf_duration_string(record['run_time']),
+                               'cpu_time': seconds_from_lsf_duration_string(record['cpu_used']),
+                               'max_memory_in_mb': mb_from_lsf_memory_string(record['max_mem']) }
+        else :
+            (pend_time, run_time) = bhist_times_from_job_id.get(job_id, (math.nan, math.nan))
+            result[job_id] = { 'exit_code': math.nan,
+                               'exec_host': '',
+                               'pend_time': pend_time,
+                               'run_time': run_time,
+                               'cpu_time': math.nan,
+                               'max_memory_in_mb': math.nan }
+    return result
+
+
+
+def command_template_from_command_line(command_line_as_list) :
+    # Turns a command line into a string that is the same for all the jobs in a sweep, by replacing each
+    # run of digits with '#'.  E.g. ['process_tile', 'tile-0012.tif'] -> 'process_tile tile-#.tif'.
+    result = re.sub(r'[0-9]+', '#', space_out(command_line_as_list))
+    return result
+
+
+
+class job_results_table_type :
+    '''
+    Columnar table of per-job results: one list per column, all the same length.
+    Times are in seconds, memory in MB.  Reserved memory and walltime are what the job asked LSF for.
+    '''
+    column_names = [ 'job_index', 'job_id', 'command_template', 'status', 'exit_code', 'exec_host', 
+                     'slot_count', 'reserved_memory_in_mb', 'reserved_walltime_in_minutes',
+                     'pend_time', 'run_time', 'cpu_time', 'max_memory_in_mb', 'mean_memory_in_mb' ]
+
+    def __init__(self) :
+        self._column_from_name = {}
+        for column_name in self.column_names :
+            self._column_from_name[column_name] = []
+
+    def row_count(self) :
+        return len(self._column_from_name['job_index'])
+
+    def append_row(self, **value_from_column_name) :
+        # Columns that aren't given get nan
+        for column_name in self.column_names :
+            self._column_from_name[column_name].append(value_from_column_name.get(column_name, math.nan))
+
+    def column(self, column_name) :
+        return self._column_from_name[column_name]
+
+    def write_csv(self, file_name) :
+        with open(file_name, 'w', newline='') as fid :
+            writer = csv.writer(fid)
+            writer.writerow(self.column_names)
+            for row_index in range(self.row_count()) :
+                writer.writerow([ self._column_from_name[column_name][row_index] for column_name in self.column_names ])
+
+    def write_npz(self, file_name) :
+        # Needs numpy, which tpt doesn't otherwise depend on.
+        import numpy
+        array_from_column_name = {}
+        for column_name in self.column_names :
+            column = self._column_from_name[column_name]
+            if column_name == 'command_template' or column_name == 'exec_host' :
+                array_from_column_name[column_name] = numpy.array([ str(el) for el in column ])
+            else :
+                array_from_column_name[column_name] = numpy.array(column, dtype=float)
+        numpy.savez(file_name, **array_from_column_name)
+
+    def summary_by_command_template(self) :
+        '''
+        Returns a dict mapping each command template to a dict of summary statistics for its jobs, including how much of
+        the slot and memory reservation was wasted.  Slot waste is the fraction of reserved slot-seconds (slot_count *
+        run_time) not used as CPU time.  Memory waste is the mean of (reserved memory - max memory used), over jobs
+        where both are known.
+        '''
+        row_indices_from_template = {}
+        for row_index in range(self.row_count()) :
+            template = self._column_from_name['command_template'][row_index]
+            row_indices_from_template.setdefault(template, []).append(row_index)
+        result = {}
+        for (template, row_indices) in row_indices_from_template.items() :
+            def column(column_name) :
+                return ibl(self._column_from_name[column_name], row_indices)
+            slot_seconds = [ slot_count*run_time for (slot_count, run_time) in zip(column('slot_count'), column('run_time')) ]
+            cpu_time = column('cpu_time')
+            is_cpu_known = [ not (math.isnan(slot_second) or math.isnan(cpu)) for (slot_second, cpu) in zip(slot_seconds, cpu_time) ]
+            total_slot_seconds = sum(ibb(slot_seconds, is_cpu_known))
+            total_cpu_time = sum(ibb(cpu_time, is_cpu_known))
+            memory_slack_in_mb = [ (reserved - used) for (reserved, used) in zip(column('reserved_memory_in_mb'), column('max_memory_in_mb'))
+                                   if reserved>0 and not math.isnan(used) ]
+            max_memory_in_mb = [ used for used in column('max_memory_in_mb') if not math.isnan(used) ]
+            run_time = [ t for t in column('run_time') if not math.isnan(t) ]
+            result[template] = { 'job_count': len(row_indices),
+                                 'failed_job_count': sum([ status==-1 for status in column('status') ]),
+                                 'mean_run_time': (sum(run_time)/len(run_time)) if isladen(run_time) else math.nan,
+                                 'peak_memory_in_mb': max(max_memory_in_mb) if isladen(max_memory_in_mb) else math.nan,
+                                 'wasted_slot_fraction': (1 - total_cpu_time/total_slot_seconds) if total_slot_seconds>0 else math.nan,
+                                 'mean_wasted_memory_in_mb': (sum(memory_slack_in_mb)/len(memory_slack_in_mb)) if isladen(memory_slack_in_mb) else math.nan }
+        return result
+
+    def print_summary(self) :
+        summary_from_template = self.summary_by_command_template()
+        for (template, summary) in summary_from_template.items() :
+            print('%s' % template)
+            print('    jobs: %d (%d failed)  mean run time: %.1f s  peak memory: %.1f MB' %
+                  (summary['job_count'], summary['failed_job_count'], summary['mean_run_time'], summary['peak_memory_in_mb']))
+            print('    wasted slot fraction: %.2f  mean wasted memory: %.1f MB' %
+                  (summary['wasted_slot_fraction'], summary['mean_wasted_memory_in_mb']))
+
+
+
+def get_mtime_from_path(paths, thread_count=32) :
+    # Returns a dict mapping each path to its mtime, or nan if it doesn't exist.  The stat() calls are done in 
+    # parallel, since on network filesystems they're latency-bound.
+    def mtime_or_nan(path) :
+        try :
+            return os.stat(path).st_mtime
+        except OSError :
+            return math.nan
+    unique_paths = list(set(paths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor :
+        mtimes = list(executor.map(mtime_or_nan, unique_paths))
+    result = dict(zip(unique_paths, mtimes))
+    return result
+
+
+
+def get_byte_count_from_path(paths, thread_count=32) :
+    # Like get_mtime_from_path(), but returns file sizes
+    def byte_count_or_nan(path) :
+        try :
+            return os.stat(path).st_size
+        except OSError :
+            return math.nan
+    unique_paths = list(set(paths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor :
+        byte_counts = list(executor.map(byte_count_or_nan, unique_paths))
+    result = dict(zip(unique_paths, byte_counts))
+    return result
+
+
+
+def sha256_of_file(path) :
+    # Returns the hex SHA-256 digest of the file's contents, or None if it can't be read
+    digest = hashlib.sha256()
+    try :
+        with open(path, 'rb') as fid :
+            for chunk in iter(lambda : fid.read(1<<20), b'') :
+                digest.update(chunk)
+    except OSError :
+        return None
+    return digest.hexdigest()
+
+
+
+def get_sha256_from_path(paths, file_hash_from_path, thread_count=32) :
+    '''
+    Returns a dict mapping each path to the SHA-256 of its contents (None if it can't be read).  file_hash_from_path
+    is a cache mapping path to [size, mtime, digest]: files whose size and mtime match the cache aren't re-read.
+    The cache is updated in place.  Hashing is done in parallel.
+    '''
+    unique_paths = list(set(paths))
+    def hash_of_path(path) :
+        try :
+            stat_result = os.stat(path)
+        except OSError :
+            return (path, None)
+        cached = file_hash_from_path.get(path)
+        if cached is not None and cached[0] == stat_result.st_size and cached[1] == stat_result.st_mtime :
+            return (path, cached[2])
+        digest = sha256_of_file(path)
+        return (path, digest, stat_result.st_size, stat_result.st_mtime)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor :
+        hash_results = list(executor.map(hash_of_path, unique_paths))
+    result = {}
+    for hash_result in hash_results :
+        result[hash_result[0]] = hash_result[1]
+        if len(hash_result) == 4 and hash_result[1] is not None :
+            file_hash_from_path[hash_result[0]] = [ hash_result[2], hash_result[3], hash_result[1] ]
+    return result
+
+
+
+def load_up_to_date_manifest(file_name) :
+    # Loads the manifest used by 'hash'-mode up-to-date checking, or returns an empty one if the file doesn't exist
+    if os.path.exists(file_name) :
+        with open(file_name, 'r') as fid :
+            result = json.load(fid)
+    else :
+        result = { 'file_hash_from_path': {}, 'input_hashes_from_job_key': {} }
+    return result
+
+
+
+def save_up_to_date_manifest(file_name, manifest) :
+    write_file_atomically(file_name, json.dumps(manifest))
+
+
+
+def record_up_to_date_input_hashes(manifest, job_keys, input_file_names_from_job_index) :
+    # Records the current hashes of each job's inputs in the manifest, as the inputs it last succeeded with
+    sha256_from_path = get_sha256_from_path(flatten(input_file_names_from_job_index), manifest['file_hash_from_path'])
+    for (job_key, input_file_names) in zip(job_keys, input_file_names_from_job_index) :
+        manifest['input_hashes_from_job_key'][job_key] = { path:sha256_from_path[path] for path in input_file_names }
+
+
+
+def determine_which_jobs_are_up_to_date(input_file_names_from_job_index, output_file_names_from_job_index, mode='mtime', manifest=None, job_keys=None) :
+    '''
+    Returns a list of booleans, true for each job whose outputs are up to date.  The files of all the jobs are checked 
+    in one batch, in parallel, and each file is only checked once.  In both modes, all of a job's outputs must exist.
+    In 'mtime' mode, the oldest output must be no older than the newest input.  In 'hash' mode, the inputs must have the 
+    same hashes as recorded in the manifest (under the job's key) when the job last succeeded.
+    '''
+    job_count = len(output_file_names_from_job_index)
+    mtime_from_path = get_mtime_from_path(flatten(output_file_names_from_job_index) + 
+                                          (flatten(input_file_names_from_job_index) if mode == 'mtime' else []))
+    do_outputs_exist_from_job_index = \
+        [ all([ not math.isnan(mtime_from_path[path]) for path in output_file_names ]) for output_file_names in output_file_names_from_job_index ]
+    if mode == 'mtime' :
+        result = [False] * job_count
+        for job_index in range(job_count) :
+            if not do_outputs_exist_from_job_index[job_index] :
+                continue
+            oldest_output_mtime = min([ mtime_from_path[path] for path in output_file_names_from_job_index[job_index] ])
+            input_mtimes = [ mtime_from_path[path] for path in input_file_names_from_job_index[job_index] ]
+            if any(map(math.isnan, input_mtimes)) :
+                continue   # a missing input means we can't vouch for the outputs
+            result[job_index] = all([ (input_mtime <= oldest_output_mtime) for input_mtime in input_mtimes ])
+    elif mode == 'hash' :
+        input_hashes_from_job_key = manifest['input_hashes_from_job_key']
+        has_record_from_job_index = [ (do_outputs_exist and (job_key in input_hashes_from_job_key)) 
+                                      for (do_outputs_exist, job_key) in zip(do_outputs_exist_from_job_index, job_keys) ]
+        # Only hash the inputs of jobs that could possibly be up to date
+        sha256_from_path = get_sha256_from_path(flatten(ibb(input_file_names_from_job_index, has_record_from_job_index)), 
+                                                manifest['file_hash_from_path'])
+        result = [False] * job_count
+        for job_index in where(has_record_from_job_index) :
+            recorded_hash_from_path = input_hashes_from_job_key[job_keys[job_index]]
+            input_file_names = input_file_names_from_job_index[job_index]
+            result[job_index] = ( set(recorded_hash_from_path.keys()) == set(input_file_names) and
+                                  all([ (sha256_from_path[path] is not None and sha256_from_path[path] == recorded_hash_from_path[path]) 
+                                        for path in input_file_names ]) )
+    else :
+        raise RuntimeError('Unknown up-to-date check mode: %s' % mode)
+    return result
+
+
+
+class adaptive_slot_cap_type :
+    '''
+    Additive-increase, multiplicative-decrease (AIMD) control of the number of slots a bqueue_type keeps in use 
+    (running or pending) at once.  Call update() every so often with what the queue's own jobs are doing.  
+
+    The cluster counts as congested if more than target_pending_fraction of the cap is taken up by jobs that have 
+    been pending for more than maximum_time_to_start seconds, or if the median time-to-start of the jobs that started 
+    since the last update is more than maximum_time_to_start.  Then the cap is multiplied by multiplicative_decrease.  
+    Otherwise, if the cap is what's holding back submission, it goes up by additive_increase.  The cap always stays 
+    within [minimum_slot_count, maximum_slot_count].  Each update is recorded in the history, and appended to 
+    log_file_name (as tab-separated values) if that is given.
+    '''
+    def __init__(self, 
+                 minimum_slot_count, 
+                 maximum_slot_count, 
+                 initial_slot_count=None, 
+                 additive_increase=4, 
+                 multiplicative_decrease=0.5, 
+                 target_pending_fraction=0.1, 
+                 maximum_time_to_start=120,
+                 log_file_name=None) :
+        if minimum_slot_count > maximum_slot_count :
+            raise RuntimeError('minimum_slot_count (%g) is more than maximum_slot_count (%g)' % (minimum_slot_count, maximum_slot_count))
+        if initial_slot_count is None :
+            initial_slot_count = min(maximum_slot_count, max(minimum_slot_count, 64))
+        self._minimum_slot_count = minimum_slot_count
+        self._maximum_slot_count = maximum_slot_count
+        self._slot_count = min(maximum_slot_count, max(minimum_slot_count, initial_slot_count))
+        self._additive_increase = additive_increase
+        self._multiplicative_decrease = multiplicative_decrease
+        self._target_pending_fraction = target_pending_fraction
+        self._maximum_time_to_start = maximum_time_to_start
+        self._log_file_name = log_file_name
+        self._history = []
+        if log_file_name is not None :
+            with open(log_file_name, 'w') as fid :
+                fid.write('elapsed_time\tslot_count_cap\tpending_slot_count\tstuck_pending_slot_count\trunning_slot_count\tmedian_time_to_start\n')
+
+    def slot_count(self) :
+        return self._slot_count
+
+    def maximum_time_to_start(self) :
+        return self._maximum_time_to_start
+
+    def history(self) :
+        # List of (elapsed_time, slot_count_cap, pending_slot_count, stuck_pending_slot_count, running_slot_count, median_time_to_start)
+        return self._history
+
+    def update(self, elapsed_time, pending_slot_count, stuck_pending_slot_count, running_slot_count, times_to_start, is_cap_binding) :
+        # Adjusts the cap, given the current state of things, and returns the new cap.
+        # stuck_pending_slot_count counts the slots of jobs that have been pending for more than maximum_time_to_start.
+        # times_to_start are the pending times of jobs that have started since the last update.
+        median_time_to_start = statistics.median(times_to_start) if isladen(times_to_start) else math.nan
+        is_congested = ( stuck_pending_slot_count > self._target_pending_fraction * self._slot_count or 
+                         median_time_to_start > self._maximum_time_to_start )   # nan compares False
+        if is_congested :
+            self._slot_count = max(self._minimum_slot_count, math.floor(self._slot_count * self._multiplicative_decrease))
+        elif is_cap_binding :
+            self._slot_count = min(self._maximum_slot_count, self._slot_count + self._additive_increase)
+        entry = (elapsed_time, self._slot_count, pending_slot_count, stuck_pending_slot_count, running_slot_count, median_time_to_start)
+        self._history.append(entry)
+        if self._log_file_name is not None :
+            with open(self._log_file_name, 'a') as fid :
+                fid.write('\t'.join([ ('%g' % value) for value in entry ]) + '\n')
+        return self._slot_count
+
+
+
 class bqueue_type :    
-    def __init__(self, do_actually_submit=True, maximum_running_slot_count=math.inf) :
+    def __init__(self, 
+                 do_actually_submit=True, 
+                 maximum_running_slot_count=math.inf, 
+                 maximum_running_memory_in_mb=math.inf, 
+                 maximum_running_slot_minutes=math.inf,
+                 do_harvest_results=False,
+                 results_harvest_interval=60,
+                 do_speculate_stragglers=False,
+                 straggler_runtime_factor=3,
+                 minimum_straggler_runtime=60,
+                 minimum_completed_job_count_for_speculation=10,
+                 do_cancel_outstanding_jobs_on_exit=True,
+                 lsf_event_log_file_name=None,
+                 lsf_event_log_offset_file_name=None,
+                 lsf_event_log_bjobs_check_interval=600,
+                 job_log_archive_folder_path=None,
+                 job_log_archive_segment_count=16,
+                 job_id_file_name=None,
+                 pilot_folder_path=None,
+                 maximum_pilot_worker_count=10,
+                 pilot_worker_slot_count=1,
+                 pilot_worker_bsub_options_as_list=[],
+                 pilot_idle_timeout=60,
+                 up_to_date_check_mode=None,
+                 up_to_date_manifest_file_name=None,
+                 do_adapt_running_slot_count=False,
+                 minimum_running_slot_count=1,
+                 initial_running_slot_count=None,
+                 slot_count_adaptation_interval=60,
+                 slot_count_cap_log_file_name=None,
+                 lsf_failure_threshold=3,
+                 lsf_circuit_reset_timeout=30,
+                 maximum_submit_attempt_count=5,
+                 runtime_history_file_name=None,
+                 local_resource_sampling_interval=1.0) :
+        # maximum_running_memory_in_mb caps the total memory reserved by running/pending jobs, and 
+        # maximum_running_slot_minutes caps the total of their slot counts times their run-time limits (-W), i.e. 
+        # how many slot-minutes of the cluster they can tie up at once.  A job that needs more than a whole budget
+        # on its own is rejected by enqueue().
+        # If do_harvest_results is true, run() collects accounting info for finished jobs every 
+        # results_harvest_interval seconds (so bjobs hasn't forgotten them yet), into self.results_table().
+        # If do_speculate_stragglers is true, a job that has been running for more than straggler_runtime_factor 
+        # times the median run time of the jobs finished so far (and more than minimum_straggler_runtime seconds) 
+        # gets a speculative copy, on a different host.  Whichever copy finishes first wins, and the other is killed.
+        # The copy's output goes to <stdouterr_file_name>.speculative, so the loser can't overwrite the winner's log
+        # when it's killed.  If the copy wins, its log stays there; stdouterr_file_name() says where each job's log is.
+        # If do_cancel_outstanding_jobs_on_exit is true, run() kills all outstanding jobs (with a single bkill)
+        # when maximum_wait_time runs out, or if it is interrupted.
+        # If lsf_event_log_file_name is given, run() gets job state changes by tailing that file (an lsb.events or 
+        # lsb.acct file, or a site copy of one) instead of polling bjobs.  Straggler speculation still uses bjobs.
+        # In case a job's final record gets missed, every lsf_event_log_bjobs_check_interval seconds the jobs that were 
+        # submitted more than that long ago, and are still in progress, get checked with bjobs.
+        # If job_log_archive_folder_path is given, each job's stdout+stderr goes into a job_log_archive_type in that 
+        # folder, instead of the job's own stdouterr_file_name.  Use get_job_log() to read them back.
+        # If job_id_file_name is given, run() appends a '<job index>\t<job id>' line to it for each LSF job it submits,
+        # so that other processes can check on or cancel the jobs (see read_job_id_file()).
+        # If pilot_folder_path is given, run() doesn't submit one LSF job per queued job.  Instead it submits up to
+        # maximum_pilot_worker_count long-lived worker jobs, each with pilot_worker_slot_count slots, which pull the 
+        # queued jobs one at a time from a task queue in pilot_folder_path (see pilot_pool_type).  In this mode, the 
+        # per-job slot counts, bsub options and resource budgets are not used.
+        # If up_to_date_check_mode is 'mtime', run() skips jobs whose declared outputs all exist and are no older than
+        # any of their declared inputs.  If it's 'hash', run() skips jobs whose outputs all exist and whose inputs have 
+        # the same content hashes as when the job last succeeded, as recorded in up_to_date_manifest_file_name.
+        # If do_adapt_running_slot_count is true, maximum_running_slot_count is an upper bound rather than a fixed cap.  
+        # The cap actually used starts at initial_running_slot_count, and every slot_count_adaptation_interval seconds it 
+        # is adjusted (within [minimum_running_slot_count, maximum_running_slot_count]) by an adaptive_slot_cap_type, 
+        # based on how long our jobs pend before they start.  So only enough work gets queued to fill the capacity that's
+        # actually available.  The cap history is in slot_count_cap_history(), and in slot_count_cap_log_file_name if 
+        # given.  Like straggler speculation, this uses bjobs even if there's an LSF event log.
+        # If LSF commands time out or fail lsf_failure_threshold times in a row (see set_lsf_command_timeouts()), run()
+        # stops calling LSF for lsf_circuit_reset_timeout seconds (doubling each time it happens again), keeping the last 
+        # known job statuses, instead of giving up on the whole run.  A job that fails to submit 
+        # maximum_submit_attempt_count times is marked as errored out.  So is a job whose bsub times out, without being 
+        # resubmitted, since it may have been submitted anyway.
+        # If runtime_history_file_name is given, the run times of jobs that succeed are recorded there (see 
+        # runtime_history_type), keyed by command template and total input size, and run() uses that history to submit 
+        # the jobs it predicts will take longest first, so the sweep doesn't end with a long tail.  Jobs with no history 
+        # keep enqueue order.  Like straggler speculation, this uses bjobs even if there's an LSF event log.  Not used 
+        # in pilot mode.
+        # If do_actually_submit is false, the resident memory and CPU time of each job's process tree are sampled from 
+        # /proc every local_resource_sampling_interval seconds while it runs (None to turn this off), and the peak and 
+        # mean RSS, CPU time and wall time go into the results table, so that a local dry run can be used to size the
+        # LSF requests.  Locally run jobs are always harvested into the results table, whether or not do_harvest_results 
+        # is true, since that needs no LSF calls.
         self._bsub_option_list_from_job_index = []
         self._command_line_as_list = [] 
         self._slot_count_from_job_index = []
+        self._resources_from_job_index = []
+        self._budgeted_resources_from_job_index = []
         self._job_id_from_job_index = []
         self._has_been_submitted_from_job_index = []
         self._stdouterr_file_name_from_job_index = []
         self._do_actually_submit = do_actually_submit 
         self._maximum_running_slot_count = maximum_running_slot_count 
+        self._maximum_running_memory_in_mb = maximum_running_memory_in_mb
+        self._maximum_running_slot_minutes = maximum_running_slot_minutes
         self._job_status_from_job_index = []
+        self._do_harvest_results = do_harvest_results
+        self._results_harvest_interval = results_harvest_interval
+        self._has_been_harvested_from_job_index = []
+        self._results_table = job_results_table_type()
+        self._do_speculate_stragglers = do_speculate_stragglers
+        self._straggler_runtime_factor = straggler_runtime_factor
+        self._minimum_straggler_runtime = minimum_straggler_runtime
+        self._minimum_completed_job_count_for_speculation = minimum_completed_job_count_for_speculation
+        self._do_cancel_outstanding_jobs_on_exit = do_cancel_outstanding_jobs_on_exit
+        self._speculative_job_id_from_job_index = []
+        self._has_abandoned_speculation_from_job_index = []
+        self._run_start_time_from_job_index = []
+        self._exec_host_from_job_index = []
+        self._did_speculative_copy_win_from_job_index = []
+        self._completed_run_times = []
+        self._submit_time_from_job_index = []
+        self._recent_times_to_start = []
+        if do_adapt_running_slot_count :
+            self._adaptive_slot_cap = adaptive_slot_cap_type(minimum_running_slot_count, 
+                                                             maximum_running_slot_count, 
+                                                             initial_running_slot_count, 
+                                                             log_file_name=slot_count_cap_log_file_name)
+        else :
+            self._adaptive_slot_cap = None
+        self._slot_count_adaptation_interval = slot_count_adaptation_interval
+        self._lsf_circuit_breaker = circuit_breaker_type(lsf_failure_threshold, lsf_circuit_reset_timeout)
+        self._maximum_submit_attempt_count = maximum_submit_attempt_count
+        self._submit_failure_count_from_job_index = []
+        self._runtime_history = runtime_history_type(runtime_history_file_name) if runtime_history_file_name is not None else None
+        self._run_time_from_job_index = []
+        self._has_run_time_been_recorded_from_job_index = []
+        self._submission_rank_from_job_index = None
+        self._local_resource_sampling_interval = local_resource_sampling_interval
+        self._local_resource_usage_from_job_index = []
+        self._job_index_from_job_id = {}
+        if lsf_event_log_file_name is None :
+            self._lsf_event_log_tailer = None
+        else :
+            self._lsf_event_log_tailer = lsf_event_log_tailer_type(lsf_event_log_file_name, lsf_event_log_offset_file_name)
+        self._lsf_event_log_bjobs_check_interval = lsf_event_log_bjobs_check_interval
+        self._last_lsf_event_log_bjobs_check_time = time.time()
+        self._job_id_file_name = job_id_file_name
+        self._input_file_names_from_job_index = []
+        self._output_file_names_from_job_index = []
+        if not (up_to_date_check_mode is None or up_to_date_check_mode == 'mtime' or up_to_date_check_mode == 'hash') :
+            raise RuntimeError('Unknown up_to_date_check_mode: %s' % up_to_date_check_mode)
+        if up_to_date_check_mode == 'hash' and up_to_date_manifest_file_name is None :
+            raise RuntimeError('An up_to_date_manifest_file_name is needed when up_to_date_check_mode is \'hash\'')
+        self._up_to_date_check_mode = up_to_date_check_mode
+        self._up_to_date_manifest_file_name = up_to_date_manifest_file_name
+        self._up_to_date_manifest = load_up_to_date_manifest(up_to_date_manifest_file_name) if up_to_date_check_mode == 'hash' else None
+        if pilot_folder_path is None :
+            self._pilot_pool = None
+        else :
+            self._pilot_pool = pilot_pool_type(pilot_folder_path, 
+                                               do_actually_submit, 
+                                               maximum_pilot_worker_count, 
+                                               pilot_worker_slot_count, 
+                                               pilot_worker_bsub_options_as_list,
+                                               idle_timeout=pilot_idle_timeout)
+        self._job_id_file = None
+        if job_log_archive_folder_path is None :
+            self._job_log_archive = None
+        else :
+            self._job_log_archive = job_log_archive_type(job_log_archive_folder_path, job_log_archive_segment_count)
         
     def queue_length(self) :
         result = len(self._has_been_submitted_from_job_index) 
         return result
     
-    def enqueue(self, slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list) :
+    def enqueue(self, slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list, memory_in_mb=None, walltime_in_minutes=None,
+                input_file_names=None, output_file_names=None) :
+        # If memory_in_mb or walltime_in_minutes are given, the matching -R rusage[mem=...] and -W options get added
+        # to the bsub options.  Otherwise they are read from bsub_options_as_list, if present there.
+        # If output_file_names is given (and the queue has an up_to_date_check_mode), run() skips the job when its 
+        # outputs are up to date with respect to input_file_names.
+        (resources, bsub_options_as_list) = resolve_job_resources(slot_count, bsub_options_as_list, memory_in_mb, walltime_in_minutes)
+        if self._pilot_pool is None :
+            # The adaptive slot cap can grow as far as maximum_running_slot_count, so check against that
+            check_job_fits_in_budget(budgeted_resources(resources), 
+                                     (self._maximum_running_slot_count, self._maximum_running_memory_in_mb, self._maximum_running_slot_minutes))
         job_index = self.queue_length() + 1
         self._command_line_as_list.append(command_line_as_list)
         self._job_id_from_job_index.append(math.nan)
         self._has_been_submitted_from_job_index.append(False)            
         self._slot_count_from_job_index.append(slot_count)
+        self._resources_from_job_index.append(resources)
+        self._budgeted_resources_from_job_index.append(budgeted_resources(resources))
         self._stdouterr_file_name_from_job_index.append(stdouterr_file_name)
         self._bsub_option_list_from_job_index.append(bsub_options_as_list)
         self._job_status_from_job_index.append(math.nan)
+        self._has_been_harvested_from_job_index.append(False)
+        self._speculative_job_id_from_job_index.append(math.nan)
+        self._has_abandoned_speculation_from_job_index.append(False)
+        self._run_start_time_from_job_index.append(math.nan)
+        self._submit_time_from_job_index.append(math.nan)
+        self._submit_failure_count_from_job_index.append(0)
+        self._run_time_from_job_index.append(math.nan)
+        self._has_run_time_been_recorded_from_job_index.append(False)
+        self._local_resource_usage_from_job_index.append(None)
+        self._exec_host_from_job_index.append('')
+        self._did_speculative_copy_win_from_job_index.append(False)
+        self._input_file_names_from_job_index.append(input_file_names if input_file_names is not None else [])
+        self._output_file_names_from_job_index.append(output_file_names if output_file_names is not None else [])
     
+    def enqueue_file_groups(self, path_groups, slot_count, stdouterr_file_name_from_group_index, bsub_options_as_list, command_line_from_paths,
+                            memory_in_mb=None, walltime_in_minutes=None) :
+        '''
+        Enqueues one job per group of files, e.g. as returned by partition_by_byte_count() (after mapping indices to 
+        paths).  command_line_from_paths(group_index, paths) should return the command line for the job that handles 
+        the given paths.  stdouterr_file_name_from_group_index can be None, to send all the output to /dev/null.
+        Each group's paths are declared as the inputs of its job.
+        '''
+        group_count = len(path_groups)
+        for group_index in range(group_count) :
+            paths = path_groups[group_index]
+            stdouterr_file_name = stdouterr_file_name_from_group_index[group_index] if stdouterr_file_name_from_group_index is not None else ''
+            self.enqueue(slot_count, 
+                         stdouterr_file_name, 
+                         bsub_options_as_list, 
+                         command_line_from_paths(group_index, paths), 
+                         memory_in_mb, 
+                         walltime_in_minutes,
+                         input_file_names=paths)
+
+    def _mark_up_to_date_jobs(self) :
+        '''
+        Marks each not-yet-submitted job whose declared outputs are up to date as having succeeded (status +1, job id
+        -3), without submitting it.  Returns the number of jobs marked.
+        '''
+        if self._up_to_date_check_mode is None :
+            return 0
+        job_count = self.queue_length()
+        job_index_from_candidate_index = \
+            [ job_index for job_index in range(job_count) 
+              if math.isnan(self._job_status_from_job_index[job_index]) and isladen(self._output_file_names_from_job_index[job_index]) ]
+        is_up_to_date_from_candidate_index = \
+            determine_which_jobs_are_up_to_date(ibl(self._input_file_names_from_job_index, job_index_from_candidate_index),
+                                                ibl(self._output_file_names_from_job_index, job_index_from_candidate_index),
+                                                self._up_to_date_check_mode,
+                                                self._up_to_date_manifest,
+                                                [ self._up_to_date_job_key(job_index) for job_index in job_index_from_candidate_index ])
+        job_indices_to_skip = ibb(job_index_from_candidate_index, is_up_to_date_from_candidate_index)
+        for job_index in job_indices_to_skip :
+            self._job_id_from_job_index[job_index] = -3   # means skipped because up to date
+            self._job_status_from_job_index[job_index] = +1
+        return len(job_indices_to_skip)
+
+    def _up_to_date_job_key(self, job_index) :
+        # Identifies a job in the up-to-date manifest
+        return json.dumps([ self._command_line_as_list[job_index], sorted(self._output_file_names_from_job_index[job_index]) ])
+
+    def _record_up_to_date_manifest(self) :
+        # In 'hash' mode, records the input hashes of jobs that ran and succeeded, and saves the manifest
+        if self._up_to_date_check_mode != 'hash' :
+            return
+        job_count = self.queue_length()
+        job_indices_to_record = \
+            [ job_index for job_index in range(job_count) 
+              if (self._job_status_from_job_index[job_index]==+1 and self._job_id_from_job_index[job_index]!=-3 and 
+                  isladen(self._output_file_names_from_job_index[job_index])) ]
+        record_up_to_date_input_hashes(self._up_to_date_manifest, 
+                                       [ self._up_to_date_job_key(job_index) for job_index in job_indices_to_record ],
+                                       ibl(self._input_file_names_from_job_index, job_indices_to_record))
+        save_up_to_date_manifest(self._up_to_date_manifest_file_name, self._up_to_date_manifest)
+
+    def get_job_log(self, job_index) :
+        # Returns the stdout+stderr of the given job from the job log archive, or None if there isn't one (yet)
+        if self._job_log_archive is None :
+            raise RuntimeError('This queue was not set up with a job log archive')
+        return self._job_log_archive.get_job_log(job_index)
+
+    def stdouterr_file_name(self, job_index) :
+        # Returns the name of the file holding the given job's stdout+stderr, which is the speculative copy's log if
+        # the copy won.  Returns '' if the output went to /dev/null, or to the job log archive.
+        (_, result) = self._command_line_and_stdouterr_file_name(job_index, self._did_speculative_copy_win_from_job_index[job_index])
+        return result if result != '/dev/null' else ''
+
+    def _command_line_and_stdouterr_file_name(self, job_index, is_speculative=False) :
+        # The command line to run for the given job, and where its output goes, taking the job log archive into account.
+        # A speculative copy gets a log file of its own.
+        command_line_as_list = self._command_line_as_list[job_index]
+        stdouterr_file_name = self._stdouterr_file_name_from_job_index[job_index]
+        if is_speculative and isladen(stdouterr_file_name) and stdouterr_file_name != '/dev/null' :
+            stdouterr_file_name = stdouterr_file_name + '.speculative'
+        if self._job_log_archive is not None :
+            command_line_as_list = self._job_log_archive.wrapped_command_line(job_index, command_line_as_list)
+            stdouterr_file_name = '/dev/null'
+        return (command_line_as_list, stdouterr_file_name)
+
+    def _submit_job(self, job_index, extra_bsub_options_as_list=[], is_speculative=False) :
+        # Calls bsub() on the given job, routing its output to the job log archive if there is one.  Returns the job id.
+        (command_line_as_list, stdouterr_file_name) = self._command_line_and_stdouterr_file_name(job_index, is_speculative)
+        if not self._do_actually_submit :
+            (job_id, self._local_resource_usage_from_job_index[job_index]) = \
+                run_job_locally(command_line_as_list, self._local_resource_sampling_interval)
+            return job_id
+        job_id = \
+            bsub(command_line_as_list, 
+                 self._do_actually_submit,
+                 self._slot_count_from_job_index[job_index],
+                 stdouterr_file_name,
+                 self._bsub_option_list_from_job_index[job_index] + extra_bsub_options_as_list) 
+        if self._job_id_file is not None and job_id > 0 :
+            self._job_id_file.write('%d\t%d\n' % (job_index, job_id))
+        return job_id
+
+    def cancel_outstanding_jobs(self) :
+        '''
+        Kills all the jobs (and speculative copies) that have been submitted but haven't exited, with as few bkill 
+        calls as possible.  Their status is set to -1.
+        '''
+        job_count = self.queue_length()
+        is_outstanding_from_job_index = \
+            [ (self._job_id_from_job_index[job_index] > 0 and 
+               not (self._job_status_from_job_index[job_index]==-1 or self._job_status_from_job_index[job_index]==+1))
+              for job_index in range(job_count) ]
+        job_index_from_outstanding_index = where(is_outstanding_from_job_index)
+        job_ids_to_kill = ibl(self._job_id_from_job_index, job_index_from_outstanding_index) + \
+                          [ self._speculative_job_id_from_job_index[job_index] for job_index in job_index_from_outstanding_index 
+                            if not math.isnan(self._speculative_job_id_from_job_index[job_index]) ]
+        bkill(job_ids_to_kill)
+        for job_index in job_index_from_outstanding_index :
+            self._job_status_from_job_index[job_index] = -1
+
+    def _update_job_statuses_from_event_log(self, old_job_status_from_job_index) :
+        # Like update_job_status_from_job_index(), but gets the new statuses from the LSF event log instead of bjobs.
+        # Does not mutate old_job_status_from_job_index.
+        job_status_from_job_index = list(old_job_status_from_job_index)
+        for (job_id, job_status_code, _) in self._lsf_event_log_tailer.read_new_transitions() :
+            job_index = self._job_index_from_job_id.get(job_id)
+            if (job_index is not None) and job_status_from_job_index[job_index]==0 :
+                job_status_from_job_index[job_index] = job_status_code
+        # A job whose final record was missed (e.g. because the log rotated twice between reads) would otherwise stay
+        # in progress forever, so every so often check on the long-running ones with bjobs
+        now = time.time()
+        if now - self._last_lsf_event_log_bjobs_check_time > self._lsf_event_log_bjobs_check_interval :
+            self._last_lsf_event_log_bjobs_check_time = now
+            job_index_from_overdue_index = \
+                [ job_index for job_index in range(len(job_status_from_job_index)) 
+                  if (job_status_from_job_index[job_index]==0 and 
+                      now - self._submit_time_from_job_index[job_index] > self._lsf_event_log_bjobs_check_interval) ]
+            if isladen(job_index_from_overdue_index) :
+                try :
+                    job_status_from_overdue_index = get_bsub_job_status(ibl(self._job_id_from_job_index, job_index_from_overdue_index))
+                except lsf_unavailable_error :
+                    # Keep the transitions already read from the log, which can't be read again
+                    self._lsf_circuit_breaker.record_failure()
+                else :
+                    self._lsf_circuit_breaker.record_success()
+                    for (job_index, job_status) in zip(job_index_from_overdue_index, job_status_from_overdue_index) :
+                        job_status_from_job_index[job_index] = job_status
+        return job_status_from_job_index
+
+    def _update_job_statuses_tracking_run_times(self, old_job_status_from_job_index) :
+        '''
+        Like update_job_status_from_job_index(), but also keeps track of when and where each job started running,
+        and settles races between jobs and their speculative copies.  Returns (job_status_from_job_index, 
+        job_ids_to_kill), where job_ids_to_kill are the losing copies of jobs that one copy has finished.
+        Does not mutate old_job_status_from_job_index.
+        '''
+        job_status_from_job_index = list(old_job_status_from_job_index)
+        job_index_from_in_progress_index = where([ job_status==0 for job_status in old_job_status_from_job_index ])
+        primary_job_ids = ibl(self._job_id_from_job_index, job_index_from_in_progress_index)
+        speculative_job_ids = [ self._speculative_job_id_from_job_index[job_index] for job_index in job_index_from_in_progress_index
+                                if not math.isnan(self._speculative_job_id_from_job_index[job_index]) ]
+        polled_job_ids = primary_job_ids + speculative_job_ids
+        (lsf_stat_from_polled_index, exec_host_from_polled_index) = get_lsf_stat_and_exec_host(polled_job_ids)
+        lsf_stat_from_job_id = dict(zip(polled_job_ids, lsf_stat_from_polled_index))
+        exec_host_from_job_id = dict(zip(polled_job_ids, exec_host_from_polled_index))
+        now = time.time()
+        job_ids_to_kill = []
+        for job_index in job_index_from_in_progress_index :
+            job_id = self._job_id_from_job_index[job_index]
+            speculative_job_id = self._speculative_job_id_from_job_index[job_index]
+            lsf_stat = lsf_stat_from_job_id[job_id]
+            if lsf_stat == 'RUN' and math.isnan(self._run_start_time_from_job_index[job_index]) :
+                self._run_start_time_from_job_index[job_index] = now
+                if not math.isnan(self._submit_time_from_job_index[job_index]) :
+                    self._recent_times_to_start.append(now - self._submit_time_from_job_index[job_index])
+                self._exec_host_from_job_index[job_index] = exec_host_from_job_id[job_id]
+            job_status = job_status_code_from_lsf_stat(lsf_stat)
+            if math.isnan(speculative_job_id) :
+                new_job_status = job_status
+                if job_status == +1 and not math.isnan(self._run_start_time_from_job_index[job_index]) :
+                    self._completed_run_times.append(now - self._run_start_time_from_job_index[job_index])
+                    self._run_time_from_job_index[job_index] = now - self._run_start_time_from_job_index[job_index]
+            else :
+                speculative_job_status = job_status_code_from_lsf_stat(lsf_stat_from_job_id[speculative_job_id])
+                if job_status == +1 :
+                    new_job_status = +1
+                    job_ids_to_kill.append(speculative_job_id)
+                elif speculative_job_status == +1 :
+                    # The copy won, so from now on it's the job of record
+                    new_job_status = +1
+                    job_ids_to_kill.append(job_id)
+                    self._job_id_from_job_index[job_index] = speculative_job_id
+                    self._speculative_job_id_from_job_index[job_index] = job_id
+                    self._did_speculative_copy_win_from_job_index[job_index] = True
+                elif job_status == -1 and speculative_job_status == -1 :
+                    new_job_status = -1
+                else :
+                    # At least one copy is still going
+                    new_job_status = 0
+            job_status_from_job_index[job_index] = new_job_status
+        return (job_status_from_job_index, job_ids_to_kill)
+
+    def _submit_speculative_copies(self, job_status_from_job_index, maximum_new_resources) :
+        '''
+        Submits a speculative copy of each straggler, as far as maximum_new_resources allows.  Each copy is kept off 
+        the host that the original is running on.  Returns the resources used by the new copies.
+        '''
+        if len(self._completed_run_times) < self._minimum_completed_job_count_for_speculation :
+            return [0, 0, 0]
+        straggler_run_time = max(self._straggler_runtime_factor * statistics.median(self._completed_run_times), 
+                                 self._minimum_straggler_runtime)
+        now = time.time()
+        job_count = self.queue_length()
+        job_index_from_straggler_index = \
+            [ job_index for job_index in range(job_count) 
+              if (job_status_from_job_index[job_index]==0 and
+                  math.isnan(self._speculative_job_id_from_job_index[job_index]) and
+                  not self._has_abandoned_speculation_from_job_index[job_index] and
+                  now - self._run_start_time_from_job_index[job_index] > straggler_run_time) ]   # nan start time compares False
+        resources_from_straggler_index = ibl(self._budgeted_resources_from_job_index, job_index_from_straggler_index)
+        will_submit_from_straggler_index = determine_which_jobs_to_submit_given_resources(resources_from_straggler_index, maximum_new_resources)
+        job_indices_to_copy = ibb(job_index_from_straggler_index, will_submit_from_straggler_index)
+        for job_index in job_indices_to_copy :
+            exec_host = self._exec_host_from_job_index[job_index]
+            avoid_host_options_as_list = [ '-R', 'select[hname!=%s]' % exec_host ] if isladen(exec_host) else []
+            try :
+                self._speculative_job_id_from_job_index[job_index] = self._submit_job(job_index, avoid_host_options_as_list, is_speculative=True)
+            except lsf_submit_timeout_error :
+                # The copy may be in LSF after all, so don't try again for this job
+                self._has_abandoned_speculation_from_job_index[job_index] = True
+                raise
+        result = sum_of_resources(ibl(self._budgeted_resources_from_job_index, job_indices_to_copy))
+        return result
+
+    def slot_count_cap_history(self) :
+        '''
+        Returns the history of the adaptive slot count cap, as a list of (elapsed_time, slot_count_cap, pending_slot_count, 
+        stuck_pending_slot_count, running_slot_count, median_time_to_start) tuples, one per adjustment.  Empty unless
+        do_adapt_running_slot_count is true.
+        '''
+        result = self._adaptive_slot_cap.history() if self._adaptive_slot_cap is not None else []
+        return result
+
+    def _running_slot_count_cap(self) :
+        result = self._adaptive_slot_cap.slot_count() if self._adaptive_slot_cap is not None else self._maximum_running_slot_count
+        return result
+
+    def _adapt_running_slot_count(self, elapsed_time, job_status_from_job_index, is_cap_binding) :
+        # Feeds the current pending/running picture to the adaptive slot cap
+        now = time.time()
+        maximum_time_to_start = self._adaptive_slot_cap.maximum_time_to_start()
+        pending_slot_count = 0
+        stuck_pending_slot_count = 0
+        running_slot_count = 0
+        for job_index in where([ job_status==0 for job_status in job_status_from_job_index ]) :
+            slot_count = self._slot_count_from_job_index[job_index]
+            if math.isnan(self._run_start_time_from_job_index[job_index]) :
+                pending_slot_count += slot_count
+                if now - self._submit_time_from_job_index[job_index] > maximum_time_to_start :
+                    stuck_pending_slot_count += slot_count
+            else :
+                running_slot_count += slot_count
+        self._adaptive_slot_cap.update(elapsed_time, pending_slot_count, stuck_pending_slot_count, running_slot_count, 
+                                       self._recent_times_to_start, is_cap_binding)
+        self._recent_times_to_start = []
+
+    def _input_byte_count_from_job_index(self) :
+        # Total size of each job's declared inputs, or nan if it has none, or any are missing
+        byte_count_from_path = get_byte_count_from_path(flatten(self._input_file_names_from_job_index))
+        result = [ (sum([ byte_count_from_path[path] for path in input_file_names ]) if isladen(input_file_names) else math.nan)
+                   for input_file_names in self._input_file_names_from_job_index ]
+        return result
+
+    def _determine_submission_rank_from_job_index(self, input_byte_count_from_job_index) :
+        # Returns each job's place in the submission order, longest-predicted-first
+        predicted_run_time_from_job_index = \
+            [ self._runtime_history.predict_run_time(command_template_from_command_line(command_line_as_list), input_byte_count) 
+              for (command_line_as_list, input_byte_count) in zip(self._command_line_as_list, input_byte_count_from_job_index) ]
+        job_index_from_rank = longest_predicted_first_order(predicted_run_time_from_job_index)
+        result = [None] * len(job_index_from_rank)
+        for (rank, job_index) in enumerate(job_index_from_rank) :
+            result[job_index] = rank
+        return result
+
+    def _record_runtime_history(self, input_byte_count_from_job_index) :
+        # Adds the run times of the jobs that have succeeded since the last call to the runtime history, and saves it
+        for job_index in range(self.queue_length()) :
+            if ( self._job_status_from_job_index[job_index] == +1 and not math.isnan(self._run_time_from_job_index[job_index]) and 
+                 not self._has_run_time_been_recorded_from_job_index[job_index] ) :
+                self._runtime_history.record_run_time(command_template_from_command_line(self._command_line_as_list[job_index]), 
+                                                      input_byte_count_from_job_index[job_index], 
+                                                      self._run_time_from_job_index[job_index])
+                self._has_run_time_been_recorded_from_job_index[job_index] = True
+        self._runtime_history.save()
+
+    def lsf_health_metrics(self) :
+        # Returns a dict with the state of the LSF circuit breaker, the number of LSF failures seen, and the number of times run() has backed off
+        return self._lsf_circuit_breaker.metrics()
+
+    def _note_submit_failure(self, job_index, e, job_status_from_job_index) :
+        # Called when bsub fails for a job.  Gives up on the job if it has failed to submit too many times, or if bsub
+        # timed out, since then the job may be in LSF after all, and submitting it again could run it twice.
+        self._lsf_circuit_breaker.record_failure()
+        self._submit_failure_count_from_job_index[job_index] += 1
+        if isinstance(e, lsf_submit_timeout_error) :
+            printfe('Giving up on job %d, because bsub timed out.  It may have been submitted anyway, in which case it is not '
+                    'being tracked, and will not be killed by cancel_outstanding_jobs().  The error was:\n%s\n' % (job_index, str(e)))
+            job_status_from_job_index[job_index] = -1
+        elif self._submit_failure_count_from_job_index[job_index] >= self._maximum_submit_attempt_count :
+            printfe('Giving up on job %d after %d failed attempts to submit it.  The last error was:\n%s\n' % 
+                    (job_index, self._submit_failure_count_from_job_index[job_index], str(e)))
+            job_status_from_job_index[job_index] = -1
+
+    def results_table(self) :
+        return self._results_table
+
+    def harvest_results(self) :
+        '''
+        Adds a row to self.results_table() for each job that has exited since the last call, using a few wide bjobs
+        calls to get the accounting info for all of them at once.
+        '''
+        job_count = self.queue_length()
+        is_harvestable_from_job_index = \
+            [ (not self._has_been_harvested_from_job_index[job_index] and 
+               (self._job_status_from_job_index[job_index]==-1 or self._job_status_from_job_index[job_index]==+1))
+              for job_index in range(job_count) ]
+        job_index_from_harvestable_index = where(is_harvestable_from_job_index)
+        if isempty(job_index_from_harvestable_index) :
+            return
+        lsf_job_ids = [ self._job_id_from_job_index[job_index] for job_index in job_index_from_harvestable_index
+                        if self._job_id_from_job_index[job_index] > 0 ]
+        record_from_job_id = get_job_accounting_records(lsf_job_ids) if isladen(lsf_job_ids) else {}
+        for job_index in job_index_from_harvestable_index :
+            job_id = self._job_id_from_job_index[job_index]
+            (slot_count, memory_in_mb, walltime_in_minutes) = self._resources_from_job_index[job_index]
+            record = record_from_job_id.get(job_id, {})
+            resource_usage = self._local_resource_usage_from_job_index[job_index]
+            if resource_usage is not None :
+                record = { 'exit_code': resource_usage['exit_code'],
+                           'run_time': resource_usage['wall_time'],
+                           'cpu_time': resource_usage['cpu_time'],
+                           'max_memory_in_mb': resource_usage['peak_rss_in_mb'],
+                           'mean_memory_in_mb': resource_usage['mean_rss_in_mb'] }
+            if not math.isnan(record.get('run_time', math.nan)) :
+                self._run_time_from_job_index[job_index] = record['run_time']
+            self._results_table.append_row(job_index=job_index, 
+                                           job_id=job_id, 
+                                           command_template=command_template_from_command_line(self._command_line_as_list[job_index]), 
+                                           status=self._job_status_from_job_index[job_index], 
+                                           slot_count=slot_count, 
+                                           reserved_memory_in_mb=memory_in_mb, 
+                                           reserved_walltime_in_minutes=walltime_in_minutes, 
+                                           **record)
+            self._has_been_harvested_from_job_index[job_index] = True
+
     def run(self, maximum_wait_time=math.inf, do_show_progress_bar=True) :
         # Possible job_statuses are {-1,0,+1,math.nan}.
         #   -1 means errored out
@@ -248,39 +1579,169 @@ class bqueue_type :
         #   +1 means completed successfully
         #   math.nan means not yet submitted
         
+        job_count = self.queue_length() 
+        skipped_job_count = self._mark_up_to_date_jobs()
+        job_status_from_job_index = self._job_status_from_job_index
+        progress_bar = progress_bar_object(job_count) if do_show_progress_bar else None
+        if progress_bar is not None :
+            progress_bar.update(skipped_job_count)
+        if self._job_id_file_name is not None :
+            self._job_id_file = open(self._job_id_file_name, 'a', buffering=1)   # line-buffered, so readers see each job id promptly
+        if self._runtime_history is not None :
+            input_byte_count_from_job_index = self._input_byte_count_from_job_index()
+            self._submission_rank_from_job_index = self._determine_submission_rank_from_job_index(input_byte_count_from_job_index)
+        try :
+            if self._pilot_pool is None :
+                (job_status_from_job_index, have_all_exited, is_time_up) = \
+                    self._run_loop(job_status_from_job_index, maximum_wait_time, progress_bar)
+            else :
+                (job_status_from_job_index, have_all_exited, is_time_up) = \
+                    self._run_pilot_loop(job_status_from_job_index, maximum_wait_time, progress_bar)
+        except KeyboardInterrupt :
+            if self._pilot_pool is not None :
+                self._pilot_pool.shut_down(do_kill_workers=self._do_cancel_outstanding_jobs_on_exit)
+            if self._do_cancel_outstanding_jobs_on_exit :
+                self.cancel_outstanding_jobs()
+            raise
+        finally :
+            if self._job_id_file is not None :
+                self._job_id_file.close()
+                self._job_id_file = None
+            if self._runtime_history is not None and sys.exc_info()[0] is not None :
+                # The run is being cut short (e.g. by Ctrl-C), so record the run times we have now, rather than below
+                self._record_runtime_history(input_byte_count_from_job_index)
+        if is_time_up and not have_all_exited and self._do_cancel_outstanding_jobs_on_exit :
+            self.cancel_outstanding_jobs()
+            job_status_from_job_index = self._job_status_from_job_index
+        if self._do_harvest_results or not self._do_actually_submit :
+            # Harvesting locally run jobs needs no LSF calls, so always do that
+            try :
+                self.harvest_results()
+            except lsf_unavailable_error as e :
+                printfe('Unable to harvest job results, because LSF is having problems.  Call harvest_results() to try again.\n%s\n' % str(e))
+        self._record_up_to_date_manifest()
+        if self._runtime_history is not None :
+            self._record_runtime_history(input_byte_count_from_job_index)
+        return job_status_from_job_index
+
+    def _run_pilot_loop(self, job_status_from_job_index, maximum_wait_time, progress_bar) :
+        # Like _run_loop(), but hands the jobs to a pool of pilot workers.  Returns (job_status_from_job_index, have_all_exited, is_time_up).
+        job_status_from_job_index = list(job_status_from_job_index)
+        job_count = self.queue_length()
+        for job_index in range(job_count) :
+            if math.isnan(job_status_from_job_index[job_index]) :
+                (command_line_as_list, stdouterr_file_name) = self._command_line_and_stdouterr_file_name(job_index)
+                self._pilot_pool.add_task(job_index, command_line_as_list, stdouterr_file_name)
+                job_status_from_job_index[job_index] = 0
+        is_time_up = False
+        ticId = tic()
+        exited_job_count = sum([ (job_status==-1 or job_status==+1) for job_status in job_status_from_job_index ])
+        have_all_exited = (exited_job_count==job_count)
+        while not have_all_exited and not is_time_up :
+            new_results = self._pilot_pool.get_new_results()
+            for (job_index, exit_code) in new_results :
+                job_status_from_job_index[job_index] = +1 if exit_code==0 else -1
+            exited_job_count = exited_job_count + len(new_results)
+            if progress_bar is not None :
+                progress_bar.update(len(new_results))
+            have_all_exited = (exited_job_count==job_count)
+            self._job_status_from_job_index = job_status_from_job_index
+            if not have_all_exited :
+                # Scaling calls bjobs and bsub, so it goes behind the circuit breaker, like the LSF calls in _run_loop()
+                if (not self._do_actually_submit) or self._lsf_circuit_breaker.is_call_allowed() :
+                    will_call_lsf = self._do_actually_submit and self._pilot_pool.worker_count() > 0
+                    try :
+                        started_worker_count = self._pilot_pool.scale(job_count - exited_job_count)
+                        if will_call_lsf or (self._do_actually_submit and started_worker_count > 0) :
+                            self._lsf_circuit_breaker.record_success()
+                    except lsf_unavailable_error :
+                        self._lsf_circuit_breaker.record_failure()
+                time.sleep(1)
+                is_time_up = (toc(ticId) > maximum_wait_time)
+        self._pilot_pool.shut_down(do_kill_workers=(is_time_up and self._do_cancel_outstanding_jobs_on_exit))
+        return (job_status_from_job_index, have_all_exited, is_time_up)
+
+    def _run_loop(self, job_status_from_job_index, maximum_wait_time, progress_bar) :
+        # The guts of run().  Returns (job_status_from_job_index, have_all_exited, is_time_up).
+        # progress_bar is None if no progress bar is to be shown.
         have_all_exited = False 
         is_time_up = False 
         job_count = self.queue_length() 
-        job_status_from_job_index = self._job_status_from_job_index
-        if do_show_progress_bar :
-            progress_bar = progress_bar_object(job_count) 
         ticId = tic() 
+        last_harvest_tic_id = tic()
+        last_adaptation_tic_id = tic()
+        do_adapt_running_slot_count = (self._adaptive_slot_cap is not None) and self._do_actually_submit
+        do_track_run_times = self._do_speculate_stragglers or do_adapt_running_slot_count or (self._runtime_history is not None)
         while not have_all_exited and not is_time_up :
             old_job_status_from_job_index = job_status_from_job_index
-            job_status_from_job_index = update_job_status_from_job_index(old_job_status_from_job_index, self._job_id_from_job_index)
+            # While LSF is unhealthy, don't call it at all, and carry on with the last known statuses
+            is_lsf_healthy = (not self._do_actually_submit) or self._lsf_circuit_breaker.is_call_allowed()
+            # Whether the status update below will actually call bjobs (it doesn't if there's nothing in progress)
+            will_poll_lsf = ( self._do_actually_submit and (do_track_run_times or self._lsf_event_log_tailer is None) and 
+                              any([ job_status==0 for job_status in old_job_status_from_job_index ]) )
+            try :
+                if not is_lsf_healthy :
+                    job_status_from_job_index = list(old_job_status_from_job_index)
+                elif do_track_run_times and self._do_actually_submit :
+                    (job_status_from_job_index, job_ids_to_kill) = self._update_job_statuses_tracking_run_times(old_job_status_from_job_index)
+                    bkill(job_ids_to_kill)
+                elif self._lsf_event_log_tailer is not None :
+                    job_status_from_job_index = self._update_job_statuses_from_event_log(old_job_status_from_job_index)
+                else :
+                    job_status_from_job_index = update_job_status_from_job_index(old_job_status_from_job_index, self._job_id_from_job_index)
+                if is_lsf_healthy and will_poll_lsf :
+                    self._lsf_circuit_breaker.record_success()
+            except lsf_unavailable_error :
+                self._lsf_circuit_breaker.record_failure()
+                is_lsf_healthy = False
+                job_status_from_job_index = list(old_job_status_from_job_index)
+            # Share the list, so that if the run is interrupted while submitting, run() still sees the jobs that 
+            # finished this time round (which matters for local jobs, which finish as they're 'submitted')
+            self._job_status_from_job_index = job_status_from_job_index
             is_in_progress_from_job_index = [ job_status==0 for job_status in job_status_from_job_index ]
-            carryover_slot_count = sum(ibb(self._slot_count_from_job_index, is_in_progress_from_job_index)) 
-            maximum_new_slot_count = self._maximum_running_slot_count - carryover_slot_count 
-            if maximum_new_slot_count > 0 :
+            has_speculative_copy_in_progress_from_job_index = \
+                [ (is_in_progress and not math.isnan(speculative_job_id)) 
+                  for (is_in_progress, speculative_job_id) in zip(is_in_progress_from_job_index, self._speculative_job_id_from_job_index) ]
+            carryover_resources = sum_of_resources(ibb(self._budgeted_resources_from_job_index, is_in_progress_from_job_index) +
+                                                   ibb(self._budgeted_resources_from_job_index, has_speculative_copy_in_progress_from_job_index))
+            maximum_resources = (self._running_slot_count_cap(), self._maximum_running_memory_in_mb, self._maximum_running_slot_minutes)
+            maximum_new_resources = [ (maximum - carryover) for (maximum, carryover) in zip(maximum_resources, carryover_resources) ]
+            if is_lsf_healthy and self._do_speculate_stragglers and self._do_actually_submit and all([ (maximum_new > 0) for maximum_new in maximum_new_resources ]) :
+                try :
+                    speculative_resources = self._submit_speculative_copies(job_status_from_job_index, maximum_new_resources)
+                    maximum_new_resources = [ (maximum_new - speculative) for (maximum_new, speculative) in zip(maximum_new_resources, speculative_resources) ]
+                except lsf_unavailable_error :
+                    self._lsf_circuit_breaker.record_failure()
+                    is_lsf_healthy = False
+            is_cap_binding = False
+            if is_lsf_healthy and all([ (maximum_new > 0) for maximum_new in maximum_new_resources ]) :
                 is_submittable_from_job_index = [ math.isnan(job_status) for job_status in job_status_from_job_index ]
                 job_index_from_submittable_index = where(is_submittable_from_job_index) 
-                slot_count_from_submittable_index = ibl(self._slot_count_from_job_index, job_index_from_submittable_index)
-                will_submit_from_submittable_index = determine_which_jobs_to_submit(slot_count_from_submittable_index, maximum_new_slot_count) 
+                if self._runtime_history is not None :
+                    job_index_from_submittable_index.sort(key=self._submission_rank_from_job_index.__getitem__)
+                resources_from_submittable_index = ibl(self._budgeted_resources_from_job_index, job_index_from_submittable_index)
+                will_submit_from_submittable_index = determine_which_jobs_to_submit_given_resources(resources_from_submittable_index, maximum_new_resources) 
                 job_indices_to_submit = ibb(job_index_from_submittable_index, will_submit_from_submittable_index) 
                 jobs_to_submit_count = len(job_indices_to_submit) 
+                # The slot cap is binding if some held-back job would fit but for its slot count
+                new_slot_count = sum(ibl(self._slot_count_from_job_index, job_indices_to_submit))
+                is_cap_binding = any([ (resources[0] > maximum_new_resources[0] - new_slot_count) 
+                                       for (resources, will_submit) in zip(resources_from_submittable_index, will_submit_from_submittable_index) 
+                                       if not will_submit ])
                 for i in range(jobs_to_submit_count) :
                     job_index = job_indices_to_submit[i] 
-                    command_line_as_list = self._command_line_as_list[job_index]
-                    this_slot_count = self._slot_count_from_job_index[job_index]
-                    this_stdouterr_file_name = self._stdouterr_file_name_from_job_index[job_index]
-                    this_bsub_options_as_list = self._bsub_option_list_from_job_index[job_index]
-                    this_job_id = \
-                        bsub(command_line_as_list, 
-                             self._do_actually_submit,
-                             this_slot_count,
-                             this_stdouterr_file_name,
-                             this_bsub_options_as_list) 
+                    submit_tic_id = tic()
+                    try :
+                        this_job_id = self._submit_job(job_index)
+                    except lsf_unavailable_error as e :
+                        # Leave the rest for the next time round
+                        self._note_submit_failure(job_index, e, job_status_from_job_index)
+                        break
+                    if self._do_actually_submit :
+                        self._lsf_circuit_breaker.record_success()
                     self._job_id_from_job_index[job_index] = this_job_id 
+                    self._submit_time_from_job_index[job_index] = time.time()
+                    self._job_index_from_job_id[this_job_id] = job_index
                     if self._do_actually_submit :
                         job_status_from_job_index [job_index] = 0  # means running or pending 
                     else :
@@ -288,6 +1749,7 @@ class bqueue_type :
                         # In this case the value returned from bsub() indicates which.
                         if this_job_id == -1 :
                             job_status_from_job_index [job_index] = +1
+                            self._run_time_from_job_index[job_index] = toc(submit_tic_id)
                         elif this_job_id == -2 :
                             job_status_from_job_index [job_index] = -1
                         else :
@@ -297,38 +1759,135 @@ class bqueue_type :
             had_job_exited = [ (job_status==-1 or job_status==+1) for job_status in old_job_status_from_job_index ]  
             last_exited_job_count = sum(had_job_exited)
             newly_exited_job_count = exited_job_count - last_exited_job_count 
-            if do_show_progress_bar :
+            if progress_bar is not None :
                 progress_bar.update(newly_exited_job_count) 
             have_all_exited = (exited_job_count==job_count) 
             self._job_status_from_job_index = job_status_from_job_index  # not necessary, but nice to keep things up to date
+            if is_lsf_healthy and self._do_harvest_results and toc(last_harvest_tic_id) > self._results_harvest_interval :
+                try :
+                    self.harvest_results()
+                    last_harvest_tic_id = tic()
+                except lsf_unavailable_error :
+                    self._lsf_circuit_breaker.record_failure()
+            if do_adapt_running_slot_count and toc(last_adaptation_tic_id) > self._slot_count_adaptation_interval :
+                if not all([ (maximum_new > 0) for maximum_new in maximum_new_resources ]) :
+                    is_cap_binding = (maximum_new_resources[0] <= 0) and any([ math.isnan(job_status) for job_status in job_status_from_job_index ])
+                self._adapt_running_slot_count(toc(ticId), job_status_from_job_index, is_cap_binding)
+                last_adaptation_tic_id = tic()
             if not have_all_exited :
                 if self._do_actually_submit :
                     time.sleep(1) 
                 is_time_up = (toc(ticId) > maximum_wait_time) 
-        return job_status_from_job_index
+        return (job_status_from_job_index, have_all_exited, is_time_up)
+
+
+
+def read_job_id_file(job_id_file_name) :
+    '''
+    Reads a job id file written by bqueue_type.run(), and returns a dict mapping each job index to the list of LSF
+    job ids submitted for it (more than one if there were speculative copies).
+    '''
+    job_ids_from_job_index = {}
+    with open(job_id_file_name, 'r') as fid :
+        for line in fid :
+            tokens = line.split()
+            if len(tokens) != 2 :
+                continue   # e.g. a partly-written last line
+            job_ids_from_job_index.setdefault(int(tokens[0]), []).append(int(tokens[1]))
+    return job_ids_from_job_index
 
 
 
-def bwait(job_ids, maximum_wait_time=math.inf, do_show_progress_bar=True) :
-    have_all_exited = False 
-    is_time_up = False 
+def bwait_as_completed(job_ids, maximum_wait_time=math.inf, poll_interval=10, lsf_event_log_file_name=None) :
+    '''
+    Generator that yields (job_id, status) for each of the given jobs as it exits, where status is +1 (succeeded) or 
+    -1 (errored out).  Only jobs that haven't exited yet are polled.  Job ids that are nan (i.e. jobs that were never 
+    submitted) are yielded right away, with a status of nan.  Stops when all the jobs have exited, or after 
+    maximum_wait_time seconds, whichever comes first.
+    If lsf_event_log_file_name is given, bjobs is called once at the start, and after that job state changes are
+    read from that file (an lsb.events or lsb.acct file, or a site copy of one).
+    '''
+    unfinished_job_ids = []
+    for job_id in job_ids :
+        if math.isnan(job_id) :
+            yield (job_id, math.nan)
+        else :
+            unfinished_job_ids.append(job_id)
+    if lsf_event_log_file_name is not None :
+        # Start tailing before the initial poll, so no transitions fall through the cracks
+        lsf_event_log_tailer = lsf_event_log_tailer_type(lsf_event_log_file_name)
+    is_first_poll = True
+    ticId = tic() 
+    while isladen(unfinished_job_ids) :
+        if lsf_event_log_file_name is None or is_first_poll :
+            job_statuses = get_bsub_job_status(unfinished_job_ids) 
+            status_from_exited_job_id = { job_id:job_status for (job_id, job_status) in zip(unfinished_job_ids, job_statuses) if job_status!=0 }
+        else :
+            status_from_exited_job_id = { job_id:job_status_code for (job_id, job_status_code, _) in lsf_event_log_tailer.read_new_transitions()
+                                          if job_status_code!=0 }
+        is_first_poll = False
+        still_unfinished_job_ids = []
+        for job_id in unfinished_job_ids :
+            if job_id in status_from_exited_job_id :
+                yield (job_id, status_from_exited_job_id[job_id])
+            else :
+                still_unfinished_job_ids.append(job_id)
+        unfinished_job_ids = still_unfinished_job_ids
+        if isladen(unfinished_job_ids) :
+            if toc(ticId) > maximum_wait_time :
+                break
+            time.sleep(poll_interval) 
+
+
+
+def bwait_any(job_ids, maximum_wait_time=math.inf, poll_interval=10, lsf_event_log_file_name=None) :
+    # Waits for any one of the given jobs to exit, and returns its (job_id, status).  Returns None on timeout.
+    for (job_id, job_status) in bwait_as_completed(job_ids, maximum_wait_time, poll_interval, lsf_event_log_file_name) :
+        return (job_id, job_status)
+    return None
+
+
+
+def bwait_n(job_ids, n, maximum_wait_time=math.inf, poll_interval=10, lsf_event_log_file_name=None) :
+    # Waits for n of the given jobs to exit, and returns a list of their (job_id, status) pairs, in the order they 
+    # exited.  On timeout, the list will be shorter than n.
+    result = []
+    if n <= 0 :
+        return result
+    for (job_id, job_status) in bwait_as_completed(job_ids, maximum_wait_time, poll_interval, lsf_event_log_file_name) :
+        result.append( (job_id, job_status) )
+        if len(result) >= n :
+            break
+    return result
+
+
+
+def bwait(job_ids, maximum_wait_time=math.inf, do_show_progress_bar=True, lsf_event_log_file_name=None) :
+    # Waits for all the given jobs to exit, and returns their statuses, in the same order as job_ids.
+    # Jobs that haven't exited when maximum_wait_time runs out have status 0.
+    # If lsf_event_log_file_name is given, bjobs is called once at the start, and after that job state changes are 
+    # read from that file (an lsb.events or lsb.acct file, or a site copy of one).
     job_count = len(job_ids) 
     if do_show_progress_bar :
         progress_bar = progress_bar_object(job_count) 
-    last_exited_job_count = 0 
-    ticId = tic() 
-    while not have_all_exited and not is_time_up :
-        job_statuses = get_bsub_job_status(job_ids) 
-        has_job_exited = [status!=0 for status in job_statuses]
-        exited_job_count = sum(has_job_exited) 
-        newly_exited_job_count = exited_job_count - last_exited_job_count 
+    job_statuses = [0] * job_count
+    job_indices_from_job_id = {}
+    for job_index in range(job_count) :
+        job_id = job_ids[job_index]
+        if math.isnan(job_id) :
+            job_statuses[job_index] = math.nan   # never submitted, so nothing to wait for
+        else :
+            job_indices_from_job_id.setdefault(job_id, []).append(job_index)
+    if do_show_progress_bar :
+        progress_bar.update(job_count - sum(map(len, job_indices_from_job_id.values())))
+    poll_interval = 10 if lsf_event_log_file_name is None else 1
+    # Each distinct job id only needs waiting on once
+    for (job_id, job_status) in bwait_as_completed(list(job_indices_from_job_id.keys()), maximum_wait_time, poll_interval, lsf_event_log_file_name) :
+        job_indices = job_indices_from_job_id[job_id]
+        for job_index in job_indices :
+            job_statuses[job_index] = job_status
         if do_show_progress_bar :
-            progress_bar.update(newly_exited_job_count) 
-        have_all_exited = (exited_job_count==job_count)         
-        if ~have_all_exited :
-            time.sleep(10) 
-            is_time_up = (toc(ticId) > maximum_wait_time) 
-        last_exited_job_count = exited_job_count 
+            progress_bar.update(len(job_indices)) 
     return job_statuses
 
 
@@ -360,6 +1919,351 @@ def test_bqueue() :
 
 
 
-# If called from command line, run the test(s)
+_fake_bsub_source = '''#!%s
+# Fake bsub for test_lsf_fault_handling().  Runs the job in the background, and records its exit code in <job id>.exit.
+import os, sys, time, subprocess
+folder_path = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(folder_path, 'bsub_calls'), 'a') as fid :
+    fid.write('.')
+if os.path.exists(os.path.join(folder_path, 'bsub_sleep')) :
+    time.sleep(60)
+if os.path.exists(os.path.join(folder_path, 'bsub_delay')) :
+    time.sleep(float(open(os.path.join(folder_path, 'bsub_delay')).read()))
+if os.path.exists(os.path.join(folder_path, 'bsub_fail')) :
+    print('LSF is down. Please wait...')
+    sys.exit(255)
+job_id = 1000 + len(open(os.path.join(folder_path, 'bsub_calls')).read())
+argv = sys.argv[1:]
+value_from_option = {}
+while argv[0].startswith('-') :
+    value_from_option[argv[0]] = argv[1]
+    argv = argv[2:]
+exit_file_name = os.path.join(folder_path, '%%d.exit' %% job_id)
+log_fid = open(value_from_option.get('-oo', '/dev/null'), 'w')
+subprocess.Popen(['sh', '-c', '"$@"; echo $? > %%s.tmp; mv %%s.tmp %%s' %% (exit_file_name, exit_file_name, exit_file_name), 'sh'] + argv,
+                 stdout=log_fid, stderr=subprocess.STDOUT, start_new_session=True)
+print('Job <%%d> is submitted to default queue <normal>.' %% job_id)
+'''
+
+_fake_bjobs_source = '''#!%s
+# Fake bjobs for test_lsf_fault_handling().  If bjobs_forget exists, finished jobs are 'not found'.
+import os, sys, time
+folder_path = os.path.dirname(os.path.abspath(__file__))
+if os.path.exists(os.path.join(folder_path, 'bjobs_sleep')) :
+    time.sleep(60)
+if os.path.exists(os.path.join(folder_path, 'bjobs_fail')) :
+    sys.stderr.write('LSF is down. Please wait...\\n')
+    sys.exit(255)
+return_code = 0
+print('JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME')
+for job_id in sys.argv[1:] :
+    exit_file_name = os.path.join(folder_path, '%%s.exit' %% job_id)
+    if os.path.exists(exit_file_name) :
+        if os.path.exists(os.path.join(folder_path, 'bjobs_forget')) :
+            sys.stderr.write('Job <%%s> is not found\\n' %% job_id)
+            return_code = 255
+            continue
+        stat = 'DONE' if open(exit_file_name).read().strip() == '0' else 'EXIT'
+    else :
+        stat = 'RUN'
+    print('%%s  me  %%s  normal  login1  h01u01  job  Oct 19 10:00' %% (job_id, stat))
+sys.exit(return_code)
+'''
+
+_fake_bhist_source = '''#!%s
+# Fake bhist -a -l for test_lsf_fault_handling(), with bhist's line wrapping
+import os, sys
+folder_path = os.path.dirname(os.path.abspath(__file__))
+blocks = []
+for job_id in sys.argv[3:] :
+    exit_file_name = os.path.join(folder_path, '%%s.exit' %% job_id)
+    if os.path.exists(exit_file_name) :
+        exit_code = open(exit_file_name).read().strip()
+        outcome = 'Done successfully. The CPU time used is 0.1 seconds.' if exit_code == '0' else 'Exited with exit code %%s. The CPU time used is 0.1 seconds.' %% exit_code
+        blocks.append('Job <%%s>, User <me>, Project <default>, Command <true>\\n'
+                      'Mon Oct 19 10:00:00: Submitted from host <login1>, to Queue <normal>, CWD <$HOME>;\\n'
+                      'Mon Oct 19 10:00:01: %%s\\n                     %%s\\n' %% (job_id, outcome[:30], outcome[30:]))
+print(('\\n' + '-'*78 + '\\n\\n').join(blocks))
+'''
+
+
+
+def _write_fake_lsf_commands(folder_path) :
+    # Writes fake bsub, bjobs, bhist and bkill commands into folder_path, for tests that don't need a real LSF.  Put 
+    # folder_path first on the PATH to use them.  Creating fault files (e.g. bjobs_fail) in folder_path makes them misbehave.
+    for (command_name, source) in [ ('bsub', _fake_bsub_source), ('bjobs', _fake_bjobs_source), ('bhist', _fake_bhist_source), 
+                                    ('bkill', '#!/bin/sh\n') ] :
+        file_name = os.path.join(folder_path, command_name)
+        with open(file_name, 'w') as fid :
+            fid.write(source % sys.executable if '%s' in source else source)
+        os.chmod(file_name, 0o755)
+
+
+
+def test_lsf_fault_handling() :
+    '''
+    Checks timeouts, retries, and the circuit breaker, using fake bsub, bjobs and bkill commands that can be made to 
+    hang or fail.  Doesn't need LSF.
+    '''
+    old_path = os.environ['PATH']
+    fake_folder_path = tempfile.mkdtemp(prefix='tpt-fake-lsf-')
+    def fault_file_name(name) :
+        return os.path.join(fake_folder_path, name)
+    def bsub_call_count() :
+        if not os.path.exists(fault_file_name('bsub_calls')) :
+            return 0
+        with open(fault_file_name('bsub_calls'), 'r') as fid :
+            return len(fid.read())
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    try :
+        _write_fake_lsf_commands(fake_folder_path)
+        os.environ['PATH'] = fake_folder_path + os.pathsep + old_path
+        set_lsf_command_timeouts(submit_timeout=1, query_timeout=0.5, query_retry_count=1, retry_base_delay=0.1)
+
+        # A command that outlasts its timeout gets killed
+        tic_id = tic()
+        try :
+            run_subprocess_and_return_stdout(['sleep', '10'], timeout=0.2)
+            check(False, 'run_subprocess_and_return_stdout() should have timed out')
+        except subprocess.TimeoutExpired :
+            check(toc(tic_id) < 5, 'the timed-out command should have been killed promptly')
+
+        # A bsub that times out is not retried, and its job is marked as errored out
+        open(fault_file_name('bsub_sleep'), 'w').close()
+        bqueue = bqueue_type(True, lsf_circuit_reset_timeout=0.5)
+        bqueue.enqueue(1, '', [], ['true'])
+        job_statuses = bqueue.run(30, False)
+        check(job_statuses == [-1], 'a job whose bsub timed out should be marked as errored out, got %s' % job_statuses)
+        check(bsub_call_count() == 1, 'a bsub that timed out should not be retried, but bsub was called %d times' % bsub_call_count())
+        os.remove(fault_file_name('bsub_sleep'))
+
+        # A bsub that keeps failing opens the circuit breaker, and eventually the job is given up on
+        open(fault_file_name('bsub_fail'), 'w').close()
+        bqueue = bqueue_type(True, lsf_failure_threshold=2, lsf_circuit_reset_timeout=0.2, maximum_submit_attempt_count=3)
+        bqueue.enqueue(1, '', [], ['true'])
+        job_statuses = bqueue.run(30, False)
+        check(job_statuses == [-1], 'a job that can\'t be submitted should be marked as errored out, got %s' % job_statuses)
+        check(bqueue.lsf_health_metrics()['open_count'] >= 1, 'repeated bsub failures should open the circuit breaker')
+        os.remove(fault_file_name('bsub_fail'))
+
+        # A bjobs outage partway through a run is ridden out, and the run still finishes
+        def make_bjobs_hang_for_a_while() :
+            time.sleep(1.5)
+            open(fault_file_name('bjobs_sleep'), 'w').close()
+            time.sleep(4)
+            os.remove(fault_file_name('bjobs_sleep'))
+        def make_bjobs_fail_for_a_while() :
+            time.sleep(1.5)
+            open(fault_file_name('bjobs_fail'), 'w').close()
+            time.sleep(4)
+            os.remove(fault_file_name('bjobs_fail'))
+        thread = threading.Thread(target=make_bjobs_hang_for_a_while, daemon=True)
+        bqueue = bqueue_type(True, maximum_running_slot_count=2, lsf_failure_threshold=2, lsf_circuit_reset_timeout=1)
+        for _ in range(4) :
+            bqueue.enqueue(1, '', [], ['sleep', '1'])
+        thread.start()
+        job_statuses = bqueue.run(60, False)
+        thread.join()
+        check(job_statuses == [+1]*4, 'all the jobs should succeed despite the bjobs outage, got %s' % job_statuses)
+        check(bqueue.lsf_health_metrics()['open_count'] >= 1, 'the bjobs outage should open the circuit breaker')
+
+        # Likewise in pilot mode, where bjobs is used to count the live workers
+        thread = threading.Thread(target=make_bjobs_fail_for_a_while, daemon=True)
+        pilot_folder_path = os.path.join(fake_folder_path, 'pilot')
+        bqueue = bqueue_type(True, pilot_folder_path=pilot_folder_path, maximum_pilot_worker_count=2, pilot_idle_timeout=2, 
+                             lsf_failure_threshold=1, lsf_circuit_reset_timeout=1)
+        for _ in range(4) :
+            bqueue.enqueue(1, '', [], ['sleep', '1'])
+        thread.start()
+        job_statuses = bqueue.run(60, False)
+        thread.join()
+        check(job_statuses == [+1]*4, 'all the pilot jobs should succeed despite the bjobs outage, got %s' % job_statuses)
+        check(bqueue.lsf_health_metrics()['open_count'] >= 1, 'the bjobs outage should open the circuit breaker in pilot mode')
+
+        # A speculative copy of a straggler writes to a log of its own, which is the job's log if the copy wins
+        log_file_name = os.path.join(fake_folder_path, 'straggler.log')
+        marker_file_name = os.path.join(fake_folder_path, 'straggler.started')
+        bqueue = bqueue_type(True, do_speculate_stragglers=True, straggler_runtime_factor=2, minimum_straggler_runtime=1, 
+                             minimum_completed_job_count_for_speculation=1)
+        bqueue.enqueue(1, '', [], ['sleep', '2'])   # long enough to be seen running, so there's a run time to go on
+        # The first copy to start is slow, the second is quick
+        bqueue.enqueue(1, log_file_name, [], 
+                       ['sh', '-c', 'if [ -e %s ]; then echo copy; else touch %s; sleep 10; echo original; fi' % (marker_file_name, marker_file_name)])
+        job_statuses = bqueue.run(60, False)
+        check(job_statuses == [+1, +1], 'the straggler should finish, got %s' % job_statuses)
+        check(bqueue.stdouterr_file_name(1) == log_file_name + '.speculative', 
+              'the winning copy\'s log should be the job\'s log, got %s' % bqueue.stdouterr_file_name(1))
+        with open(bqueue.stdouterr_file_name(1), 'r') as fid :
+            check(fid.read().strip() == 'copy', 'the speculative copy\'s log should hold its own output')
+
+        # Jobs that bjobs has forgotten about are looked up with bhist, and don't count as LSF failures
+        open(fault_file_name('bjobs_forget'), 'w').close()
+        bqueue = bqueue_type(True, lsf_failure_threshold=1, lsf_circuit_reset_timeout=60)
+        bqueue.enqueue(1, '', [], ['true'])
+        bqueue.enqueue(1, '', [], ['false'])
+        job_statuses = bqueue.run(30, False)
+        check(job_statuses == [+1, -1], 'forgotten jobs should get their final status from bhist, got %s' % job_statuses)
+        check(bqueue.lsf_health_metrics()['open_count'] == 0, 'forgotten jobs should not open the circuit breaker')
+        os.remove(fault_file_name('bjobs_forget'))
+
+        # In event-log mode, jobs whose final records never show up in the log get checked with bjobs
+        event_log_file_name = fault_file_name('lsb.events')
+        open(event_log_file_name, 'w').close()
+        bqueue = bqueue_type(True, lsf_event_log_file_name=event_log_file_name, lsf_event_log_bjobs_check_interval=1)
+        bqueue.enqueue(1, '', [], ['true'])
+        bqueue.enqueue(1, '', [], ['false'])
+        job_statuses = bqueue.run(30, False)
+        check(job_statuses == [+1, -1], 'jobs missing from the event log should get their status from bjobs, got %s' % job_statuses)
+    finally :
+        os.environ['PATH'] = old_path
+        set_lsf_command_timeouts()
+        shutil.rmtree(fake_folder_path)
+    print('Test passed.')
+
+
+
+def test_up_to_date_checking() :
+    '''
+    Checks that run() skips jobs whose outputs are up to date, in both 'mtime' and 'hash' modes, and that the 
+    manifest gets rewritten after a run.  Runs the jobs locally, so doesn't need LSF.
+    '''
+    folder_path = tempfile.mkdtemp(prefix='tpt-up-to-date-')
+    input_file_name = os.path.join(folder_path, 'input.txt')
+    output_file_name = os.path.join(folder_path, 'output.txt')
+    runs_file_name = os.path.join(folder_path, 'runs')
+    manifest_file_name = os.path.join(folder_path, 'manifest.json')
+    command_line_as_list = ['sh', '-c', 'cat %s > %s; echo . >> %s' % (input_file_name, output_file_name, runs_file_name)]
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    def run_count() :
+        if not os.path.exists(runs_file_name) :
+            return 0
+        with open(runs_file_name, 'r') as fid :
+            return len(fid.read().split())
+    def write_input(contents, mtime) :
+        with open(input_file_name, 'w') as fid :
+            fid.write(contents)
+        os.utime(input_file_name, (mtime, mtime))
+    def run_job(mode) :
+        # Returns the job's id, and checks that it succeeded
+        bqueue = bqueue_type(False, up_to_date_check_mode=mode, up_to_date_manifest_file_name=(manifest_file_name if mode == 'hash' else None))
+        bqueue.enqueue(1, '', [], command_line_as_list, input_file_names=[input_file_name], output_file_names=[output_file_name])
+        job_statuses = bqueue.run(30, False)
+        check(job_statuses == [+1], 'the job should succeed, got %s' % job_statuses)
+        return bqueue._job_id_from_job_index[0]
+    def load_recorded_input_hash() :
+        hashes = list(load_up_to_date_manifest(manifest_file_name)['input_hashes_from_job_key'].values())
+        check(len(hashes) == 1, 'the manifest should hold one job, got %d' % len(hashes))
+        return hashes[0][input_file_name]
+    try :
+        # 'mtime' mode: the job runs when the output is missing or older than the input, and is skipped otherwise
+        write_input('first', time.time() - 100)
+        check(run_job('mtime') == -1 and run_count() == 1, 'the job should run when its output is missing')
+        check(run_job('mtime') == -3 and run_count() == 1, 'the job should be skipped when its output is newer than its input')
+        write_input('first', time.time() + 100)
+        check(run_job('mtime') == -1 and run_count() == 2, 'the job should run when its input is newer than its output')
+        os.remove(output_file_name)
+        os.remove(runs_file_name)
+
+        # 'hash' mode: only a change to the input's contents makes the job run again
+        write_input('first', time.time() - 100)
+        check(run_job('hash') == -1 and run_count() == 1, 'the job should run when there is no manifest')
+        check(os.path.exists(manifest_file_name), 'the manifest should be written after the run')
+        check(load_recorded_input_hash() == sha256_of_file(input_file_name), 'the manifest should hold the input\'s hash')
+        check(run_job('hash') == -3 and run_count() == 1, 'the job should be skipped when its input is unchanged')
+        write_input('first', time.time() + 100)
+        check(run_job('hash') == -3 and run_count() == 1, 'the job should be skipped when only its input\'s mtime changed')
+        write_input('second', time.time() + 200)
+        check(run_job('hash') == -1 and run_count() == 2, 'the job should run when its input\'s contents changed')
+        check(load_recorded_input_hash() == sha256_of_file(input_file_name), 'the manifest should be rewritten with the new hash')
+        check(run_job('hash') == -3 and run_count() == 2, 'the job should be skipped after the manifest is rewritten')
+        os.remove(output_file_name)
+        check(run_job('hash') == -1 and run_count() == 3, 'the job should run when its output is missing')
+    finally :
+        shutil.rmtree(folder_path)
+    print('Test passed.')
+
+
+
+def test_adaptive_slot_cap() :
+    # Checks the additive increase and multiplicative decrease of the cap, and that it stays within its bounds
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    folder_path = tempfile.mkdtemp(prefix='tpt-slot-cap-')
+    try :
+        log_file_name = os.path.join(folder_path, 'slot-cap.tsv')
+        cap = adaptive_slot_cap_type(8, 100, maximum_time_to_start=60, log_file_name=log_file_name)
+        check(cap.slot_count() == 64, 'the cap should start at 64, got %d' % cap.slot_count())
+
+        # No congestion: the cap goes up only while it's what's holding back submission
+        check(cap.update(10, 0, 0, 64, [5, 10], True) == 68, 'the cap should go up by 4 when it is binding')
+        check(cap.update(20, 0, 0, 30, [], False) == 68, 'the cap should stay put when it is not binding')
+        for update_index in range(20) :
+            cap.update(30+update_index, 0, 0, cap.slot_count(), [], True)
+        check(cap.slot_count() == 100, 'the cap should stop at the maximum, got %d' % cap.slot_count())
+
+        # Congestion: the cap is halved, whether or not it's binding
+        check(cap.update(60, 20, 11, 80, [], True) == 50, 'the cap should halve when too many slots are stuck pending')
+        check(cap.update(70, 5, 5, 45, [], True) == 54, 'a few stuck slots should not count as congestion')
+        check(cap.update(80, 0, 0, 54, [30, 90, 100], False) == 27, 'the cap should halve when jobs take too long to start')
+        check(cap.update(90, 0, 0, 27, [30, 40, 100], True) == 31, 'a slow job should not count as congestion if the median is fine')
+        for update_index in range(5) :
+            cap.update(100+update_index, 40, 40, 0, [], True)
+        check(cap.slot_count() == 8, 'the cap should stop at the minimum, got %d' % cap.slot_count())
+
+        # Each update is in the history, and in the log
+        update_count = 2 + 20 + 4 + 5
+        check(len(cap.history()) == update_count, 'the history should have %d entries, got %d' % (update_count, len(cap.history())))
+        check(math.isnan(cap.history()[1][5]), 'the median time to start should be nan when no jobs started')
+        with open(log_file_name, 'r') as fid :
+            line_count = len(fid.readlines())
+        check(line_count == update_count + 1, 'the log should have a header and %d rows, got %d lines' % (update_count, line_count))
+        check(adaptive_slot_cap_type(2, 10).slot_count() == 10, 'the initial cap should be clipped to the maximum')
+        try :
+            adaptive_slot_cap_type(10, 2)
+        except RuntimeError :
+            pass
+        else :
+            raise RuntimeError('Test failed: a minimum above the maximum should be an error')
+    finally :
+        shutil.rmtree(folder_path)
+    print('Test passed.')
+
+
+
+def test_local_resource_sampling() :
+    # Checks that the sampled resource use of locally run jobs goes into the results table, without do_harvest_results
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    bqueue = bqueue_type(False, local_resource_sampling_interval=0.1)
+    bqueue.enqueue(1, '', [], [sys.executable, '-c', 'import time; x = b"x" * (50*1024*1024); time.sleep(1)'])
+    bqueue.enqueue(1, '', [], ['false'])
+    job_statuses = bqueue.run(60, False)
+    check(job_statuses == [+1, -1], 'the first job should succeed and the second fail, got %s' % job_statuses)
+    results_table = bqueue.results_table()
+    check(results_table.row_count() == 2, 'both jobs should be in the results table, got %d rows' % results_table.row_count())
+    check(results_table.column('exit_code') == [0, 1], 'the exit codes should be recorded, got %s' % results_table.column('exit_code'))
+    max_memory_in_mb = results_table.column('max_memory_in_mb')[0]
+    check(max_memory_in_mb > 40, 'the peak memory of the first job should be over 40 MB, got %g MB' % max_memory_in_mb)
+    run_time = results_table.column('run_time')[0]
+    check(1 <= run_time < 10, 'the run time of the first job should be about 1 s, got %g s' % run_time)
+    print('Test passed.')
+
+
+
+# If called from command line, run the test(s).  test_bqueue() needs LSF.  The tests are run from tpt.fuster rather 
+# than from this __main__ copy of the module, since pilot.py imports tpt.fuster, and the exceptions raised there
+# must be the ones the bqueue catches.
 if __name__ == "__main__":
-    test_bqueue()
+    import tpt.fuster
+    tpt.fuster.test_lsf_fault_handling()
+    tpt.fuster.test_up_to_date_checking()
+    tpt.fuster.test_adaptive_slot_cap()
+    tpt.fuster.test_local_resource_sampling()
+    if shutil.which('bsub') is not None :
+        tpt.fuster.test_bqueue()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import gzip
+import struct
+import fcntl
+import signal
+import shutil
+import tempfile
+import subprocess
+import time
+from tpt.utilities import *
+
+
+
+class job_log_archive_type :
+    '''
+    Stores the stdout+stderr of many jobs in a handful of archive segment files, instead of one file per job.
+
+    Each job's log is a gzip member appended to segment (job_index % segment_count), under a lock.  The byte offset
+    and length of each log go into a fixed-width record in index.bin, at position job_index * record size, so looking
+    up one job's log is a single seek into the index and a single seek into a segment.  (Concatenated gzip members
+    are themselves a valid gzip file, so the segments can also be read with zcat.)
+
+    Jobs don't write to the archive directly.  Instead, their command line is wrapped by wrapped_command_line(), which
+    runs the command with its output going to a compressed file in node-local scratch ($TMPDIR), and appends that to
+    the archive when the command exits.  A job that gets killed by LSF (e.g. for hitting its run-time or memory limit,
+    or by bkill) still gets its output so far archived, as long as the wrapper is sent SIGINT, SIGTERM or SIGUSR2 
+    before SIGKILL, which is what LSF does.
+    '''
+    _record_format = '<IIQQ'   # is_present, segment_index, offset, byte_count
+    _record_byte_count = struct.calcsize(_record_format)
+
+    def __init__(self, folder_path, segment_count=16) :
+        self._folder_path = os.path.abspath(folder_path)
+        self._segment_count = segment_count
+        os.makedirs(self._folder_path, exist_ok=True)
+
+    def _segment_file_name(self, segment_index) :
+        return os.path.join(self._folder_path, 'segment-%04d.gz' % segment_index)
+
+    def _index_file_name(self) :
+        return os.path.join(self._folder_path, 'index.bin')
+
+    def wrapped_command_line(self, job_index, command_line_as_list) :
+        # Returns a command line that runs command_line_as_list and saves its output in the archive
+        result = [ sys.executable, '-m', 'tpt.job_log_archive', self._folder_path, str(self._segment_count), str(job_index), '--' ] + \
+                 command_line_as_list
+        return result
+
+    def append_job_log(self, job_index, compressed_log_file_name, do_replace=True) :
+        '''
+        Appends the (already gzipped) log in compressed_log_file_name to the archive, as the log of job job_index.
+        Replaces any log already there for that job index, unless do_replace is false, in which case an existing log
+        is left alone.
+        '''
+        if not do_replace and self.has_job_log(job_index) :
+            return
+        segment_index = job_index % self._segment_count
+        byte_count = os.path.getsize(compressed_log_file_name)
+        with open(self._segment_file_name(segment_index), 'ab') as segment_fid, open(compressed_log_file_name, 'rb') as log_fid :
+            # lockf() rather than flock(), so this works across hosts on NFS
+            fcntl.lockf(segment_fid, fcntl.LOCK_EX)
+            try :
+                offset = os.fstat(segment_fid.fileno()).st_size
+                shutil.copyfileobj(log_fid, segment_fid)
+                segment_fid.flush()
+                os.fsync(segment_fid.fileno())
+            finally :
+                fcntl.lockf(segment_fid, fcntl.LOCK_UN)
+        # Each job index has its own slot in the index, so no lock is needed here
+        record = struct.pack(self._record_format, 1, segment_index, offset, byte_count)
+        index_fd = os.open(self._index_file_name(), os.O_WRONLY | os.O_CREAT, 0o644)
+        try :
+            os.pwrite(index_fd, record, job_index * self._record_byte_count)
+        finally :
+            os.close(index_fd)
+
+    def _read_record(self, job_index) :
+        # Returns the (segment_index, offset, byte_count) of job job_index's log, or None if there isn't one (yet)
+        index_file_name = self._index_file_name()
+        if not os.path.exists(index_file_name) :
+            return None
+        with open(index_file_name, 'rb') as fid :
+            fid.seek(job_index * self._record_byte_count)
+            record = fid.read(self._record_byte_count)
+        if len(record) < self._record_byte_count :
+            return None
+        (is_present, segment_index, offset, byte_count) = struct.unpack(self._record_format, record)
+        if not is_present :
+            return None
+        return (segment_index, offset, byte_count)
+
+    def has_job_log(self, job_index) :
+        return (self._read_record(job_index) is not None)
+
+    def get_job_log(self, job_index) :
+        # Returns the log of job job_index, as a string, or None if there isn't one (yet)
+        record = self._read_record(job_index)
+        if record is None :
+            return None
+        (segment_index, offset, byte_count) = record
+        with open(self._segment_file_name(segment_index), 'rb') as fid :
+            fid.seek(offset)
+            compressed_log = fid.read(byte_count)
+        result = gzip.decompress(compressed_log).decode('utf-8', errors='replace')
+        return result
+
+
+
+# The signals LSF sends a job before SIGKILL, when it's killed or hits a limit
+_trapped_signal_numbers = [ signal.SIGINT, signal.SIGTERM, signal.SIGUSR2 ]
+
+
+
+class _job_signalled_error(Exception) :
+    # Raised by the wrapper's signal handler, to stop copying the log
+    def __init__(self, signal_number) :
+        Exception.__init__(self, 'Got signal %d' % signal_number)
+        self.signal_number = signal_number
+
+
+
+def run_and_archive_job_log(archive_folder_path, segment_count, job_index, command_line_as_list) :
+    '''
+    Runs the command, with its stdout+stderr compressed into node-local scratch, then appends that to the archive.
+    If the wrapper gets one of _trapped_signal_numbers, it passes the signal on to the command, and archives the log
+    so far, with a note saying so, unless there's already a log for the job (e.g. from the winning copy of a job with 
+    a speculative copy).  If the command can't be started, the error message is archived as its log.  Returns the 
+    command's return code, or 128 plus the signal number if it was killed, or 127 if it couldn't be started.
+    '''
+    archive = job_log_archive_type(archive_folder_path, segment_count)
+    (fd, compressed_log_file_name) = tempfile.mkstemp(prefix='tpt-job-%d-' % job_index, suffix='.gz')   # honors $TMPDIR
+    os.close(fd)
+    def handle_signal(signal_number, frame) :
+        # Ignore any further signals (LSF sends several), so they can't interrupt archiving the log
+        for trapped_signal_number in _trapped_signal_numbers :
+            signal.signal(trapped_signal_number, signal.SIG_IGN)
+        raise _job_signalled_error(signal_number)
+    old_handler_from_signal_number = \
+        dict([ (signal_number, signal.signal(signal_number, handle_signal)) for signal_number in _trapped_signal_numbers ])
+    process = None
+    do_replace = True
+    try :
+        with gzip.open(compressed_log_file_name, 'wb') as log_fid :
+            try :
+                try :
+                    process = subprocess.Popen(command_line_as_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                except OSError as e :
+                    log_fid.write(('Unable to run the command "%s": %s\n' % (space_out(command_line_as_list), str(e))).encode('utf-8'))
+                    return_code = 127
+                else :
+                    # read1() rather than read(), so that output is never held back in the pipe's buffer
+                    while True :
+                        chunk = process.stdout.read1(65536)
+                        if isempty(chunk) :
+                            break
+                        log_fid.write(chunk)
+                    return_code = process.wait()
+            except _job_signalled_error as e :
+                if process is not None and process.poll() is None :
+                    process.send_signal(e.signal_number)
+                log_fid.write(('\n[The job was sent signal %d, so this log is incomplete]\n' % e.signal_number).encode('utf-8'))
+                return_code = 128 + e.signal_number
+                do_replace = False
+        for signal_number in _trapped_signal_numbers :
+            signal.signal(signal_number, signal.SIG_IGN)
+        archive.append_job_log(job_index, compressed_log_file_name, do_replace)
+    finally :
+        for (signal_number, old_handler) in old_handler_from_signal_number.items() :
+            signal.signal(signal_number, old_handler)
+        os.remove(compressed_log_file_name)
+    return return_code
+
+
+
+def test_job_log_archive() :
+    '''
+    Runs a few jobs through wrapped_command_line(), and checks that get_job_log() gets back their output, including
+    for a command that can't be started, and for a job that gets killed.  Doesn't need LSF.
+    '''
+    archive_folder_path = tempfile.mkdtemp(prefix='tpt-job-log-archive-')
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    try :
+        archive = job_log_archive_type(archive_folder_path, segment_count=2)
+        check(archive.get_job_log(0) is None, 'there should be no log before the job has run')
+
+        # Round trip, with stdout and stderr both captured, and the exit code passed through
+        return_code = subprocess.call(archive.wrapped_command_line(0, ['sh', '-c', 'echo to stdout; echo to stderr 1>&2; exit 3']))
+        check(return_code == 3, 'the wrapper should pass the exit code through, got %d' % return_code)
+        log = archive.get_job_log(0)
+        check('to stdout' in log and 'to stderr' in log, 'the log should have both stdout and stderr, got %s' % repr(log))
+
+        # A second job in the same segment doesn't disturb the first
+        subprocess.call(archive.wrapped_command_line(2, ['echo', 'job 2']))
+        check(archive.get_job_log(2) == 'job 2\n', 'got the wrong log for job 2: %s' % repr(archive.get_job_log(2)))
+        check(archive.get_job_log(0) == log, 'the log of job 0 should be unchanged')
+
+        # A command that can't be started still leaves a log
+        return_code = subprocess.call(archive.wrapped_command_line(1, ['/no/such/command']))
+        check(return_code == 127, 'a command that can\'t be started should give return code 127, got %d' % return_code)
+        check('Unable to run' in archive.get_job_log(1), 'the log should say the command couldn\'t be run, got %s' % repr(archive.get_job_log(1)))
+
+        # A job that gets killed the way LSF does it leaves its output so far
+        process = subprocess.Popen(archive.wrapped_command_line(3, ['sh', '-c', 'echo partial output; exec sleep 60']))
+        tic_id = tic()
+        time.sleep(1)
+        process.send_signal(signal.SIGTERM)
+        return_code = process.wait(timeout=30)
+        check(toc(tic_id) < 20, 'the killed job should exit promptly')
+        check(return_code == 128+signal.SIGTERM, 'the killed job should give return code %d, got %d' % (128+signal.SIGTERM, return_code))
+        log = archive.get_job_log(3)
+        check(log is not None and 'partial output' in log and 'incomplete' in log, 'the killed job\'s partial log should be archived, got %s' % repr(log))
+
+        # ...but a killed job doesn't replace a log that's already there, e.g. from the copy that won a speculative race
+        process = subprocess.Popen(archive.wrapped_command_line(2, ['sh', '-c', 'echo loser; exec sleep 60']))
+        time.sleep(1)
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+        check(archive.get_job_log(2) == 'job 2\n', 'a killed job should not replace an existing log, got %s' % repr(archive.get_job_log(2)))
+    finally :
+        shutil.rmtree(archive_folder_path)
+    print('Test passed.')
+
+
+
+def main(argv) :
+    # Usage: python -m tpt.job_log_archive <archive folder> <segment count> <job index> -- <command> [args...]
+    if len(argv)<5 or argv[3] != '--' :
+        raise RuntimeError('Usage: python -m tpt.job_log_archive <archive folder> <segment count> <job index> -- <command> [args...]')
+    archive_folder_path = argv[0]
+    segment_count = int(argv[1])
+    job_index = int(argv[2])
+    command_line_as_list = argv[4:]
+    return_code = run_and_archive_job_log(archive_folder_path, segment_count, job_index, command_line_as_list)
+    return return_code
+
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import os
+import shlex
+import tempfile
+from tpt.utilities import *
+
+
+
+# Bits of the jStatus field in lsb.events/lsb.acct records
+JOB_STAT_PEND = 0x01
+JOB_STAT_PSUSP = 0x02
+JOB_STAT_RUN = 0x04
+JOB_STAT_SSUSP = 0x08
+JOB_STAT_USUSP = 0x10
+JOB_STAT_EXIT = 0x20
+JOB_STAT_DONE = 0x40
+
+
+
+def job_status_code_from_lsf_jstatus(jstatus) :
+    # Converts an LSF jStatus bitmask to one of {-1,0,+1}, same as job_status_code_from_lsf_stat()
+    if jstatus & JOB_STAT_DONE :
+        result = +1
+    elif jstatus & JOB_STAT_EXIT :
+        result = -1
+    else :
+        result = 0
+    return result
+
+
+
+def parse_lsf_event_record(line) :
+    '''
+    Parses a single lsb.events or lsb.acct record, and returns (job_id, job_status_code, event_time), with the status
+    code one of {-1,0,+1}.  Returns None for records that aren't about a job changing state (or can't be parsed).
+    The records understood are JOB_NEW, JOB_START and JOB_STATUS (from lsb.events) and JOB_FINISH (from lsb.acct).
+    Fields are space-separated, and strings are double-quoted, so shlex does the tokenizing.
+    '''
+    try :
+        tokens = shlex.split(line)
+    except ValueError :
+        return None
+    if len(tokens) < 5 :
+        return None
+    event_type = tokens[0]
+    try :
+        event_time = float(tokens[2])
+        job_id = int(tokens[3])
+        if event_type == 'JOB_NEW' :
+            job_status_code = 0
+        elif event_type == 'JOB_START' or event_type == 'JOB_STATUS' :
+            job_status_code = job_status_code_from_lsf_jstatus(int(tokens[4]))
+        elif event_type == 'JOB_FINISH' :
+            # jStatus comes after two variable-length host lists
+            asked_host_count = int(tokens[22])
+            exec_host_count_index = 23 + asked_host_count
+            exec_host_count = int(tokens[exec_host_count_index])
+            jstatus_index = exec_host_count_index + 1 + exec_host_count
+            job_status_code = job_status_code_from_lsf_jstatus(int(tokens[jstatus_index]))
+        else :
+            return None
+    except (ValueError, IndexError) :
+        return None
+    return (job_id, job_status_code, event_time)
+
+
+
+class lsf_event_log_tailer_type :
+    '''
+    Incrementally reads an LSF event or accounting file (lsb.events, lsb.acct, or a site copy of one), and turns new
+    records into job state transitions.
+
+    Reads pick up from a byte offset, which is saved to offset_file_name (if given) after every read, so a restarted
+    conductor picks up where it left off.  If there's no saved offset, reading starts at the current end of the file
+    when do_start_at_end is true, or at the beginning otherwise.  A partial line at the end of the file is left
+    for the next read.  If the file has been rotated (i.e. it has a new inode), the rest of the old file is read
+    from file_name + '.1', the name LSF gives it, before starting on the new one.  The file is read 
+    read_chunk_byte_count bytes at a time, so a big backlog (e.g. a whole lsb.acct) never has to fit in memory at once.
+    '''
+    def __init__(self, file_name, offset_file_name=None, do_start_at_end=True, read_chunk_byte_count=1024*1024) :
+        self._file_name = file_name
+        self._offset_file_name = offset_file_name
+        self._read_chunk_byte_count = read_chunk_byte_count
+        if (offset_file_name is not None) and os.path.exists(offset_file_name) :
+            with open(offset_file_name, 'r') as fid :
+                (inode_as_string, offset_as_string) = fid.read().split()
+            self._inode = int(inode_as_string)
+            self._offset = int(offset_as_string)
+        elif os.path.exists(file_name) :
+            stat_result = os.stat(file_name)
+            self._inode = stat_result.st_ino
+            self._offset = stat_result.st_size if do_start_at_end else 0
+        else :
+            self._inode = None
+            self._offset = 0
+
+    def read_new_transitions(self) :
+        '''
+        Returns a list of (job_id, job_status_code, event_time) tuples, one for each job state change recorded since
+        the last call, in file order.
+        '''
+        if not os.path.exists(self._file_name) :
+            return []
+        result = []
+        stat_result = os.stat(self._file_name)
+        if self._inode is not None and stat_result.st_ino != self._inode :
+            # The file has been rotated.  Finish off the old one, if it's where we expect.
+            rotated_file_name = self._file_name + '.1'
+            if os.path.exists(rotated_file_name) and os.stat(rotated_file_name).st_ino == self._inode :
+                (transitions, _) = self._read_complete_lines(rotated_file_name, self._offset)
+                result.extend(transitions)
+            self._offset = 0
+        elif stat_result.st_size < self._offset :
+            # The file has been truncated
+            self._offset = 0
+        self._inode = stat_result.st_ino
+        (transitions, self._offset) = self._read_complete_lines(self._file_name, self._offset)
+        result.extend(transitions)
+        self._save_offset()
+        return result
+
+    def _read_complete_lines(self, file_name, offset) :
+        # Returns (transitions, new_offset), where new_offset is just past the last complete line.  Reads a chunk at a 
+        # time, carrying any partial line at the end of a chunk over to the next one.
+        transitions = []
+        new_offset = offset
+        partial_line = b''
+        with open(file_name, 'rb') as fid :
+            fid.seek(offset)
+            for chunk in iter(lambda : fid.read(self._read_chunk_byte_count), b'') :
+                data = partial_line + chunk
+                last_newline_index = data.rfind(b'\n')
+                if last_newline_index < 0 :
+                    partial_line = data
+                    continue
+                for line in data[:last_newline_index].decode('utf-8', errors='replace').split('\n') :
+                    transition = parse_lsf_event_record(line)
+                    if transition is not None :
+                        transitions.append(transition)
+                new_offset += last_newline_index + 1
+                partial_line = data[last_newline_index+1:]
+        return (transitions, new_offset)
+
+    def _save_offset(self) :
+        if self._offset_file_name is None :
+            return
+        write_file_atomically(self._offset_file_name, '%d %d\n' % (self._inode, self._offset))
+
+
+
+def _fake_event_record(event_type, event_time, job_id, jstatus) :
+    # Makes an lsb.events/lsb.acct-style record, for test_lsf_event_log()
+    if event_type == 'JOB_FINISH' :
+        # userId options numProcessors submitTime beginTime termTime startTime userName queue resReq dependCond preExecCmd 
+        # fromHost cwd inFile outFile errFile jobFile, then two host lists, then jStatus
+        fields = [ 1001, 0, 1, event_time-20, 0, 0, event_time-10, 'me', 'normal', '', '', '', 'login1', '/home/me', '', '', '', '',
+                   1, 'h01u01', 2, 'h01u01', 'h01u02', jstatus, 12.5 ]
+    elif event_type == 'JOB_NEW' :
+        fields = [ 1001, 0, 1 ]
+    else :
+        fields = [ jstatus, 4321, 4321, 1.0 ]
+    tokens = [ event_type, '10.1', event_time, job_id ] + fields
+    result = ' '.join([ ('"%s"' % token) if isinstance(token, str) else str(token) for token in tokens ]) + '\n'
+    return result
+
+
+
+def test_lsf_event_log() :
+    # Parses fake event records, and tails a locally-written fake event file through a partial line, a restart, and
+    # a rotation.  Run with "python -m tpt.lsf_event_log".
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    check(parse_lsf_event_record(_fake_event_record('JOB_NEW', 100, 7, 0)) == (7, 0, 100.0), 'JOB_NEW')
+    check(parse_lsf_event_record(_fake_event_record('JOB_START', 101, 7, JOB_STAT_RUN)) == (7, 0, 101.0), 'JOB_START')
+    check(parse_lsf_event_record(_fake_event_record('JOB_STATUS', 102, 7, JOB_STAT_DONE)) == (7, +1, 102.0), 'JOB_STATUS DONE')
+    check(parse_lsf_event_record(_fake_event_record('JOB_STATUS', 102, 8, JOB_STAT_EXIT)) == (8, -1, 102.0), 'JOB_STATUS EXIT')
+    check(parse_lsf_event_record(_fake_event_record('JOB_FINISH', 103, 9, JOB_STAT_DONE)) == (9, +1, 103.0), 'JOB_FINISH DONE')
+    check(parse_lsf_event_record(_fake_event_record('JOB_FINISH', 103, 10, JOB_STAT_EXIT)) == (10, -1, 103.0), 'JOB_FINISH EXIT')
+    check(parse_lsf_event_record('"MBD_START" "10.1" 100 "master" 1 2\n') is None, 'other record types should be ignored')
+    check(parse_lsf_event_record('"JOB_STATUS" "10.1" 100 "not a job id" 4\n') is None, 'malformed records should be ignored')
+    with tempfile.TemporaryDirectory() as folder_path :
+        file_name = os.path.join(folder_path, 'lsb.events')
+        offset_file_name = os.path.join(folder_path, 'offset')
+        with open(file_name, 'w') as fid :
+            fid.write(_fake_event_record('JOB_NEW', 100, 1, 0))
+            fid.write(_fake_event_record('JOB_START', 101, 1, JOB_STAT_RUN))
+        tailer = lsf_event_log_tailer_type(file_name, offset_file_name, do_start_at_end=False)
+        check(tailer.read_new_transitions() == [ (1, 0, 100.0), (1, 0, 101.0) ], 'reading from the start')
+        # A partial line is left for next time
+        record = _fake_event_record('JOB_STATUS', 102, 1, JOB_STAT_DONE)
+        with open(file_name, 'a') as fid :
+            fid.write(record[:10])
+        check(tailer.read_new_transitions() == [], 'a partial line should not be read')
+        with open(file_name, 'a') as fid :
+            fid.write(record[10:])
+        check(tailer.read_new_transitions() == [ (1, +1, 102.0) ], 'the completed line should be read')
+        # A restarted tailer picks up where the last one left off
+        with open(file_name, 'a') as fid :
+            fid.write(_fake_event_record('JOB_NEW', 103, 2, 0))
+        tailer = lsf_event_log_tailer_type(file_name, offset_file_name)
+        check(tailer.read_new_transitions() == [ (2, 0, 103.0) ], 'a restarted tailer should resume from the saved offset')
+        # Rotation: the rest of the old file is read from lsb.events.1 before the new file
+        with open(file_name, 'a') as fid :
+            fid.write(_fake_event_record('JOB_STATUS', 104, 2, JOB_STAT_EXIT))
+        os.rename(file_name, file_name + '.1')
+        with open(file_name, 'w') as fid :
+            fid.write(_fake_event_record('JOB_NEW', 105, 3, 0))
+        check(tailer.read_new_transitions() == [ (2, -1, 104.0), (3, 0, 105.0) ], 'rotation')
+        # Reading in chunks smaller than a record gives the same transitions, and leaves a partial line for next time
+        with open(file_name, 'a') as fid :
+            fid.write(_fake_event_record('JOB_START', 106, 3, JOB_STAT_RUN))
+            fid.write(_fake_event_record('JOB_FINISH', 107, 3, JOB_STAT_DONE))
+            fid.write(record[:10])
+        tailer = lsf_event_log_tailer_type(file_name, do_start_at_end=False, read_chunk_byte_count=7)
+        check(tailer.read_new_transitions() == [ (3, 0, 105.0), (3, 0, 106.0), (3, +1, 107.0) ], 'reading in small chunks')
+        with open(file_name, 'a') as fid :
+            fid.write(record[10:])
+        check(tailer.read_new_transitions() == [ (1, +1, 102.0) ], 'the line left over from reading in small chunks')
+    print('Test passed.')
+
+
+
+if __name__ == "__main__":
+    test_lsf_event_log()
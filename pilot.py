@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import math
+import uuid
+import random
+import shutil
+import tempfile
+import subprocess
+from tpt.utilities import *
+
+
+
+# Layout of a pilot folder, which must be on a filesystem that the conductor and all the workers can see:
+#   pending/<task index>.json              tasks waiting for a worker
+#   claimed/<task index>.<worker id>.json  tasks a worker has claimed (by renaming them out of pending/)
+#   results/<task index>.json              exit codes of finished tasks the conductor hasn't seen yet
+#   reported/<task index>.json             exit codes of finished tasks the conductor has seen
+#   heartbeats/<worker id>                 touched by each worker every time round its loop, and every so often while 
+#                                          it runs a task
+#   stop                                   if present, workers exit once their current task is done
+
+
+
+def _write_json_atomically(file_name, value) :
+    write_file_atomically(file_name, json.dumps(value))
+
+
+
+def _task_index_from_file_name(file_name) :
+    return int(file_name.split('.')[0])
+
+
+
+class pilot_pool_type :
+    '''
+    The conductor's side of pilot mode.  Instead of one LSF job per task, a pool of long-lived worker jobs is
+    submitted, each with worker_slot_count slots, and the workers pull tasks one at a time out of a task queue
+    in folder_path, run them, and report their exit codes.  This avoids paying scheduler dispatch latency for
+    every task, and balances uneven task durations automatically.
+
+    The pool grows (up to maximum_worker_count) when there are more unfinished tasks than live workers, and
+    shrinks by itself: a worker that finds no work for idle_timeout seconds exits.  Tasks claimed by a worker
+    whose heartbeat is more than heartbeat_timeout seconds old go back in the queue.
+
+    If do_actually_submit is false, the workers are started as local processes, which is handy for testing.
+
+    Anything left in folder_path by an earlier pool is cleared out.  Each task also carries the id of the pool that
+    queued it, and results for other pools' tasks (e.g. from a straggling worker of an earlier pool) are ignored.
+    '''
+    def __init__(self,
+                 folder_path,
+                 do_actually_submit=True,
+                 maximum_worker_count=10,
+                 worker_slot_count=1,
+                 worker_bsub_options_as_list=[],
+                 worker_stdouterr_file_name='/dev/null',
+                 idle_timeout=60,
+                 heartbeat_timeout=300) :
+        self._folder_path = os.path.abspath(folder_path)
+        self._do_actually_submit = do_actually_submit
+        self._maximum_worker_count = maximum_worker_count
+        self._worker_slot_count = worker_slot_count
+        self._worker_bsub_options_as_list = worker_bsub_options_as_list
+        self._worker_stdouterr_file_name = worker_stdouterr_file_name
+        self._idle_timeout = idle_timeout
+        self._heartbeat_timeout = heartbeat_timeout
+        self._job_id_or_process_from_worker_id = {}
+        self._has_been_reported_from_task_index = {}
+        self._pool_id = uuid.uuid4().hex[:12]
+        for subfolder_name in ['pending', 'claimed', 'results', 'reported', 'heartbeats'] :
+            subfolder_path = os.path.join(self._folder_path, subfolder_name)
+            if os.path.exists(subfolder_path) :
+                shutil.rmtree(subfolder_path)
+            os.makedirs(subfolder_path)
+        stop_file_name = os.path.join(self._folder_path, 'stop')
+        if os.path.exists(stop_file_name) :
+            os.remove(stop_file_name)
+
+    def add_task(self, task_index, command_line_as_list, stdouterr_file_name) :
+        task = { 'command_line': command_line_as_list, 'stdouterr_file_name': stdouterr_file_name, 'pool_id': self._pool_id }
+        _write_json_atomically(os.path.join(self._folder_path, 'pending', '%d.json' % task_index), task)
+        self._has_been_reported_from_task_index[task_index] = False
+
+    def get_new_results(self) :
+        '''
+        Returns a list of (task_index, exit_code) pairs for the tasks that have finished since the last call.
+        Also puts tasks claimed by dead workers back in the queue.
+        '''
+        result = []
+        for entry in os.scandir(os.path.join(self._folder_path, 'results')) :
+            if not entry.name.endswith('.json') :
+                continue
+            task_index = _task_index_from_file_name(entry.name)
+            if self._has_been_reported_from_task_index.get(task_index, True) :
+                continue
+            with open(entry.path, 'r') as fid :
+                task_result = json.load(fid)
+            if task_result.get('pool_id') != self._pool_id :
+                os.remove(entry.path)   # left over from some other pool
+                continue
+            exit_code = task_result['exit_code']
+            result.append( (task_index, exit_code) )
+            self._has_been_reported_from_task_index[task_index] = True
+            # Move it out of the way, so the next scan only sees new results
+            os.replace(entry.path, os.path.join(self._folder_path, 'reported', entry.name))
+        self._requeue_tasks_of_dead_workers()
+        return result
+
+    def _requeue_tasks_of_dead_workers(self) :
+        now = time.time()
+        heartbeats_folder_path = os.path.join(self._folder_path, 'heartbeats')
+        for entry in os.scandir(os.path.join(self._folder_path, 'claimed')) :
+            (task_index_as_string, worker_id, _) = entry.name.split('.')
+            try :
+                last_heartbeat_time = os.path.getmtime(os.path.join(heartbeats_folder_path, worker_id))
+            except FileNotFoundError :
+                last_heartbeat_time = -math.inf
+            if now - last_heartbeat_time > self._heartbeat_timeout :
+                try :
+                    os.rename(entry.path, os.path.join(self._folder_path, 'pending', '%s.json' % task_index_as_string))
+                except FileNotFoundError :
+                    pass   # the worker finished it after all
+
+    def worker_count(self) :
+        # The number of workers started that haven't yet been seen to exit, without calling LSF
+        return len(self._job_id_or_process_from_worker_id)
+
+    def live_worker_count(self) :
+        # Counts the workers that are pending, starting, or running
+        worker_ids = list(self._job_id_or_process_from_worker_id.keys())
+        if self._do_actually_submit :
+            from tpt.fuster import get_bsub_job_status
+            job_ids = [ self._job_id_or_process_from_worker_id[worker_id] for worker_id in worker_ids ]
+            is_live_from_worker_index = [ status==0 for status in get_bsub_job_status(job_ids) ]
+        else :
+            is_live_from_worker_index = [ (self._job_id_or_process_from_worker_id[worker_id].poll() is None) for worker_id in worker_ids ]
+        for (worker_id, is_live) in zip(worker_ids, is_live_from_worker_index) :
+            if not is_live :
+                del self._job_id_or_process_from_worker_id[worker_id]
+        return sum(is_live_from_worker_index)
+
+    def scale(self, unfinished_task_count) :
+        # Starts enough new workers that there's one per unfinished task, up to maximum_worker_count.
+        # Returns the number of workers started.
+        target_worker_count = min(self._maximum_worker_count, unfinished_task_count)
+        new_worker_count = max(0, target_worker_count - self.live_worker_count())
+        for _ in range(new_worker_count) :
+            self._start_worker()
+        return new_worker_count
+
+    def _start_worker(self) :
+        worker_id = uuid.uuid4().hex[:12]
+        # Workers touch their heartbeat several times per heartbeat_timeout, even while running a long task
+        heartbeat_interval = self._heartbeat_timeout / 4
+        command_line_as_list = [ sys.executable, '-m', 'tpt.pilot', self._folder_path, worker_id, str(self._idle_timeout), str(heartbeat_interval) ]
+        if self._do_actually_submit :
+            from tpt.fuster import bsub
+            job_id = bsub(command_line_as_list, True, self._worker_slot_count, self._worker_stdouterr_file_name, self._worker_bsub_options_as_list)
+            self._job_id_or_process_from_worker_id[worker_id] = job_id
+        else :
+            process = subprocess.Popen(command_line_as_list, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._job_id_or_process_from_worker_id[worker_id] = process
+
+    def shut_down(self, do_kill_workers=False) :
+        # Tells the workers to exit once their current task is done.  If do_kill_workers is true, kills them right away.
+        open(os.path.join(self._folder_path, 'stop'), 'w').close()
+        if do_kill_workers :
+            if self._do_actually_submit :
+                from tpt.fuster import bkill
+                bkill(list(self._job_id_or_process_from_worker_id.values()))
+            else :
+                for process in self._job_id_or_process_from_worker_id.values() :
+                    process.kill()
+        elif not self._do_actually_submit :
+            for process in self._job_id_or_process_from_worker_id.values() :
+                process.wait()
+
+
+
+def _claim_task(folder_path, worker_id, candidate_file_names) :
+    # Tries to claim one of the candidates, by renaming it into claimed/.  Returns (task_index, claimed_file_name), or None.
+    # candidate_file_names is consumed as we go.
+    while isladen(candidate_file_names) :
+        file_name = candidate_file_names.pop()
+        task_index = _task_index_from_file_name(file_name)
+        claimed_file_name = os.path.join(folder_path, 'claimed', '%d.%s.json' % (task_index, worker_id))
+        try :
+            os.rename(os.path.join(folder_path, 'pending', file_name), claimed_file_name)   # atomic, so only one worker wins
+        except FileNotFoundError :
+            continue   # another worker got it first
+        return (task_index, claimed_file_name)
+    return None
+
+
+
+def _touch(file_name) :
+    with open(file_name, 'w') :
+        pass   # opening for writing updates the mtime
+
+
+
+def _run_task(task, heartbeat_file_name, heartbeat_interval) :
+    # Runs the task, touching the heartbeat file every heartbeat_interval seconds while it runs.  Returns the exit code.
+    stdouterr_file_name = task['stdouterr_file_name']
+    if (stdouterr_file_name is None) or len(stdouterr_file_name)==0 :
+        stdouterr_file_name = '/dev/null'
+    with open(stdouterr_file_name, 'w') as log_fid :
+        try :
+            process = subprocess.Popen(task['command_line'], stdout=log_fid, stderr=subprocess.STDOUT)
+        except OSError as e :
+            log_fid.write('Unable to run task: %s\n' % str(e))
+            return 127
+        while True :
+            try :
+                return process.wait(timeout=heartbeat_interval)
+            except subprocess.TimeoutExpired :
+                _touch(heartbeat_file_name)
+
+
+
+def run_pilot_worker(folder_path, worker_id, idle_timeout, heartbeat_interval=60) :
+    '''
+    The worker's side of pilot mode.  Repeatedly claims a task from folder_path, runs it, and writes its exit code,
+    until there's a stop file, or no work has turned up for idle_timeout seconds.  The worker's heartbeat is touched 
+    every time round the loop, and every heartbeat_interval seconds while a task is running.
+    '''
+    heartbeat_file_name = os.path.join(folder_path, 'heartbeats', worker_id)
+    stop_file_name = os.path.join(folder_path, 'stop')
+    candidate_file_names = []
+    idle_tic_id = tic()
+    while not os.path.exists(stop_file_name) :
+        _touch(heartbeat_file_name)
+        if isempty(candidate_file_names) :
+            # Shuffle, so that workers don't all fight over the same tasks
+            candidate_file_names = [ entry.name for entry in os.scandir(os.path.join(folder_path, 'pending')) if entry.name.endswith('.json') ]
+            random.shuffle(candidate_file_names)
+        claim = _claim_task(folder_path, worker_id, candidate_file_names)
+        if claim is None :
+            if toc(idle_tic_id) > idle_timeout :
+                break
+            time.sleep(1)
+            continue
+        (task_index, claimed_file_name) = claim
+        try :
+            with open(claimed_file_name, 'r') as fid :
+                task = json.load(fid)
+        except FileNotFoundError :
+            continue   # the conductor took it back in the meantime
+        task_tic_id = tic()
+        exit_code = _run_task(task, heartbeat_file_name, heartbeat_interval)
+        _write_json_atomically(os.path.join(folder_path, 'results', '%d.json' % task_index),
+                               { 'exit_code': exit_code, 'worker_id': worker_id, 'run_time': toc(task_tic_id), 'pool_id': task.get('pool_id') })
+        try :
+            os.remove(claimed_file_name)
+        except FileNotFoundError :
+            pass   # the conductor thought we were dead, and took it back
+        idle_tic_id = tic()
+    if os.path.exists(heartbeat_file_name) :
+        os.remove(heartbeat_file_name)
+
+
+
+def test_pilot_pool() :
+    # Runs a small pool of local workers, including a task that outlasts the heartbeat timeout, in a folder with 
+    # leftovers from an earlier run.  Run with "python -c 'import tpt.pilot; tpt.pilot.test_pilot_pool()'".
+    with tempfile.TemporaryDirectory() as scratch_folder_path :
+        folder_path = os.path.join(scratch_folder_path, 'pilot')
+        run_log_file_name = os.path.join(scratch_folder_path, 'runs.txt')
+        def appender_command_line(label, sleep_time, exit_code) :
+            code = 'import time, sys; open(%r, "a").write(%r + "\\n"); time.sleep(%g); sys.exit(%d)' % (run_log_file_name, label, sleep_time, exit_code)
+            return [ sys.executable, '-c', code ]
+        # Leftovers from an earlier run, which should be neither run nor reported
+        for subfolder_name in ['pending', 'results'] :
+            os.makedirs(os.path.join(folder_path, subfolder_name))
+        _write_json_atomically(os.path.join(folder_path, 'pending', '99.json'), 
+                               { 'command_line': appender_command_line('stale', 0, 0), 'stdouterr_file_name': '' })
+        _write_json_atomically(os.path.join(folder_path, 'results', '1.json'), { 'exit_code': 0 })
+        pool = pilot_pool_type(folder_path, do_actually_submit=False, maximum_worker_count=2, idle_timeout=5, heartbeat_timeout=2)
+        expected_exit_code_from_task_index = { 0:0, 1:1, 2:0, 3:0 }
+        pool.add_task(0, appender_command_line('long', 5, 0), '')   # longer than the heartbeat timeout
+        for task_index in [1, 2, 3] :
+            pool.add_task(task_index, appender_command_line('short-%d' % task_index, 0, expected_exit_code_from_task_index[task_index]), '')
+        exit_code_from_task_index = {}
+        tic_id = tic()
+        while len(exit_code_from_task_index) < 4 and toc(tic_id) < 60 :
+            for (task_index, exit_code) in pool.get_new_results() :
+                exit_code_from_task_index[task_index] = exit_code
+            pool.scale(4 - len(exit_code_from_task_index))
+            time.sleep(0.5)
+        pool.shut_down()
+        with open(run_log_file_name, 'r') as fid :
+            labels = fid.read().split()
+    if exit_code_from_task_index != expected_exit_code_from_task_index :
+        raise RuntimeError('Test failed: got exit codes %s, expected %s' % (exit_code_from_task_index, expected_exit_code_from_task_index))
+    if sorted(labels) != ['long', 'short-1', 'short-2', 'short-3'] :
+        raise RuntimeError('Test failed: each task should have run once, and no stale tasks, but the runs were %s' % labels)
+    print('Test passed.')
+
+
+
+if __name__ == "__main__":
+    # Usage: python -m tpt.pilot <pilot folder> <worker id> <idle timeout in seconds> [<heartbeat interval in seconds>]
+    run_pilot_worker(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]) if len(sys.argv)>4 else 60)
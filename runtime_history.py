@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import heapq
+import random
+import statistics
+import fcntl
+from tpt.utilities import *
+
+
+
+def input_size_bucket(input_byte_count) :
+    # Jobs whose total input sizes are within a factor of sqrt(2) or so of each other share a bucket.
+    # Jobs with no (or missing) inputs go in bucket '-'.
+    if math.isnan(input_byte_count) or input_byte_count <= 0 :
+        result = '-'
+    else :
+        result = '%d' % math.floor(2*math.log2(input_byte_count))
+    return result
+
+
+
+class runtime_history_type :
+    '''
+    A small persistent record of how long jobs have taken to run, keyed by command template (see
+    command_template_from_command_line()) and total input size, used to predict how long new jobs will take.
+
+    For each (template, input size bucket) it keeps the number of runs seen, and running means of the run time and
+    of the input byte count.  The means are plain means for the first few runs, then exponentially-weighted with
+    weight smoothing, so they follow drift.  If there's no history for a job's own bucket, the nearest bucket of the
+    same template is used, with the run time scaled in proportion to input size.
+
+    The history is loaded from file_name (if it exists), and written back by save().  Several sweeps can share a 
+    history file: save() re-reads the file under a lock, and replays the runs recorded since the last save on top of 
+    it, so no sweep's runs get lost.
+    '''
+    def __init__(self, file_name=None, smoothing=0.3) :
+        self._file_name = file_name
+        self._smoothing = smoothing
+        self._entry_from_bucket_from_template = self._load()
+        self._unsaved_runs = []   # (command_template, input_byte_count, run_time) of the runs recorded since the last save()
+
+    def _load(self) :
+        if (self._file_name is not None) and os.path.exists(self._file_name) :
+            with open(self._file_name, 'r') as fid :
+                result = json.load(fid)
+        else :
+            result = {}
+        return result
+
+    def record_run_time(self, command_template, input_byte_count, run_time) :
+        self._apply_run_time(command_template, input_byte_count, run_time)
+        self._unsaved_runs.append( (command_template, input_byte_count, run_time) )
+
+    def _apply_run_time(self, command_template, input_byte_count, run_time) :
+        entry_from_bucket = self._entry_from_bucket_from_template.setdefault(command_template, {})
+        bucket = input_size_bucket(input_byte_count)
+        (count, mean_run_time, mean_input_byte_count) = entry_from_bucket.get(bucket, [0, 0.0, 0.0])
+        weight = max(self._smoothing, 1.0/(count+1))
+        mean_run_time = mean_run_time + weight * (run_time - mean_run_time)
+        if not math.isnan(input_byte_count) :
+            mean_input_byte_count = mean_input_byte_count + weight * (input_byte_count - mean_input_byte_count)
+        entry_from_bucket[bucket] = [count+1, mean_run_time, mean_input_byte_count]
+
+    def predict_run_time(self, command_template, input_byte_count) :
+        # Returns the predicted run time in seconds, or nan if there's no history for the command template
+        entry_from_bucket = self._entry_from_bucket_from_template.get(command_template)
+        if entry_from_bucket is None or isempty(entry_from_bucket) :
+            return math.nan
+        bucket = input_size_bucket(input_byte_count)
+        if bucket in entry_from_bucket :
+            return entry_from_bucket[bucket][1]
+        sized_buckets = [ other_bucket for other_bucket in entry_from_bucket.keys() if other_bucket != '-' ]
+        if bucket == '-' or isempty(sized_buckets) :
+            # Nothing to scale with, so just use the typical run time for the template
+            return statistics.median([ entry[1] for entry in entry_from_bucket.values() ])
+        nearest_bucket = min(sized_buckets, key=lambda other_bucket : abs(int(other_bucket) - int(bucket)))
+        (_, mean_run_time, mean_input_byte_count) = entry_from_bucket[nearest_bucket]
+        result = mean_run_time * input_byte_count / mean_input_byte_count
+        return result
+
+    def save(self) :
+        if self._file_name is None :
+            return
+        # Hold the lock from re-reading the file to writing it, so two sweeps saving at once don't drop each other's runs
+        lock_fd = os.open(self._file_name + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+        try :
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX)
+            self._entry_from_bucket_from_template = self._load()
+            for (command_template, input_byte_count, run_time) in self._unsaved_runs :
+                self._apply_run_time(command_template, input_byte_count, run_time)
+            write_file_atomically(self._file_name, json.dumps(self._entry_from_bucket_from_template))
+            self._unsaved_runs = []
+        finally :
+            os.close(lock_fd)   # releases the lock
+
+
+
+def longest_predicted_first_order(predicted_run_time_from_job_index) :
+    '''
+    Returns the job indices ordered longest-predicted-first (LPT).  Jobs with no prediction (nan) are treated as
+    taking the median of the predicted times, and ties keep enqueue order, so with no predictions at all the result
+    is just enqueue order.
+    '''
+    job_count = len(predicted_run_time_from_job_index)
+    known_run_times = [ run_time for run_time in predicted_run_time_from_job_index if not math.isnan(run_time) ]
+    if isempty(known_run_times) :
+        return list(range(job_count))
+    typical_run_time = statistics.median(known_run_times)
+    key_from_job_index = [ (typical_run_time if math.isnan(run_time) else run_time) for run_time in predicted_run_time_from_job_index ]
+    result = sorted(range(job_count), key=lambda job_index : -key_from_job_index[job_index])
+    return result
+
+
+
+def simulate_makespan(run_time_from_job_index, slot_count_from_job_index, maximum_slot_count, job_index_from_order_index=None) :
+    '''
+    Simulates running the jobs with at most maximum_slot_count slots in use at once, submitting in the given order
+    (enqueue order by default) the same way bqueue_type does: whenever slots free up, jobs are considered in order,
+    and any job that fits is started, skipping over those that don't.  Returns the makespan, i.e. the time at
+    which the last job finishes.
+    '''
+    if job_index_from_order_index is None :
+        job_index_from_order_index = list(range(len(run_time_from_job_index)))
+    pending_job_indices = list(job_index_from_order_index)
+    finish_time_heap = []   # (finish_time, slot_count) of running jobs
+    now = 0.0
+    free_slot_count = maximum_slot_count
+    while isladen(pending_job_indices) or isladen(finish_time_heap) :
+        still_pending_job_indices = []
+        for job_index in pending_job_indices :
+            slot_count = slot_count_from_job_index[job_index]
+            if free_slot_count > 0 and slot_count <= free_slot_count :
+                heapq.heappush(finish_time_heap, (now + run_time_from_job_index[job_index], slot_count))
+                free_slot_count -= slot_count
+            else :
+                still_pending_job_indices.append(job_index)
+        pending_job_indices = still_pending_job_indices
+        if isempty(finish_time_heap) :
+            raise RuntimeError('Some jobs need more than maximum_slot_count slots')
+        # Advance to the next finish time, and free up the slots of every job that finishes then
+        (now, slot_count) = heapq.heappop(finish_time_heap)
+        free_slot_count += slot_count
+        while isladen(finish_time_heap) and finish_time_heap[0][0] <= now :
+            free_slot_count += heapq.heappop(finish_time_heap)[1]
+    return now
+
+
+
+def benchmark_longest_predicted_first(run_time_from_job_index, predicted_run_time_from_job_index, slot_count_from_job_index, maximum_slot_count) :
+    '''
+    Simulates a sweep in enqueue order and in longest-predicted-first order, and returns a dict with both makespans,
+    the fractional makespan gain of LPT over enqueue order, and the lower bound on the makespan (the larger of the
+    longest job and the total slot-seconds divided by maximum_slot_count).
+    '''
+    enqueue_order_makespan = simulate_makespan(run_time_from_job_index, slot_count_from_job_index, maximum_slot_count)
+    lpt_makespan = simulate_makespan(run_time_from_job_index, slot_count_from_job_index, maximum_slot_count,
+                                     longest_predicted_first_order(predicted_run_time_from_job_index))
+    total_slot_seconds = sum([ run_time*slot_count for (run_time, slot_count) in zip(run_time_from_job_index, slot_count_from_job_index) ])
+    result = { 'enqueue_order_makespan': enqueue_order_makespan,
+               'lpt_makespan': lpt_makespan,
+               'makespan_gain': (enqueue_order_makespan - lpt_makespan) / enqueue_order_makespan,
+               'makespan_lower_bound': max(max(run_time_from_job_index), total_slot_seconds/maximum_slot_count) }
+    return result
+
+
+
+def main(argv) :
+    # Usage: python -m tpt.runtime_history [job count] [maximum slot count] [prediction error]
+    # Benchmarks LPT ordering on a synthetic sweep with heavy-tailed run times, where the predictions are off by a
+    # random factor of about exp(prediction error).  Reports the makespan gain for the run times in random order, and in
+    # the worst case for enqueue order, where the longest jobs come last.
+    job_count = int(argv[0]) if len(argv)>0 else 1000
+    maximum_slot_count = int(argv[1]) if len(argv)>1 else 50
+    prediction_error = float(argv[2]) if len(argv)>2 else 0.3
+    random_number_generator = random.Random(0)
+    run_time_from_job_index = [ 60*random_number_generator.lognormvariate(0, 1) for _ in range(job_count) ]
+    slot_count_from_job_index = [1] * job_count
+    for (description, run_times) in [ ('random order', run_time_from_job_index), ('longest last', sorted(run_time_from_job_index)) ] :
+        predicted_run_times = [ run_time*math.exp(random_number_generator.gauss(0, prediction_error)) for run_time in run_times ]
+        result = benchmark_longest_predicted_first(run_times, predicted_run_times, slot_count_from_job_index, maximum_slot_count)
+        printf('%s: enqueue-order makespan %.0f s, LPT makespan %.0f s (lower bound %.0f s), gain %.1f%%\n' %
+               (description, result['enqueue_order_makespan'], result['lpt_makespan'], result['makespan_lower_bound'], 100*result['makespan_gain']))
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+import os
+import json
+import math
+import time
+import socket
+import sqlite3
+import uuid
+import threading
+import shutil
+import tempfile
+import multiprocessing
+from tpt.utilities import *
+from tpt.fuster import *
+
+
+
+class shared_bqueue_type :
+    '''
+    A bqueue_type whose job table lives in an SQLite file, so that several
+    "conductor" processes can work through the same set of jobs.
+
+    Every process that calls run() on the same file is one conductor.  Each
+    conductor repeatedly claims a batch of pending jobs (atomically, inside an
+    IMMEDIATE transaction), submits them, and polls the ones it owns.  Each
+    conductor also writes a heartbeat into the table, from a background thread,
+    several times per lease_duration, so the lease holds even while a long batch
+    is being submitted.  If a conductor's heartbeat is older than
+    lease_duration, the other conductors release its jobs: unsubmitted ones go
+    back to pending, and submitted ones get tracked by whichever conductor
+    claims them next.  A conductor only writes to jobs it still owns, and
+    records each job id as soon as the job is submitted.
+
+    The resource budgets (maximum_running_slot_count, etc.) are global: they are
+    stored in the table when the table is created, and they cap the totals over
+    all conductors.  As for bqueue_type, maximum_running_slot_minutes caps the
+    total of slot count times run-time limit, and enqueue() rejects a job that
+    needs more than a whole budget on its own.
+
+    SQLite's WAL mode needs shared memory, so it only works when all the
+    conductors are on the same host.  For conductors on different login nodes,
+    use journal_mode='DELETE', which relies on fcntl() locks on the shared
+    filesystem instead.
+
+    If a conductor dies between calling bsub and recording the job id, that job
+    will be submitted a second time by whichever conductor takes over.  If bsub
+    times out, the job is marked as errored out rather than resubmitted, since
+    it may have been submitted anyway.
+
+    As in bqueue_type, if LSF commands fail lsf_failure_threshold times in a
+    row, a conductor stops calling LSF for lsf_circuit_reset_timeout seconds,
+    rather than giving up on the run.
+    '''
+
+    def __init__(self,
+                 file_name,
+                 do_actually_submit=True,
+                 maximum_running_slot_count=math.inf,
+                 maximum_running_memory_in_mb=math.inf,
+                 maximum_running_slot_minutes=math.inf,
+                 batch_size=1000,
+                 lease_duration=300,
+                 journal_mode='WAL',
+                 lsf_failure_threshold=3,
+                 lsf_circuit_reset_timeout=30) :
+        self._file_name = file_name
+        self._do_actually_submit = do_actually_submit
+        self._batch_size = batch_size
+        self._lease_duration = lease_duration
+        self._lsf_circuit_breaker = circuit_breaker_type(lsf_failure_threshold, lsf_circuit_reset_timeout)
+        self._conductor_id = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._connection = sqlite3.connect(file_name, timeout=60, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=%s' % journal_mode)
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction() as cursor :
+            cursor.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                           '  job_index INTEGER PRIMARY KEY, '
+                           '  slot_count INTEGER NOT NULL, '
+                           '  memory_in_mb REAL NOT NULL, '
+                           '  walltime_in_minutes REAL NOT NULL, '
+                           '  stdouterr_file_name TEXT, '
+                           '  bsub_options TEXT NOT NULL, '
+                           '  command_line TEXT NOT NULL, '
+                           '  job_id INTEGER, '
+                           '  status INTEGER, '
+                           '  owner TEXT)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS jobs_by_owner_and_status ON jobs (owner, status)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS conductors ('
+                           '  conductor_id TEXT PRIMARY KEY, '
+                           '  heartbeat_time REAL NOT NULL)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS settings ('
+                           '  key TEXT PRIMARY KEY, '
+                           '  value TEXT NOT NULL)')
+            # The first process to create the table gets to set the resource budgets
+            maximum_resources = (maximum_running_slot_count, maximum_running_memory_in_mb, maximum_running_slot_minutes)
+            cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)',
+                           ('maximum_resources', json.dumps([ (value if math.isfinite(value) else None) for value in maximum_resources ])))
+
+    def _transaction(self) :
+        return _sqlite_immediate_transaction(self._connection)
+
+    def maximum_resources(self) :
+        # Returns the (slot_count, memory_in_mb, slot_minutes) budget shared by all conductors
+        row = self._connection.execute('SELECT value FROM settings WHERE key = ?', ('maximum_resources',)).fetchone()
+        result = [ (math.inf if value is None else value) for value in json.loads(row[0]) ]
+        return result
+
+    def close(self) :
+        # Closes the connection to the job table.  Call this before forking (e.g. with multiprocessing), since an SQLite 
+        # connection that is open across a fork() can corrupt the table.
+        self._connection.close()
+
+    def queue_length(self) :
+        row = self._connection.execute('SELECT COUNT(*) FROM jobs').fetchone()
+        return row[0]
+
+    def enqueue(self, slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list, memory_in_mb=None, walltime_in_minutes=None) :
+        self.enqueue_many([ (slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list, memory_in_mb, walltime_in_minutes) ])
+
+    def enqueue_many(self, job_specs) :
+        '''
+        Like enqueue(), but takes an iterable of (slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list)
+        tuples, and adds them all in a single transaction.  Much faster than calling enqueue() repeatedly for big sweeps.
+        Each tuple can optionally have memory_in_mb and walltime_in_minutes on the end.
+        '''
+        maximum_resources = self.maximum_resources()
+        with self._transaction() as cursor :
+            cursor.executemany('INSERT INTO jobs (slot_count, memory_in_mb, walltime_in_minutes, stdouterr_file_name, bsub_options, command_line) '
+                               '  VALUES (?, ?, ?, ?, ?, ?)',
+                               map(lambda job_spec : _row_from_job_spec(job_spec, maximum_resources), job_specs))
+
+    def job_status_from_job_index(self) :
+        # Same encoding as bqueue_type.run(): {-1,0,+1,math.nan}
+        rows = self._connection.execute('SELECT status FROM jobs ORDER BY job_index').fetchall()
+        result = [ (math.nan if row[0] is None else row[0]) for row in rows ]
+        return result
+
+    def _heartbeat_and_release_dead_conductors(self, cursor) :
+        now = time.time()
+        cursor.execute('INSERT OR REPLACE INTO conductors (conductor_id, heartbeat_time) VALUES (?, ?)', (self._conductor_id, now))
+        dead_conductor_ids = [ row[0] for row in
+                               cursor.execute('SELECT conductor_id FROM conductors WHERE heartbeat_time < ?', (now - self._lease_duration,)) ]
+        for dead_conductor_id in dead_conductor_ids :
+            cursor.execute('UPDATE jobs SET owner = NULL WHERE owner = ?', (dead_conductor_id,))
+            cursor.execute('DELETE FROM conductors WHERE conductor_id = ?', (dead_conductor_id,))
+
+    def _renew_lease_until_stopped(self, stop_event) :
+        # Runs on a background thread, with its own connection, since SQLite connections can't be shared between threads.
+        # Only updates an existing heartbeat.  If we were declared dead in the meantime, _claim_batch() signs us up again.
+        connection = sqlite3.connect(self._file_name, timeout=60, isolation_level=None)
+        try :
+            while not stop_event.wait(self._lease_duration / 4) :
+                connection.execute('UPDATE conductors SET heartbeat_time = ? WHERE conductor_id = ?', (time.time(), self._conductor_id))
+        finally :
+            connection.close()
+
+    def _claim_batch(self) :
+        '''
+        Atomically claims a batch of jobs for this conductor.  Adopts in-progress jobs that have no owner (because
+        their conductor died), and claims as many pending jobs as fit in what's left of the global resource budgets.
+        Returns the list of (job_index, slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list)
+        tuples for the pending jobs that this conductor should now submit.
+        '''
+        maximum_resources = self.maximum_resources()
+        with self._transaction() as cursor :
+            self._heartbeat_and_release_dead_conductors(cursor)
+            cursor.execute('UPDATE jobs SET owner = ? WHERE job_index IN '
+                           '  (SELECT job_index FROM jobs WHERE owner IS NULL AND status = 0 LIMIT ?)',
+                           (self._conductor_id, self._batch_size))
+            # Resources that are in use, or that some conductor has claimed but not yet submitted
+            committed_resources = \
+                cursor.execute('SELECT COALESCE(SUM(slot_count), 0), COALESCE(SUM(memory_in_mb), 0), COALESCE(SUM(slot_count*walltime_in_minutes), 0) FROM jobs '
+                               '  WHERE status = 0 OR (status IS NULL AND owner IS NOT NULL)').fetchone()
+            maximum_new_resources = [ (maximum - committed) for (maximum, committed) in zip(maximum_resources, committed_resources) ]
+            if any([ (maximum_new <= 0) for maximum_new in maximum_new_resources ]) :
+                return []
+            rows = cursor.execute('SELECT job_index, slot_count, stdouterr_file_name, bsub_options, command_line, memory_in_mb, walltime_in_minutes FROM jobs '
+                                  '  WHERE owner IS NULL AND status IS NULL ORDER BY job_index LIMIT ?',
+                                  (self._batch_size,)).fetchall()
+            resources_from_submittable_index = [ budgeted_resources((row[1], row[5], row[6])) for row in rows ]
+            will_submit_from_submittable_index = determine_which_jobs_to_submit_given_resources(resources_from_submittable_index, maximum_new_resources)
+            claimed_rows = ibb(rows, will_submit_from_submittable_index)
+            cursor.executemany('UPDATE jobs SET owner = ? WHERE job_index = ?',
+                               [ (self._conductor_id, row[0]) for row in claimed_rows ])
+        result = [ (row[0], row[1], row[2], json.loads(row[3]), json.loads(row[4])) for row in claimed_rows ]
+        return result
+
+    def _does_own_job(self, job_index) :
+        row = self._connection.execute('SELECT owner FROM jobs WHERE job_index = ?', (job_index,)).fetchone()
+        return (row[0] == self._conductor_id)
+
+    def _submit_claimed_jobs(self, claimed_jobs) :
+        # Submits the claimed jobs one at a time, recording each job id as soon as we have it.  Stops early if we lose 
+        # ownership of a job (because our lease ran out), or if LSF is having problems, in which case the rest of the 
+        # batch goes back to pending for the next claim.
+        for (claimed_index, claimed_job) in enumerate(claimed_jobs) :
+            (job_index, slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list) = claimed_job
+            if not self._does_own_job(job_index) :
+                break
+            try :
+                job_id = bsub(command_line_as_list,
+                              self._do_actually_submit,
+                              slot_count,
+                              stdouterr_file_name,
+                              bsub_options_as_list)
+            except lsf_submit_timeout_error as e :
+                printfe('Giving up on job %d, because bsub timed out.  It may have been submitted anyway.\n%s\n' % (job_index, str(e)))
+                self._lsf_circuit_breaker.record_failure()
+                self._record_submission(job_index, None, -1)
+                self._release_jobs(claimed_jobs[claimed_index+1:])
+                break
+            except lsf_unavailable_error as e :
+                printfe('Unable to submit job %d, will try again later.\n%s\n' % (job_index, str(e)))
+                self._lsf_circuit_breaker.record_failure()
+                self._release_jobs(claimed_jobs[claimed_index:])
+                break
+            if self._do_actually_submit :
+                self._lsf_circuit_breaker.record_success()
+                job_status = 0
+            else :
+                # The job was run locally, and has already either succeeded or failed
+                job_status = +1 if job_id == -1 else -1
+            self._record_submission(job_index, job_id, job_status)
+
+    def _record_submission(self, job_index, job_id, job_status) :
+        with self._transaction() as cursor :
+            cursor.execute('UPDATE jobs SET job_id = ?, status = ? WHERE job_index = ? AND owner = ?',
+                           (job_id, job_status, job_index, self._conductor_id))
+
+    def _release_jobs(self, claimed_jobs) :
+        # Hands unsubmitted claimed jobs back, so they can be claimed again
+        with self._transaction() as cursor :
+            cursor.executemany('UPDATE jobs SET owner = NULL WHERE job_index = ? AND owner = ? AND status IS NULL',
+                               [ (claimed_job[0], self._conductor_id) for claimed_job in claimed_jobs ])
+
+    def _update_owned_job_statuses(self) :
+        # Polls LSF for the in-progress jobs we own.  Returns true if it called LSF.
+        rows = self._connection.execute('SELECT job_index, job_id FROM jobs WHERE owner = ? AND status = 0',
+                                        (self._conductor_id,)).fetchall()
+        if isempty(rows) :
+            return False
+        job_id_from_owned_index = [ row[1] for row in rows ]
+        job_status_from_owned_index = get_bsub_job_status(job_id_from_owned_index)
+        # Only write back jobs that have changed, and only if we still own them
+        with self._transaction() as cursor :
+            cursor.executemany('UPDATE jobs SET status = ? WHERE job_index = ? AND owner = ?',
+                               [ (job_status, row[0], self._conductor_id)
+                                 for (row, job_status) in zip(rows, job_status_from_owned_index) if job_status != 0 ])
+        return self._do_actually_submit
+
+    def lsf_health_metrics(self) :
+        # Returns a dict with the state of the LSF circuit breaker, the number of LSF failures seen, and the number of times it has opened
+        return self._lsf_circuit_breaker.metrics()
+
+    def _exited_and_total_job_counts(self) :
+        (exited_job_count, job_count) = \
+            self._connection.execute('SELECT COALESCE(SUM(status = 1 OR status = -1), 0), COUNT(*) FROM jobs').fetchone()
+        return (exited_job_count, job_count)
+
+    def run(self, maximum_wait_time=math.inf, do_show_progress_bar=True) :
+        # Returns the job statuses of all jobs in the table, with the same encoding as bqueue_type.run().
+        # Returns when all the jobs in the table have exited, whichever conductor ran them.
+        (exited_job_count, job_count) = self._exited_and_total_job_counts()
+        if do_show_progress_bar :
+            progress_bar = progress_bar_object(job_count)
+            progress_bar.update(exited_job_count)
+        have_all_exited = (exited_job_count == job_count)
+        is_time_up = False
+        ticId = tic()
+        with self._transaction() as cursor :
+            self._heartbeat_and_release_dead_conductors(cursor)
+        stop_lease_renewal_event = threading.Event()
+        lease_renewal_thread = threading.Thread(target=self._renew_lease_until_stopped, args=(stop_lease_renewal_event,), daemon=True)
+        lease_renewal_thread.start()
+        try :
+            while not have_all_exited and not is_time_up :
+                last_exited_job_count = exited_job_count
+                # While LSF is unhealthy, don't call it at all, and leave the statuses in the table as they are
+                is_lsf_healthy = (not self._do_actually_submit) or self._lsf_circuit_breaker.is_call_allowed()
+                if is_lsf_healthy :
+                    try :
+                        if self._update_owned_job_statuses() :
+                            self._lsf_circuit_breaker.record_success()
+                    except lsf_unavailable_error as e :
+                        printfe('Unable to get job statuses from LSF, will try again later.\n%s\n' % str(e))
+                        self._lsf_circuit_breaker.record_failure()
+                        is_lsf_healthy = False
+                if is_lsf_healthy :
+                    claimed_jobs = self._claim_batch()
+                    self._submit_claimed_jobs(claimed_jobs)
+                (exited_job_count, job_count) = self._exited_and_total_job_counts()
+                if do_show_progress_bar :
+                    progress_bar.update(exited_job_count - last_exited_job_count)
+                have_all_exited = (exited_job_count == job_count)
+                if not have_all_exited :
+                    if self._do_actually_submit :
+                        time.sleep(1)
+                    is_time_up = (toc(ticId) > maximum_wait_time)
+        finally :
+            stop_lease_renewal_event.set()
+            lease_renewal_thread.join()
+            # Hand our in-progress jobs back, so another conductor can pick them up right away
+            with self._transaction() as cursor :
+                cursor.execute('UPDATE jobs SET owner = NULL WHERE owner = ?', (self._conductor_id,))
+                cursor.execute('DELETE FROM conductors WHERE conductor_id = ?', (self._conductor_id,))
+        return self.job_status_from_job_index()
+
+
+
+def _row_from_job_spec(job_spec, maximum_resources) :
+    # Converts an enqueue_many() tuple into a row for the jobs table, raising if the job can never fit in the budget
+    (slot_count, stdouterr_file_name, bsub_options_as_list, command_line_as_list) = job_spec[0:4]
+    memory_in_mb = job_spec[4] if len(job_spec)>4 else None
+    walltime_in_minutes = job_spec[5] if len(job_spec)>5 else None
+    ((_, memory_in_mb, walltime_in_minutes), bsub_options_as_list) = \
+        resolve_job_resources(slot_count, bsub_options_as_list, memory_in_mb, walltime_in_minutes)
+    check_job_fits_in_budget(budgeted_resources((slot_count, memory_in_mb, walltime_in_minutes)), maximum_resources)
+    result = (slot_count, memory_in_mb, walltime_in_minutes, stdouterr_file_name, json.dumps(bsub_options_as_list), json.dumps(command_line_as_list))
+    return result
+
+
+
+class _sqlite_immediate_transaction :
+    # Context manager for a BEGIN IMMEDIATE ... COMMIT block, so that claims are atomic across processes
+    def __init__(self, connection) :
+        self._connection = connection
+
+    def __enter__(self) :
+        self._cursor = self._connection.cursor()
+        self._cursor.execute('BEGIN IMMEDIATE')
+        return self._cursor
+
+    def __exit__(self, etype, value, traceback) :
+        if etype is None :
+            self._cursor.execute('COMMIT')
+        else :
+            self._cursor.execute('ROLLBACK')
+        self._cursor.close()
+
+
+
+def _run_test_conductor(file_name, do_actually_submit, lease_duration, batch_size) :
+    # Runs one conductor on file_name until all the jobs are done, for test_shared_bqueue().  Used as the target of a 
+    # multiprocessing.Process, so that conductors can be run side by side, and killed.
+    bqueue = shared_bqueue_type(file_name, do_actually_submit, batch_size=batch_size, lease_duration=lease_duration)
+    bqueue.run(120, False)
+    bqueue.close()
+
+
+
+def test_shared_bqueue() :
+    '''
+    Runs several conductors on one job table, and checks that each job runs once, that a conductor's jobs get taken 
+    over after it's killed, and that the resource budget holds across conductors.  Uses local jobs, and fake LSF 
+    commands (see _write_fake_lsf_commands()), so doesn't need LSF.
+    '''
+    from tpt.fuster import _write_fake_lsf_commands
+    old_path = os.environ['PATH']
+    folder_path = tempfile.mkdtemp(prefix='tpt-shared-bqueue-')
+    def check(condition, description) :
+        if not condition :
+            raise RuntimeError('Test failed: %s' % description)
+    def make_job_table(file_name, do_actually_submit, job_specs, **kwargs) :
+        # The table gets closed before any conductors are forked
+        bqueue = shared_bqueue_type(file_name, do_actually_submit, **kwargs)
+        bqueue.enqueue_many(job_specs)
+        bqueue.close()
+    def final_job_statuses(file_name) :
+        bqueue = shared_bqueue_type(file_name, False)
+        result = bqueue.job_status_from_job_index()
+        bqueue.close()
+        return result
+    def run_count_from_label(runs_file_name) :
+        # Each test job appends its label to runs_file_name when it finishes
+        result = {}
+        if os.path.exists(runs_file_name) :
+            with open(runs_file_name, 'r') as fid :
+                for label in fid.read().split() :
+                    result[label] = result.get(label, 0) + 1
+        return result
+    try :
+        # Several local conductors on one file run each job exactly once
+        file_name = os.path.join(folder_path, 'local.db')
+        runs_file_name = os.path.join(folder_path, 'local-runs.txt')
+        job_count = 20
+        make_job_table(file_name, False, 
+                       [ (1, '', [], ['sh', '-c', 'sleep 0.1; echo %d >> %s' % (job_index, runs_file_name)]) for job_index in range(job_count) ])
+        conductors = [ multiprocessing.Process(target=_run_test_conductor, args=(file_name, False, 300, 2)) for _ in range(3) ]
+        for conductor in conductors :
+            conductor.start()
+        for conductor in conductors :
+            conductor.join(120)
+        check(final_job_statuses(file_name) == [+1]*job_count, 'all the local jobs should succeed')
+        run_counts = run_count_from_label(runs_file_name)
+        check(run_counts == dict([ ('%d' % job_index, 1) for job_index in range(job_count) ]), 
+              'each local job should run exactly once, but the run counts were %s' % run_counts)
+
+        _write_fake_lsf_commands(folder_path)
+        os.environ['PATH'] = folder_path + os.pathsep + old_path
+
+        # The slot budget holds across conductors: each job records how many jobs were running when it started
+        file_name = os.path.join(folder_path, 'budget.db')
+        running_folder_path = os.path.join(folder_path, 'running')
+        concurrency_file_name = os.path.join(folder_path, 'concurrency.txt')
+        os.makedirs(running_folder_path)
+        make_job_table(file_name, True,
+                       [ (1, '', [], ['sh', '-c', 'touch {r}/{i}; ls {r} | wc -l >> {c}; sleep 1; rm {r}/{i}'.format(r=running_folder_path, i=job_index, c=concurrency_file_name)])
+                         for job_index in range(6) ],
+                       maximum_running_slot_count=2)
+        conductors = [ multiprocessing.Process(target=_run_test_conductor, args=(file_name, True, 300, 2)) for _ in range(3) ]
+        for conductor in conductors :
+            conductor.start()
+        for conductor in conductors :
+            conductor.join(120)
+        check(final_job_statuses(file_name) == [+1]*6, 'all the budgeted jobs should succeed')
+        with open(concurrency_file_name, 'r') as fid :
+            maximum_running_job_count = max([ int(line) for line in fid.read().split() ])
+        check(maximum_running_job_count <= 2, 'at most 2 jobs should run at once, over all conductors, but %d did' % maximum_running_job_count)
+
+        # A conductor that is killed partway through submitting has its submitted and claimed jobs taken over by 
+        # another, once its lease runs out
+        file_name = os.path.join(folder_path, 'takeover.db')
+        runs_file_name = os.path.join(folder_path, 'takeover-runs.txt')
+        job_count = 6
+        make_job_table(file_name, True, 
+                       [ (1, '', [], ['sh', '-c', 'sleep 2; echo %d >> %s' % (job_index, runs_file_name)]) for job_index in range(job_count) ])
+        with open(os.path.join(folder_path, 'bsub_delay'), 'w') as fid :
+            fid.write('0.5')   # so the conductor is killed partway through a batch
+        doomed_conductor = multiprocessing.Process(target=_run_test_conductor, args=(file_name, True, 2, job_count))
+        doomed_conductor.start()
+        connection = sqlite3.connect(file_name, timeout=60)
+        tic_id = tic()
+        while len(connection.execute('SELECT job_index FROM jobs WHERE status = 0').fetchall()) < 2 and toc(tic_id) < 60 :
+            time.sleep(0.1)
+        doomed_conductor.kill()
+        doomed_conductor.join()
+        submitted_job_indices = [ row[0] for row in connection.execute('SELECT job_index FROM jobs WHERE status = 0') ]
+        claimed_job_count = connection.execute('SELECT COUNT(*) FROM jobs WHERE status IS NULL AND owner IS NOT NULL').fetchone()[0]
+        connection.close()
+        check(len(submitted_job_indices) >= 2 and claimed_job_count >= 1, 
+              'the conductor should have been killed with jobs both submitted and claimed, but it had %d and %d' % (len(submitted_job_indices), claimed_job_count))
+        os.remove(os.path.join(folder_path, 'bsub_delay'))
+        job_statuses = shared_bqueue_type(file_name, True, lease_duration=2).run(120, False)
+        check(job_statuses == [+1]*job_count, 'the surviving conductor should finish all the jobs, got %s' % job_statuses)
+        run_counts = run_count_from_label(runs_file_name)
+        check(all([ run_counts.get('%d' % job_index, 0) >= 1 for job_index in range(job_count) ]), 
+              'every job should have run, but the run counts were %s' % run_counts)
+        # job_index in the table starts at 1, and the labels at 0
+        check(all([ run_counts.get('%d' % (job_index-1), 0) == 1 for job_index in submitted_job_indices ]), 
+              'the jobs that were already submitted should not be submitted again, but the run counts were %s' % run_counts)
+    finally :
+        os.environ['PATH'] = old_path
+        shutil.rmtree(folder_path)
+    print('Test passed.')
+
+
+
+# If called from command line, run the test
+if __name__ == "__main__":
+    test_shared_bqueue()
@@ -2,6 +2,7 @@ import sys
 import os
 import pwd
 import time
+import math
 import subprocess
 import io
 import datetime
@@ -10,6 +11,13 @@ import copy
 import shlex
 import stat
 import tempfile
+import fcntl
+import threading
+import heapq
+import resource
+import uuid
+import multiprocessing
+import random
 
 
 
@@ -117,13 +125,17 @@ def printfe(*args, **kwargs):
 
 
 
-def run_subprocess_and_return_stdout(command_as_list, shell=False) :
+# All the run_subprocess_*() functions take an optional timeout, in seconds.  If the command is still running when it
+# expires, the command is killed and subprocess.TimeoutExpired is raised.
+
+def run_subprocess_and_return_stdout(command_as_list, shell=False, timeout=None) :
     completed_process = \
         subprocess.run(command_as_list, 
                        stdout=subprocess.PIPE,
                        encoding='utf-8',
                        check=False, 
-                       shell=shell)
+                       shell=shell,
+                       timeout=timeout)
     stdout = completed_process.stdout    
     return_code = completed_process.returncode
     if return_code != 0 :
@@ -133,14 +145,15 @@ def run_subprocess_and_return_stdout(command_as_list, shell=False) :
 
 
 
-def run_subprocess_and_return_stdout_and_stderr(command_as_list, shell=False) :
+def run_subprocess_and_return_stdout_and_stderr(command_as_list, shell=False, timeout=None) :
     completed_process = \
         subprocess.run(command_as_list, 
                        stdout=subprocess.PIPE,
                        stderr=subprocess.PIPE, 
                        encoding='utf-8',
                        check=False, 
-                       shell=shell)
+                       shell=shell,
+                       timeout=timeout)
     stdout = completed_process.stdout    
     stderr = completed_process.stderr    
     return_code = completed_process.returncode
@@ -151,13 +164,14 @@ def run_subprocess_and_return_stdout_and_stderr(command_as_list, shell=False) :
 
 
 
-def run_subprocess_and_return_code_and_stdout(command_as_list, shell=False) :
+def run_subprocess_and_return_code_and_stdout(command_as_list, shell=False, timeout=None) :
     completed_process = \
         subprocess.run(command_as_list, 
                        stdout=subprocess.PIPE,
                        encoding='utf-8',
                        check=False, 
-                       shell=shell)
+                       shell=shell,
+                       timeout=timeout)
     stdout = completed_process.stdout
     return_code = completed_process.returncode
     #print('Result: %s' % result)                   
@@ -165,14 +179,15 @@ def run_subprocess_and_return_code_and_stdout(command_as_list, shell=False) :
 
 
 
-def run_subprocess_and_return_code_and_stdout_and_stderr(command_as_list, shell=False) :
+def run_subprocess_and_return_code_and_stdout_and_stderr(command_as_list, shell=False, timeout=None) :
     completed_process = \
         subprocess.run(command_as_list, 
                        stdout=subprocess.PIPE,
                        stderr=subprocess.PIPE,
                        encoding='utf-8',
                        check=False, 
-                       shell=shell)
+                       shell=shell,
+                       timeout=timeout)
     stdout = completed_process.stdout
     stderr = completed_process.stderr    
     return_code = completed_process.returncode
@@ -181,7 +196,7 @@ def run_subprocess_and_return_code_and_stdout_and_stderr(command_as_list, shell=
 
 
 
-def run_subprocess_and_return_code(command_as_list, shell=False) :
+def run_subprocess_and_return_code(command_as_list, shell=False, timeout=None) :
     '''
     Run the subprocess, with stdout/stderr going to those of the parent process.
     Return the return code.  *Don't* throw an exception for a nonzero return code.
@@ -189,14 +204,15 @@ def run_subprocess_and_return_code(command_as_list, shell=False) :
     completed_process = \
         subprocess.run(command_as_list, 
                        check=False, 
-                       shell=shell)
+                       shell=shell,
+                       timeout=timeout)
     return_code = completed_process.returncode
     #print('Result: %s' % result)                   
     return return_code
 
 
 
-def run_subprocess(command_as_list, shell=False) :
+def run_subprocess(command_as_list, shell=False, timeout=None) :
     '''
     Run the subprocess, with stdout/stderr going to those of the parent process.
     Throw an exception if there's a problem, otherwise return without 
@@ -205,11 +221,38 @@ def run_subprocess(command_as_list, shell=False) :
     completed_process = \
         subprocess.run(command_as_list, 
                        check=True, 
-                       shell=shell)
+                       shell=shell,
+                       timeout=timeout)
+
+
+
+def _start_kill_timer(process, timeout) :
+    # For the Popen()-based helpers: kills process once timeout seconds have passed.  Returns the timer, or None if 
+    # timeout is None.  Once the process has exited, check timer.did_fire, and cancel() the timer.
+    if timeout is None :
+        return None
+    def kill() :
+        timer.did_fire = True
+        process.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.did_fire = False
+    timer.daemon = True
+    timer.start()
+    return timer
 
 
 
-def run_subprocess_live_and_return_stdouterr(command_as_list, check=True, shell=False) :
+def _stop_kill_timer(timer, command_as_list, timeout, output) :
+    # Cancels the timer, and raises subprocess.TimeoutExpired if it fired
+    if timer is None :
+        return
+    timer.cancel()
+    if timer.did_fire :
+        raise subprocess.TimeoutExpired(command_as_list, timeout, output=output)
+
+
+
+def run_subprocess_live_and_return_stdouterr(command_as_list, check=True, shell=False, timeout=None) :
     '''
     Call an external executable, with live display of the output.  
     Return stdout+stderr as a string.
@@ -220,12 +263,14 @@ def run_subprocess_live_and_return_stdouterr(command_as_list, check=True, shell=
                           bufsize=1, 
                           encoding='utf-8', 
                           shell=shell) as p, io.StringIO() as buf:
+        timer = _start_kill_timer(p, timeout)
         for line in p.stdout :
             print(line, end='')
             buf.write(line)
         p.communicate()  # Seemingly needed to make sure returncode is set.  
                          # Hopefully will not deadlock b/c we've already 
                          # exhausted stdout.
+        _stop_kill_timer(timer, command_as_list, timeout, buf.getvalue())
         return_code = p.returncode
         if check :
             if return_code != 0 :
@@ -235,15 +280,17 @@ def run_subprocess_live_and_return_stdouterr(command_as_list, check=True, shell=
 
 
 
-def run_subprocess_live(command_as_list, check=True, shell=False) :
+def run_subprocess_live(command_as_list, check=True, shell=False, timeout=None) :
     '''
     Call an external executable, with live display of the output.
     '''
     with subprocess.Popen(command_as_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, encoding='utf-8', shell=shell) as p, io.StringIO() as buf:
+        timer = _start_kill_timer(p, timeout)
         for line in p.stdout :
             print(line, end='')
             buf.write(line)
         p.communicate()  # Seemingly needed to make sure returncode is set.  Hopefully will not deadlock b/c we've already exhausted stdout.    
+        _stop_kill_timer(timer, command_as_list, timeout, buf.getvalue())
         return_code = p.returncode
         if check :
             if return_code != 0 :
@@ -252,17 +299,152 @@ def run_subprocess_live(command_as_list, check=True, shell=False) :
 
 
 
-def run_subprocess_with_log_and_return_code(command_as_list, log_file_name, shell=False) :
+def run_subprocess_with_log_and_return_code(command_as_list, log_file_name, shell=False, timeout=None) :
     '''
     Call an external executable, with stdout+stderr to log file.
     '''
     with open(log_file_name, 'w') as fid:
-        completed_process = subprocess.run(command_as_list, stdout=fid, stderr=subprocess.STDOUT, encoding='utf-8', shell=shell, check=False)
+        completed_process = subprocess.run(command_as_list, stdout=fid, stderr=subprocess.STDOUT, encoding='utf-8', shell=shell, check=False, timeout=timeout)
         return_code = completed_process.returncode
     return return_code
 
 
 
+def _read_proc_file(pid, file_name) :
+    # Returns the contents of /proc/<pid>/<file_name>, or None if the process has gone away
+    try :
+        with open('/proc/%d/%s' % (pid, file_name), 'r') as fid :
+            return fid.read()
+    except (OSError, ValueError) :
+        return None
+
+
+
+def get_descendant_pids(pid) :
+    '''
+    Returns the pids of the process and all its live descendants.  Uses /proc/<pid>/task/<tid>/children where the
+    kernel provides it, which only touches the processes in the tree.  Otherwise scans all of /proc for parent pids.
+    '''
+    if os.path.exists('/proc/%d/task/%d/children' % (pid, pid)) :
+        result = []
+        pids_to_visit = [pid]
+        while isladen(pids_to_visit) :
+            this_pid = pids_to_visit.pop()
+            result.append(this_pid)
+            try :
+                tids = os.listdir('/proc/%d/task' % this_pid)
+            except OSError :
+                continue
+            for tid in tids :
+                children = _read_proc_file(this_pid, 'task/%s/children' % tid)
+                if children is not None :
+                    pids_to_visit.extend([ int(child) for child in children.split() ])
+    else :
+        child_pids_from_pid = {}
+        for entry in os.listdir('/proc') :
+            if not entry.isdigit() :
+                continue
+            stat = _read_proc_file(int(entry), 'stat')
+            if stat is None :
+                continue
+            parent_pid = int(stat[stat.rfind(')')+2:].split()[1])
+            child_pids_from_pid.setdefault(parent_pid, []).append(int(entry))
+        result = []
+        pids_to_visit = [pid]
+        while isladen(pids_to_visit) :
+            this_pid = pids_to_visit.pop()
+            result.append(this_pid)
+            pids_to_visit.extend(child_pids_from_pid.get(this_pid, []))
+    return result
+
+
+
+class process_tree_sampler_type :
+    '''
+    Samples the resident memory and CPU time of a process and all its descendants from /proc, every interval seconds,
+    on a background thread, so we can see what a locally-run job would need on the cluster.  Each sample reads two 
+    small /proc files per process in the tree, so the overhead is small even at sub-second intervals.
+    Call start() once the process is running, and stop() once it has exited, which returns a dict with the peak and
+    mean RSS (in MB) over the samples, the CPU time of the tree (in seconds), the wall time, and the sample count.
+    The CPU time comes from getrusage() on reaped children, which includes processes that came and went between 
+    samples.  It assumes nothing else in this process reaps children at the same time.
+    '''
+    _page_byte_count = os.sysconf('SC_PAGE_SIZE')
+    _clock_tick_count_per_second = os.sysconf('SC_CLK_TCK')
+
+    def __init__(self, pid, interval=1.0) :
+        self._pid = pid
+        self._interval = interval
+        self._rss_samples = []
+        self._last_cpu_time = 0.0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample_until_stopped, daemon=True)
+
+    def start(self) :
+        self._start_time = time.time()
+        self._start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._thread.start()
+
+    def sample(self) :
+        # Returns (rss_in_bytes, cpu_time) summed over the live processes in the tree
+        rss_in_bytes = 0
+        cpu_tick_count = 0
+        for pid in get_descendant_pids(self._pid) :
+            statm = _read_proc_file(pid, 'statm')
+            stat = _read_proc_file(pid, 'stat')
+            if statm is None or stat is None :
+                continue   # exited since we listed it
+            rss_in_bytes += int(statm.split()[1]) * self._page_byte_count
+            fields = stat[stat.rfind(')')+2:].split()   # the command name in parens may contain spaces
+            cpu_tick_count += sum([ int(field) for field in fields[11:15] ])   # utime, stime, cutime, cstime
+        return (rss_in_bytes, cpu_tick_count / self._clock_tick_count_per_second)
+
+    def _sample_until_stopped(self) :
+        while True :
+            (rss_in_bytes, cpu_time) = self.sample()
+            if rss_in_bytes > 0 :
+                self._rss_samples.append(rss_in_bytes)
+                self._last_cpu_time = cpu_time
+            if self._stop_event.wait(self._interval) :
+                break
+
+    def stop(self) :
+        self._stop_event.set()
+        self._thread.join()
+        wall_time = time.time() - self._start_time
+        end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = ( (end_rusage.ru_utime - self._start_rusage.ru_utime) + (end_rusage.ru_stime - self._start_rusage.ru_stime) )
+        mb_from_bytes = 1.0 / (1024*1024)
+        result = { 'peak_rss_in_mb': (max(self._rss_samples) * mb_from_bytes) if isladen(self._rss_samples) else math.nan,
+                   'mean_rss_in_mb': (sum(self._rss_samples) / len(self._rss_samples) * mb_from_bytes) if isladen(self._rss_samples) else math.nan,
+                   'cpu_time': max(cpu_time, self._last_cpu_time),
+                   'wall_time': wall_time,
+                   'sample_count': len(self._rss_samples) }
+        return result
+
+
+
+def run_subprocess_live_and_sample_resources(command_as_list, sampling_interval=1.0, shell=False, timeout=None) :
+    '''
+    Like run_subprocess_live(), with check=False, but also samples the resource use of the process tree (see 
+    process_tree_sampler_type).  Returns (return_code, resource_usage).
+    '''
+    with subprocess.Popen(command_as_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, encoding='utf-8', shell=shell) as p :
+        sampler = process_tree_sampler_type(p.pid, sampling_interval)
+        sampler.start()
+        timer = _start_kill_timer(p, timeout)
+        try :
+            for line in p.stdout :
+                print(line, end='')
+            p.communicate()
+        finally :
+            resource_usage = sampler.stop()
+        _stop_kill_timer(timer, command_as_list, timeout, None)
+        return_code = p.returncode
+    return (return_code, resource_usage)
+
+
+
 def space_out(lst) :
     '''
     Given a list of strings, return a single string with the list concatenated, but with spaces between them.
@@ -527,6 +709,77 @@ def simple_dir(folder_name) :
 
 
 
+def get_file_inventory(folder_path) :
+    '''
+    Recursively lists the regular files under folder_path, and returns (path_from_file_index, byte_count_from_file_index).
+    Uses os.scandir(), which gets the sizes from the directory entries where it can, so this is fast even for 
+    millions of files.  Symlinks are not followed.
+    '''
+    path_from_file_index = []
+    byte_count_from_file_index = []
+    folder_paths_to_visit = [folder_path]
+    while isladen(folder_paths_to_visit) :
+        this_folder_path = folder_paths_to_visit.pop()
+        with os.scandir(this_folder_path) as entries :
+            for entry in entries :
+                if entry.is_dir(follow_symlinks=False) :
+                    folder_paths_to_visit.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) :
+                    path_from_file_index.append(entry.path)
+                    byte_count_from_file_index.append(entry.stat(follow_symlinks=False).st_size)
+    return (path_from_file_index, byte_count_from_file_index)
+
+
+
+def write_file_atomically(file_name, contents) :
+    '''
+    Writes the string contents to file_name by writing it to a temporary file next to it, then renaming that into 
+    place.  So readers never see a half-written file, and a crash never leaves one.  The temporary file name is 
+    unique, so processes writing the same file at once don't clobber each other's temporary files.
+    '''
+    temp_file_name = '%s.tmp.%s' % (file_name, uuid.uuid4().hex[:8])
+    try :
+        with open(temp_file_name, 'w') as fid :
+            fid.write(contents)
+        os.replace(temp_file_name, file_name)
+    except BaseException :
+        if os.path.exists(temp_file_name) :
+            os.remove(temp_file_name)
+        raise
+
+
+
+def partition_by_byte_count(byte_count_from_file_index, group_count=None, target_byte_count_per_group=None) :
+    '''
+    Splits files into groups with roughly equal total byte counts, e.g. to make jobs that each take about the same 
+    time.  Give either the number of groups, or the target number of bytes per group.  Uses the longest-processing-
+    time-first greedy algorithm: files are taken biggest first, and each goes into the group with the fewest bytes so 
+    far (kept in a heap), so it takes O(n log n) time for n files.
+    Returns a list of groups, each a list of file indices in increasing order.  Empty groups are dropped.
+    '''
+    file_count = len(byte_count_from_file_index)
+    if group_count is None :
+        if target_byte_count_per_group is None :
+            raise RuntimeError('Need either group_count or target_byte_count_per_group')
+        total_byte_count = sum(byte_count_from_file_index)
+        group_count = max(1, math.ceil(total_byte_count / target_byte_count_per_group))
+    elif target_byte_count_per_group is not None :
+        raise RuntimeError('Can\'t specify both group_count and target_byte_count_per_group')
+    group_count = min(group_count, file_count)
+    if group_count <= 0 :
+        return []
+    file_index_from_sorted_index = sorted(range(file_count), key=byte_count_from_file_index.__getitem__, reverse=True)
+    file_indices_from_group_index = [ [] for _ in range(group_count) ]
+    byte_count_and_group_index_heap = [ (0, group_index) for group_index in range(group_count) ]   # already a valid heap
+    for file_index in file_index_from_sorted_index :
+        (byte_count, group_index) = byte_count_and_group_index_heap[0]
+        file_indices_from_group_index[group_index].append(file_index)
+        heapq.heapreplace(byte_count_and_group_index_heap, (byte_count + byte_count_from_file_index[file_index], group_index))
+    result = [ sorted(file_indices) for file_indices in file_indices_from_group_index if isladen(file_indices) ]
+    return result
+
+
+
 def read_yaml_file_badly(file_name) :
     result = {}
     with open(file_name, 'r', encoding='UTF-8') as file:
@@ -546,6 +799,153 @@ def read_yaml_file_badly(file_name) :
     
 
 
+class token_bucket_type :
+    '''
+    Token-bucket rate limiter.  Tokens accumulate at rate per second, up to burst_count of them, and acquire() blocks
+    until enough tokens are available.  A rate of math.inf means no limit.
+
+    If shared_state_file_name is given, the bucket state lives in that file, under an fcntl() lock, so all the 
+    processes on a host that use the same file share a single budget.  Otherwise the budget is per-process.
+
+    Keeps track of how much time has been spent waiting for tokens; see metrics().
+    '''
+    def __init__(self, rate, burst_count=1, shared_state_file_name=None) :
+        self._rate = rate
+        self._burst_count = burst_count
+        self._shared_state_file_name = shared_state_file_name
+        self._token_count = burst_count
+        self._last_refill_time = time.time()
+        self._lock = threading.Lock()
+        self._acquire_count = 0
+        self._waited_acquire_count = 0
+        self._total_wait_time = 0.0
+        self._maximum_wait_time = 0.0
+
+    def acquire(self, token_count=1) :
+        # Blocks until token_count tokens are available, then takes them.  Returns the time spent waiting, in seconds.
+        if self._rate == math.inf :
+            return 0.0
+        start_time = time.time()
+        while True :
+            wait_time = self._try_to_take(token_count)
+            if wait_time <= 0 :
+                break
+            time.sleep(wait_time)
+        waited_time = time.time() - start_time
+        with self._lock :
+            self._acquire_count += 1
+            if waited_time > 0.001 :
+                self._waited_acquire_count += 1
+            self._total_wait_time += waited_time
+            self._maximum_wait_time = max(self._maximum_wait_time, waited_time)
+        return waited_time
+
+    def _try_to_take(self, token_count) :
+        # Takes the tokens and returns 0 if there are enough, otherwise returns how long to wait before trying again
+        with self._lock :
+            if self._shared_state_file_name is None :
+                (self._token_count, self._last_refill_time, wait_time) = \
+                    self._take_from_state(self._token_count, self._last_refill_time, token_count)
+            else :
+                fd = os.open(self._shared_state_file_name, os.O_RDWR | os.O_CREAT, 0o666)
+                try :
+                    fcntl.lockf(fd, fcntl.LOCK_EX)
+                    tokens = os.pread(fd, 64, 0).split()
+                    if len(tokens) == 2 :
+                        (old_token_count, last_refill_time) = (float(tokens[0]), float(tokens[1]))
+                    else :
+                        (old_token_count, last_refill_time) = (self._burst_count, time.time())
+                    (new_token_count, new_refill_time, wait_time) = \
+                        self._take_from_state(old_token_count, last_refill_time, token_count)
+                    state = ('%.6f %.6f' % (new_token_count, new_refill_time)).ljust(64).encode('ascii')
+                    os.pwrite(fd, state, 0)
+                finally :
+                    os.close(fd)   # releases the lock
+        return wait_time
+
+    def _take_from_state(self, old_token_count, last_refill_time, token_count) :
+        # Returns (new_token_count, new_refill_time, wait_time)
+        now = time.time()
+        available_token_count = min(self._burst_count, old_token_count + self._rate * max(0, now-last_refill_time))
+        if available_token_count >= token_count :
+            return (available_token_count - token_count, now, 0)
+        else :
+            return (available_token_count, now, (token_count - available_token_count) / self._rate)
+
+    def metrics(self) :
+        # Returns a dict with the number of acquire() calls, how many of those had to wait, and the total and maximum wait times
+        with self._lock :
+            result = { 'acquire_count': self._acquire_count,
+                       'waited_acquire_count': self._waited_acquire_count,
+                       'total_wait_time': self._total_wait_time,
+                       'maximum_wait_time': self._maximum_wait_time }
+        return result
+
+
+
+class circuit_breaker_type :
+    '''
+    Keeps track of whether some external service (e.g. the LSF master) is healthy, so callers can stop hammering it 
+    when it isn't.  Report the outcome of each call with record_success() or record_failure().  After 
+    failure_threshold consecutive failures the breaker opens, and is_call_allowed() returns false for reset_timeout 
+    seconds.  After that it is half-open: calls are allowed again, and the first outcome decides whether the breaker 
+    closes, or opens again for twice as long as last time (up to maximum_reset_timeout).
+    '''
+    def __init__(self, failure_threshold=3, reset_timeout=30, maximum_reset_timeout=600) :
+        self._failure_threshold = failure_threshold
+        self._initial_reset_timeout = reset_timeout
+        self._maximum_reset_timeout = maximum_reset_timeout
+        self._reset_timeout = reset_timeout
+        self._consecutive_failure_count = 0
+        self._open_time = None   # None means closed
+        self._is_half_open = False
+        self._failure_count = 0
+        self._open_count = 0
+
+    def state(self) :
+        # Returns 'closed', 'open', or 'half-open'
+        if self._open_time is None :
+            result = 'closed'
+        elif self._is_half_open or time.time() - self._open_time >= self._reset_timeout :
+            result = 'half-open'
+        else :
+            result = 'open'
+        return result
+
+    def is_call_allowed(self) :
+        result = (self.state() != 'open')
+        if result and self._open_time is not None :
+            self._is_half_open = True
+        return result
+
+    def record_success(self) :
+        self._consecutive_failure_count = 0
+        self._open_time = None
+        self._is_half_open = False
+        self._reset_timeout = self._initial_reset_timeout
+
+    def record_failure(self) :
+        self._failure_count += 1
+        self._consecutive_failure_count += 1
+        if self._is_half_open :
+            # The trial call failed, so back off for longer
+            self._reset_timeout = min(2*self._reset_timeout, self._maximum_reset_timeout)
+            self._open_time = time.time()
+            self._is_half_open = False
+            self._open_count += 1
+        elif self._open_time is None and self._consecutive_failure_count >= self._failure_threshold :
+            self._open_time = time.time()
+            self._open_count += 1
+
+    def metrics(self) :
+        # Returns a dict with the current state, the total number of failures recorded, and the number of times the breaker has opened
+        result = { 'state': self.state(),
+                   'failure_count': self._failure_count,
+                   'open_count': self._open_count }
+        return result
+
+
+
 class LockFile:
     '''
     Simple lock file implementation.  Definitely has the potential for race conditions, but
@@ -667,4 +1067,130 @@ def process_tristate_arg_pair(do, nodo, name):
         else :
             result = None
     return result
-    
\ No newline at end of file
+    
+
+
+def _check(condition, description) :
+    # For the tests below
+    if not condition :
+        raise RuntimeError('Test failed: %s' % description)
+
+
+
+def _acquire_tokens_from_shared_bucket(shared_state_file_name, rate, burst_count, acquire_count) :
+    # Run in a separate process by test_token_bucket()
+    bucket = token_bucket_type(rate, burst_count, shared_state_file_name)
+    for _ in range(acquire_count) :
+        bucket.acquire()
+
+
+
+def test_token_bucket() :
+    # The burst is available straight away, after which tokens come at the given rate
+    bucket = token_bucket_type(20, 5)
+    tic_id = tic()
+    for _ in range(5) :
+        bucket.acquire()
+    _check(toc(tic_id) < 0.1, 'the burst should not wait')
+    for _ in range(10) :
+        bucket.acquire()
+    elapsed_time = toc(tic_id)
+    _check(0.4 < elapsed_time < 1.0, 'ten tokens at 20 per second should take about 0.5 s, took %g s' % elapsed_time)
+    metrics = bucket.metrics()
+    _check(metrics['acquire_count'] == 15, 'there should be 15 acquires, got %d' % metrics['acquire_count'])
+    _check(metrics['waited_acquire_count'] >= 9, 'most acquires after the burst should wait, got %d' % metrics['waited_acquire_count'])
+    _check(0.4 < metrics['total_wait_time'] < 1.0, 'the total wait time should be about 0.5 s, got %g s' % metrics['total_wait_time'])
+    _check(token_bucket_type(math.inf).acquire(1000) == 0.0, 'an infinite rate should never wait')
+
+    # Processes that use the same state file share one budget: two processes taking 5 tokens each, at 10 per 
+    # second with a burst of one, take about 0.9 s in all, where each would take 0.4 s on its own
+    folder_path = tempfile.mkdtemp(prefix='tpt-token-bucket-')
+    try :
+        shared_state_file_name = os.path.join(folder_path, 'bucket-state')
+        processes = [ multiprocessing.Process(target=_acquire_tokens_from_shared_bucket, args=(shared_state_file_name, 10, 1, 5)) 
+                      for _ in range(2) ]
+        tic_id = tic()
+        for process in processes :
+            process.start()
+        for process in processes :
+            process.join()
+        elapsed_time = toc(tic_id)
+        _check(all([ process.exitcode == 0 for process in processes ]), 'the token-taking processes should succeed')
+        _check(elapsed_time > 0.8, 'the processes should share the budget, but took only %g s' % elapsed_time)
+    finally :
+        for file_name in os.listdir(folder_path) :
+            os.remove(os.path.join(folder_path, file_name))
+        os.rmdir(folder_path)
+    print('Test passed.')
+
+
+
+def test_partition_by_byte_count() :
+    # Every file lands in exactly one group, and with the largest-first greedy algorithm, no two groups differ by more
+    # than the biggest file
+    random_generator = random.Random(42)
+    byte_count_from_file_index = [ random_generator.randint(0, 10**6) for _ in range(1000) ]
+    groups = partition_by_byte_count(byte_count_from_file_index, group_count=10)
+    _check(len(groups) == 10, 'there should be 10 groups, got %d' % len(groups))
+    _check(sorted(flatten(groups)) == list(range(1000)), 'each file should be in exactly one group')
+    _check(all([ group == sorted(group) for group in groups ]), 'the file indices in each group should be in increasing order')
+    byte_count_from_group_index = [ sum(ibl(byte_count_from_file_index, group)) for group in groups ]
+    _check(max(byte_count_from_group_index) - min(byte_count_from_group_index) <= max(byte_count_from_file_index),
+           'the groups should be balanced, got byte counts %s' % byte_count_from_group_index)
+    _check(partition_by_byte_count([4, 1, 1, 1, 1], group_count=2) == [[0], [1, 2, 3, 4]], 
+           'a big file should get a group to itself')
+
+    # Asking for a group size instead of a group count
+    groups = partition_by_byte_count([10]*10, target_byte_count_per_group=30)
+    _check(len(groups) == 4, 'a 30-byte target should make 4 groups of 100 bytes, got %d' % len(groups))
+    _check(partition_by_byte_count([0, 0, 0], target_byte_count_per_group=30) == [[0, 1, 2]], 'empty files should make one group')
+
+    # Edge cases
+    _check(partition_by_byte_count([], group_count=3) == [], 'no files should make no groups')
+    _check(partition_by_byte_count([], target_byte_count_per_group=30) == [], 'no files should make no groups')
+    _check(partition_by_byte_count([5, 6], group_count=0) == [], 'zero groups should make no groups')
+    _check(sorted(partition_by_byte_count([5, 6, 7], group_count=10)) == [[0], [1], [2]], 'there should be at most one group per file')
+    for (group_count, target_byte_count_per_group) in [ (None, None), (2, 30) ] :
+        try :
+            partition_by_byte_count([5, 6], group_count, target_byte_count_per_group)
+        except RuntimeError :
+            pass
+        else :
+            raise RuntimeError('Test failed: exactly one of group_count and target_byte_count_per_group should be required')
+    print('Test passed.')
+
+
+
+def test_process_tree_sampler() :
+    # The job's work is done by a grandchild process, to check that the whole tree gets sampled.  The grandchild holds
+    # 50 MB and burns CPU for a second.
+    grandchild_source = 'import time\nx = b"x" * (50*1024*1024)\nt = time.time()\nwhile time.time() - t < 1 : pass\n'
+    process = subprocess.Popen(['sh', '-c', '"$0" -c \'%s\'; true' % grandchild_source, sys.executable])
+    sampler = process_tree_sampler_type(process.pid, 0.1)
+    sampler.start()
+    time.sleep(0.5)
+    descendant_pid_count = len(get_descendant_pids(process.pid))
+    (rss_in_bytes, _) = sampler.sample()
+    process.wait()
+    resource_usage = sampler.stop()
+    _check(descendant_pid_count == 2, 'the tree should hold the shell and the grandchild, got %d processes' % descendant_pid_count)
+    _check(rss_in_bytes > 40*1024*1024, 'a sample should include the grandchild\'s memory, got %d bytes' % rss_in_bytes)
+    _check(resource_usage['peak_rss_in_mb'] > 40, 'the peak RSS should be over 40 MB, got %g MB' % resource_usage['peak_rss_in_mb'])
+    _check(resource_usage['mean_rss_in_mb'] <= resource_usage['peak_rss_in_mb'], 'the mean RSS should be no more than the peak')
+    _check(resource_usage['cpu_time'] > 0.8, 'the CPU time should be about 1 s, got %g s' % resource_usage['cpu_time'])
+    _check(resource_usage['wall_time'] >= 1, 'the wall time should be at least 1 s, got %g s' % resource_usage['wall_time'])
+    _check(resource_usage['sample_count'] >= 5, 'there should be a sample every 0.1 s, got %d' % resource_usage['sample_count'])
+
+    # A process that exits straight away gets at most one sample, and its return code comes through
+    (return_code, resource_usage) = run_subprocess_live_and_sample_resources(['sh', '-c', 'exit 3'], 10)
+    _check(return_code == 3, 'the return code should be 3, got %s' % return_code)
+    _check(resource_usage['sample_count'] <= 1, 'there should be at most one sample, got %d' % resource_usage['sample_count'])
+    print('Test passed.')
+
+
+
+# If called from command line, run the test(s)
+if __name__ == "__main__":
+    test_token_bucket()
+    test_partition_by_byte_count()
+    test_process_tree_sampler()